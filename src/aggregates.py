@@ -0,0 +1,158 @@
+import os
+import shutil
+
+import pandas as pd
+
+CUBE_PATH = './data/processed/cubes'
+METRICS = ['ENTRIES_DIFF', 'EXITS_DIFF', 'BUSYNESS']
+# name: (group by station, time grain)
+CUBES = {'station_hour': (True, 'h'), 'station_day': (True, 'D'), 'station_week': (True, 'W'),
+         'system_hour': (False, 'h'), 'system_day': (False, 'D'), 'system_week': (False, 'W')}
+
+def _station_col(df):
+    """Returns name of station column: `Station` if station dataset is joined, otherwise `UNIT`."""
+    return 'Station' if 'Station' in df.columns else 'UNIT'
+
+def _floor_time(times, grain):
+    """Floors audit times to hour, day or week (weeks start on Monday).
+
+    Parameters
+    ----------
+    times : np.ndarray
+        audit times (datetime64[ns])
+    grain : str
+        'h' - hour, 'D' - day, 'W' - week
+    """
+    if grain in ('h', 'D'):
+        return times.astype(f'datetime64[{grain}]').astype('datetime64[ns]')
+
+    days = times.astype('datetime64[D]')
+    # 1970-01-01 is Thursday
+    return (days - (days.astype('int64') + 3) % 7).astype('datetime64[ns]')
+
+def build_cubes(df, cubes=None):
+    """Aggregates audit table (after `feature_generation.calc_features_from_cumulative_records`)
+        to station and system level rollups of ENTRIES_DIFF, EXITS_DIFF and BUSYNESS.
+        Returns dict {cube name: table}, table columns are
+        [station column,] PERIOD, ENTRIES_DIFF, EXITS_DIFF, BUSYNESS, N_AUDITS.
+
+        Relative counters are assigned to the period of audit (end of audit interval),
+        as `AUDIT_HOUR` does, see `resampling` for spreading them over hours of interval.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table with AUDIT_DATE_TIME and relative counters
+    cubes : list or None
+        names of cubes to build, see `CUBES`, if None - builds all
+    """
+    station_col = _station_col(df)
+    times = df.AUDIT_DATE_TIME.values
+    values = df[METRICS].astype('float64')
+    results = {}
+
+    for name in cubes or CUBES:
+        by_station, grain = CUBES[name]
+        keys = [df[station_col]] if by_station else []
+        period = pd.Series(_floor_time(times, grain), index=df.index, name='PERIOD')
+
+        grouped = values.groupby(keys + [period], observed=True, sort=True)
+        df_cube = grouped.sum(min_count=1)
+        df_cube['N_AUDITS'] = grouped.BUSYNESS.count()
+        results[name] = df_cube.reset_index()
+
+    return results
+
+def _cube_file(cube_path, name, week):
+    return os.path.join(cube_path, name, f'{week}.parquet')
+
+def update_cubes(df, week, cube_path=CUBE_PATH, cubes=None):
+    """Builds cubes for one week of data and saves them, replacing cubes of this week if they exist.
+        Cubes are stored per source week (`cube_path/<cube>/<week>.parquet`), so refresh
+        of one week does not touch other weeks. Weeks are summed on read, see `load_cube`.
+        Weeks must not share audits, otherwise they are counted twice.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table of one week with relative counters
+    week : str
+        week id, i.e. '130105'
+    cube_path : str
+        folder of cubes
+    cubes : list or None
+        names of cubes to build, see `CUBES`, if None - builds all
+    """
+    for name, df_cube in build_cubes(df, cubes).items():
+        os.makedirs(os.path.join(cube_path, name), exist_ok=True)
+        # sums are kept in float64, system totals overflow exact integers of float32
+        df_cube = df_cube.astype({'N_AUDITS': 'int32'})
+        df_cube.to_parquet(_cube_file(cube_path, name, week), index=False, compression='zstd')
+
+def rebuild_cubes(df, cube_path=CUBE_PATH, cubes=None):
+    """Builds and saves cubes for whole audit table from scratch (existing cubes are removed).
+        Data is split by source week (WEEK column of parquet storage) if it is available,
+        otherwise by calendar week of audit. Later weeks are added with `update_cubes`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table with relative counters
+    cube_path : str
+        folder of cubes
+    cubes : list or None
+        names of cubes to build, see `CUBES`, if None - builds all
+    """
+    for name in cubes or CUBES:
+        if os.path.isdir(os.path.join(cube_path, name)):
+            shutil.rmtree(os.path.join(cube_path, name))
+
+    if 'WEEK' in df.columns:
+        weeks = df.WEEK.astype(str)
+    else:
+        weeks = pd.Series(_floor_time(df.AUDIT_DATE_TIME.values, 'W'), index=df.index).dt.strftime('%y%m%d')
+
+    for week, df_week in df.groupby(weeks, sort=True):
+        update_cubes(df_week, week, cube_path, cubes)
+
+def load_cube(name, cube_path=CUBE_PATH, stations=None, start=None, end=None):
+    """Loads cube, sums partial aggregates of weeks, filters stations and periods.
+
+    Parameters
+    ----------
+    name : str
+        cube name, see `CUBES`
+    cube_path : str
+        folder of cubes
+    stations : list or None
+        stations to keep, if None - keeps all
+    start : str or None
+        first period to keep, i.e. '2013-02-01'
+    end : str or None
+        last period to keep (included)
+    """
+    df = pd.read_parquet(os.path.join(cube_path, name))
+    keys = [col for col in df.columns if col not in METRICS + ['N_AUDITS']]
+
+    if stations is not None and keys[0] != 'PERIOD':
+        df = df[df[keys[0]].isin(stations)]
+    if start is not None:
+        df = df[df.PERIOD >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df.PERIOD <= pd.Timestamp(end)]
+
+    return df.groupby(keys, observed=True, sort=True).sum(min_count=1).reset_index()
+
+def to_wide(df_cube, metric='BUSYNESS'):
+    """Pivots station cube to table station x period, ready for plotting functions.
+
+    Parameters
+    ----------
+    df_cube : pd.DataFrame
+        station level cube, see `load_cube`
+    metric : str
+        metric to pivot
+    """
+    station_col = df_cube.columns[0]
+
+    return df_cube.pivot(index=station_col, columns='PERIOD', values=metric)
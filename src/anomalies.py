@@ -0,0 +1,156 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from src import aggregates
+from src import feature_generation
+from src import resampling
+
+STATUS_OK, STATUS_DEGRADED, STATUS_CLOSED = 0, 1, 2
+STATUS_NAMES = {STATUS_OK: 'ok', STATUS_DEGRADED: 'degraded', STATUS_CLOSED: 'closed'}
+
+def _grid_sum(cells, n_cells, weights=None):
+    return np.bincount(cells, weights=weights, minlength=n_cells)
+
+def _same_weekday_baseline(grid, n_weeks):
+    """Returns median of the same day of week over `n_weeks` previous weeks for each cell of
+        device x day grid (empty cells are skipped), NaN if there is no history.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        device x day grid of values, NaN for days to skip
+    n_weeks : int
+        number of previous weeks
+    """
+    n_days = grid.shape[1]
+    shifted = np.full((n_weeks,) + grid.shape, np.nan)
+    for week in range(1, n_weeks + 1):
+        shift = 7 * week
+        if shift < n_days:
+            shifted[week - 1, :, shift:] = grid[:, :-shift]
+
+    with warnings.catch_warnings():
+        # no history for first weeks
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmedian(shifted, axis=0)
+
+def device_day_status(df, max_gap_hours=8, low_ratio=0.3, min_baseline=100, baseline_weeks=4):
+    """Flags anomalies of each device for each day on device x day grid (all arrays, no loops over devices).
+        Returns table, one row per device and day (days without audits included):
+
+        * N_AUDITS - number of audits, N_MISSING - audits below usual daily number of device (median),
+            N_GAPS - intervals between audits longer than `max_gap_hours`
+        * N_REVERSED - audits with counter running backwards (ENTRIES_FLAG / EXITS_FLAG)
+        * N_NON_REGULAR - audits with DESC other than REGULAR (i.e. RECOVR AUD, DOOR OPEN)
+        * STUCK - counters did not move during whole day
+        * BUSYNESS and BASELINE - median busyness of the same day of week of previous weeks,
+            LOW_THROUGHPUT - busyness below `low_ratio` of baseline
+        * STATUS - `STATUS_CLOSED` (no audits or stuck), `STATUS_DEGRADED` (any other anomaly) or `STATUS_OK`
+
+        Audit (interval) belongs to the day of audit, as in `aggregates.build_cubes`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table after `feature_generation.calc_features_from_cumulative_records`
+    max_gap_hours : int
+        longer intervals between audits are counted as gaps (missing audits)
+    low_ratio : float
+        busyness below `low_ratio * BASELINE` is low throughput
+    min_baseline : float
+        days with baseline below this are not checked for low throughput (quiet devices)
+    baseline_weeks : int
+        number of previous weeks of baseline
+    """
+    codes, devices = resampling._device_index(df)
+    days = df.AUDIT_DATE_TIME.values.astype('datetime64[D]')
+    first_day = days.min()
+    day_codes = (days - first_day).astype('int64')
+    n_devices, n_days = len(devices), int(day_codes.max()) + 1
+    n_cells = n_devices * n_days
+    cells = codes.astype('int64') * n_days + day_codes
+
+    busyness = df.BUSYNESS.to_numpy(dtype='float64')
+    has_value = ~np.isnan(busyness)
+    flags = feature_generation.COUNTER_REVERSED
+    is_reversed = (df.ENTRIES_FLAG.to_numpy() == flags) | (df.EXITS_FLAG.to_numpy() == flags)
+    is_gap = df.TIME_DIFF.to_numpy() > np.timedelta64(max_gap_hours, 'h')
+
+    n_audits = _grid_sum(cells, n_cells)
+    n_values = _grid_sum(cells, n_cells, has_value)
+    grid_busyness = _grid_sum(cells, n_cells, np.where(has_value, busyness, 0.))
+
+    # usual number of audits per day of each device
+    audits_grid = n_audits.reshape(n_devices, n_days).astype('float64')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        expected = np.nanmedian(np.where(audits_grid > 0, audits_grid, np.nan), axis=1)
+    n_missing = np.maximum(np.nan_to_num(expected)[:, None] - audits_grid, 0).ravel()
+
+    stuck = (n_values > 0) & (grid_busyness == 0)
+    closed = (n_audits == 0) | stuck
+
+    # closed days and days without relative values do not count in baseline
+    busyness_grid = np.where(closed | (n_values == 0), np.nan, grid_busyness).reshape(n_devices, n_days)
+    baseline = _same_weekday_baseline(busyness_grid, baseline_weeks).ravel()
+    low = ~closed & (baseline >= min_baseline) & (grid_busyness < low_ratio * baseline)
+
+    n_gaps = _grid_sum(cells, n_cells, is_gap)
+    n_reversed = _grid_sum(cells, n_cells, is_reversed)
+    n_non_regular = _grid_sum(cells, n_cells, df.DESC.astype(str).to_numpy() != 'REGULAR')
+    degraded = ~closed & (low | (n_missing > 0) | (n_gaps > 0) | (n_reversed > 0) | (n_non_regular > 0))
+
+    df_status = devices.iloc[np.repeat(np.arange(n_devices), n_days)].reset_index(drop=True)
+    df_status['DATE'] = np.tile(first_day + np.arange(n_days), n_devices).astype('datetime64[ns]')
+    df_status['N_AUDITS'] = n_audits.astype('int32')
+    df_status['N_MISSING'] = n_missing.astype('int32')
+    df_status['N_GAPS'] = n_gaps.astype('int32')
+    df_status['N_REVERSED'] = n_reversed.astype('int32')
+    df_status['N_NON_REGULAR'] = n_non_regular.astype('int32')
+    df_status['STUCK'] = stuck
+    df_status['BUSYNESS'] = np.where(n_values > 0, grid_busyness, np.nan).astype('float32')
+    df_status['BASELINE'] = baseline.astype('float32')
+    df_status['LOW_THROUGHPUT'] = low
+    df_status['STATUS'] = np.select([closed, degraded], [STATUS_CLOSED, STATUS_DEGRADED], STATUS_OK).astype('int8')
+
+    return df_status
+
+def station_day_status(df_device_status):
+    """Rolls device statuses up to stations: number of devices, closed and degraded devices for each day.
+        Station STATUS is `STATUS_CLOSED` if all devices are closed, `STATUS_DEGRADED` if some devices
+        are closed or degraded (not operating at full capacity), otherwise `STATUS_OK`.
+
+    Parameters
+    ----------
+    df_device_status : pd.DataFrame
+        device statuses, see `device_day_status`
+    """
+    station_col = aggregates._station_col(df_device_status)
+    status = df_device_status.STATUS.to_numpy()
+    df_aux = pd.DataFrame({station_col: df_device_status[station_col], 'DATE': df_device_status.DATE,
+                           'N_DEVICES': 1, 'N_CLOSED': status == STATUS_CLOSED,
+                           'N_DEGRADED': status == STATUS_DEGRADED})
+
+    df_station = df_aux.groupby([station_col, 'DATE'], observed=True, sort=True).sum().astype('int32').reset_index()
+    df_station['STATUS'] = np.select([df_station.N_CLOSED == df_station.N_DEVICES,
+                                      df_station.N_CLOSED + df_station.N_DEGRADED > 0],
+                                     [STATUS_CLOSED, STATUS_DEGRADED], STATUS_OK).astype('int8')
+
+    return df_station
+
+def daily_status_counts(df_station_status):
+    """Returns daily number of closed stations and stations not operating at full capacity
+        (question VIZ5), indexed by date. Pass one column to `visualisations.plot_heatmap_calendar`.
+
+    Parameters
+    ----------
+    df_station_status : pd.DataFrame
+        station statuses, see `station_day_status`
+    """
+    status = df_station_status.STATUS.to_numpy()
+    df_aux = pd.DataFrame({'DATE': df_station_status.DATE, 'CLOSED': status == STATUS_CLOSED,
+                           'PARTIAL': status == STATUS_DEGRADED})
+
+    return df_aux.groupby('DATE', sort=True).sum().astype('int32')
@@ -0,0 +1,463 @@
+import contextlib
+import datetime
+import functools
+import gzip
+import http.server
+import io
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+from src import aggregates
+from src import feature_generation
+from src import get_data
+from src import profiling
+from src import resampling
+from src import stations
+from src import synthetic
+from src import watch
+
+BENCHMARKS_PATH = './reports/benchmarks.jsonl'
+
+def _time_call(func, *args, repeat=3, **kwargs):
+    """Runs function `repeat` times and returns best wall time in seconds and last result.
+
+    Parameters
+    ----------
+    func : callable
+        function to time
+    repeat : int
+        number of runs, best (minimal) time is reported
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), result
+
+def benchmark_reshape(df_wide, repeat=3):
+    """Compares wide-to-long reshape engines on the same wide pre-2014 table.
+        Returns a table with best wall time, rows per second and speedup against `iterrows`.
+
+        * `vectorized` - `get_data._reshape_wide_to_long`, NumPy column blocks
+        * `iterrows` - `get_data._reshape_wide_to_long_iterrows`, old row by row parser
+        * `wide_to_long` - `get_data._reshape_wide_to_long_pandas`, pandas built-in
+
+    Parameters
+    ----------
+    df_wide : pd.DataFrame
+        wide table with `COL_NAMES` columns, i.e. `pd.read_csv(raw_file, index_col=0)`
+    repeat : int
+        number of runs per engine, best (minimal) time is reported
+    """
+    engines = {'vectorized': get_data._reshape_wide_to_long,
+               'iterrows': get_data._reshape_wide_to_long_iterrows,
+               'wide_to_long': get_data._reshape_wide_to_long_pandas}
+
+    results, outputs = [], {}
+    for name, func in engines.items():
+        seconds, outputs[name] = _time_call(func, df_wide, repeat=repeat)
+        results.append({'engine': name, 'rows_in': len(df_wide),
+                        'rows_out': len(outputs[name]), 'seconds': seconds})
+
+    # vectorized engine must produce the same table (and order) as the old parser
+    counters = ['ENTRIES', 'EXITS']
+    pd.testing.assert_frame_equal(outputs['vectorized'].astype({col: float for col in counters}),
+                                  outputs['iterrows'].astype({col: float for col in counters}),
+                                  check_dtype=False)
+
+    df_results = pd.DataFrame(results).set_index('engine')
+    df_results['rows_per_second'] = df_results.rows_in / df_results.seconds
+    df_results['speedup_vs_iterrows'] = df_results.loc['iterrows', 'seconds'] / df_results.seconds
+
+    return df_results
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class _StandInHandler(_QuietHandler):
+    """Stand-in of MTA file server with switchable behaviour, `options` (shared dict):
+
+        * 'fail' - list of status codes returned (and removed) before serving files, i.e. [503, 503]
+        * 'etag' - send ETag, 'head_length' - send Content-Length on HEAD
+        * 'ranges' - answer `Range` requests with 206 (or 416 when range starts after end of file)
+        * 'gzip' - compress body regardless of `Accept-Encoding` (misconfigured server)
+        * 'requests' - log of (method, Range header) of received requests
+    """
+
+    def __init__(self, *args, options, **kwargs):
+        self.options = options
+        super().__init__(*args, **kwargs)
+
+    def _respond(self, send_body):
+        options = self.options
+        options['requests'].append((self.command, self.headers.get('Range')))
+        if options['fail']:
+            self.send_error(options['fail'].pop(0))
+            return
+        path = os.path.join(self.directory, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        headers = {'ETag': f'"{get_data._file_sha256(path)}"'} if options['etag'] else {}
+        status, range_header = 200, self.headers.get('Range')
+        if options['gzip']:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        elif range_header is not None and options['ranges']:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status, headers['Content-Range'] = 206, f'bytes {start}-{len(body) - 1}/{len(body)}'
+            body = body[start:]
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if send_body or options['head_length']:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+@contextlib.contextmanager
+def _serve_folder(path, handler=_QuietHandler, **handler_kwargs):
+    """Serves folder over http on free local port in background thread, yields base url."""
+    handler = functools.partial(handler, directory=path, **handler_kwargs)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def _run_stage(results, name, func, *args, repeat=1, **kwargs):
+    """Runs pipeline stage `repeat` times under `profiling.stage`, appends counters of the fastest run
+        to `results` and returns result of the last run.
+    """
+    runs = []
+    for _ in range(repeat):
+        with profiling.stage(f'benchmark.{name}') as stats:
+            result = func(*args, **kwargs)
+            if isinstance(result, pd.DataFrame):
+                stats.add(rows_out=len(result))
+        runs.append(dict(stats))
+
+    best = min(runs, key=lambda run: run['wall_s'])
+    results.append({'stage': name, 'seconds': best['wall_s'], 'cpu_seconds': best['cpu_s'],
+                    'peak_rss_mb': best['peak_rss_mb'], 'rows_out': best.get('rows_out')})
+
+    return result
+
+def check_stage_peak_rss(size_mb=300):
+    """Checks that outer stage reports memory peak reached before its nested stage
+        (nested stage resets peak of process, see `profiling.stage`). Outer stage allocates
+        and frees `size_mb` MB, then runs small nested stage. Returns peaks of stages (MB),
+        raises AssertionError if peak of outer stage is lost.
+
+    Parameters
+    ----------
+    size_mb : int
+        size of allocation of outer stage
+    """
+    baseline = profiling.get_peak_rss_mb()
+    with profiling.stage('check.outer') as outer:
+        block = np.ones(size_mb * 1024 ** 2 // 8)
+        del block
+        with profiling.stage('inner') as inner:
+            pass
+
+    peaks = {'baseline': baseline, 'outer': outer['peak_rss_mb'], 'inner': inner['peak_rss_mb']}
+    assert peaks['outer'] >= peaks['inner'] + 0.8 * size_mb, f'Peak of outer stage is lost: {peaks}'
+
+    return peaks
+
+def check_watch_folder(work_path='./data/interim/watch_check'):
+    """Checks that `watch.poll_once` in folder mode leaves only source files in watched folder:
+        long tables go to interim folder, state, features and cubes to their own folders.
+        Watched folder name contains 'raw' and 'txt' (i.e. 'raw_txt_drop'), they must not be rewritten
+        in output paths. Runs both storage backends, returns table of files per folder,
+        raises AssertionError on files out of place.
+
+    Parameters
+    ----------
+    work_path : str
+        folder for watched and output files (removed first)
+    """
+    shutil.rmtree(work_path, ignore_errors=True)
+    source_path = os.path.join(work_path, 'source')
+    files = synthetic.write_raw_files(source_path, n_devices=50, n_weeks=2)
+
+    results = []
+    for storage_backend in ['csv', 'parquet']:
+        backend_path = os.path.join(work_path, storage_backend)
+        watched_path = os.path.join(backend_path, 'raw_txt_drop')
+        os.makedirs(watched_path)
+        for file in files:
+            shutil.copy(file, watched_path)
+        paths = {name: os.path.join(backend_path, name)
+                 for name in ['interim', 'state', 'features', 'cubes', 'published']}
+        weeks = watch.poll_once(watched_path, state_path=paths['state'], interim_path=paths['interim'],
+                                features_path=paths['features'], cube_path=paths['cubes'],
+                                publish_path=paths['published'], storage_backend=storage_backend, settle_seconds=0.)
+
+        watched_files = sorted(os.listdir(watched_path))
+        long_paths = [get_data._long_file_path(file, storage_backend, paths['interim']) for file in files]
+        results.append({'storage_backend': storage_backend, 'weeks': len(weeks), 'watched_files': watched_files,
+                        'long_tables': sum(os.path.exists(path) for path in long_paths),
+                        'ok': (watched_files == sorted(os.path.basename(file) for file in files)
+                               and len(weeks) == len(files) and all(os.path.exists(path) for path in long_paths))})
+
+    df_results = pd.DataFrame(results).set_index('storage_backend')
+    assert df_results.ok.all(), f'Files out of place after poll:\n{df_results}'
+
+    return df_results
+
+def check_downloader(work_path='./data/interim/download_check', backoff_factor=0.01):
+    """Checks `get_data._download_one` against local stand-in server (see `_StandInHandler`):
+        skip of present files (by ETag, by size and sha256), resume of partial file, complete
+        and stale `*.part` files left by interrupted runs, compressed responses, retries of
+        5xx and 429 responses with backoff, no retries of other 4xx responses.
+        Returns table of scenarios (status, requests received by server), raises AssertionError
+        if any scenario fails.
+
+    Parameters
+    ----------
+    work_path : str
+        folder for served and downloaded files (removed first)
+    backoff_factor : float
+        see `get_data.download_raw_data`
+    """
+    shutil.rmtree(work_path, ignore_errors=True)
+    source_path, raw_path = os.path.join(work_path, 'source'), os.path.join(work_path, 'raw')
+    file = synthetic.write_raw_files(source_path, n_devices=200, n_weeks=1)[0]
+    with open(file, 'rb') as f:
+        content = f.read()
+    name = os.path.basename(file)
+    path, retries = os.path.join(raw_path, name), 2
+    os.makedirs(raw_path)
+
+    def reset():
+        for leftover in [path, path + '.part', path + '.meta.json']:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    def read_file(path):
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write_part(data):
+        with open(path + '.part', 'wb') as f:
+            f.write(data)
+
+    half = content[:len(content) // 2]
+    # name: (server options, preparation of raw folder, expected status or error code, expected requests)
+    scenarios = {
+        'fresh': ({}, reset, 'downloaded', [('HEAD', None), ('GET', None)]),
+        'skip_by_etag': ({}, None, 'skipped', [('HEAD', None)]),
+        'skip_by_sha256': ({'etag': False}, None, 'skipped', [('HEAD', None)]),
+        'resume': ({}, lambda: (reset(), write_part(half)), 'downloaded',
+                   [('HEAD', None), ('GET', f'bytes={len(half)}-')]),
+        'complete_part': ({}, lambda: (reset(), write_part(content)), 'downloaded', [('HEAD', None)]),
+        'stale_part_416': ({'head_length': False}, lambda: (reset(), write_part(content + b'x')), 'downloaded',
+                           [('HEAD', None), ('GET', f'bytes={len(content) + 1}-'), ('GET', None)]),
+        'range_ignored': ({'ranges': False}, lambda: (reset(), write_part(half)), 'downloaded',
+                          [('HEAD', None), ('GET', f'bytes={len(half)}-')]),
+        'gzip': ({'gzip': True}, reset, 'downloaded', [('HEAD', None), ('GET', None)]),
+        'gzip_skip': ({'gzip': True}, None, 'skipped', [('HEAD', None)]),
+        'retry_5xx': ({'fail': [503, 500]}, reset, 'downloaded', [('HEAD', None)] * 3 + [('GET', None)]),
+        'retry_429': ({'fail': [429]}, reset, 'downloaded', [('HEAD', None)] * 2 + [('GET', None)]),
+        'retries_exhausted': ({'fail': [503] * (retries + 1)}, reset, 503, [('HEAD', None)] * (retries + 1)),
+        'no_retry_404': ({'fail': [404]}, reset, 404, [('HEAD', None)]),
+        'no_retry_403': ({'fail': [403]}, reset, 403, [('HEAD', None)]),
+    }
+
+    results = []
+    options = {}
+    with _serve_folder(source_path, handler=_StandInHandler, options=options) as base_url, \
+            requests.Session() as session:
+        for scenario, (changes, prepare, expected, expected_requests) in scenarios.items():
+            options.update({'fail': [], 'etag': True, 'head_length': True, 'ranges': True, 'gzip': False,
+                            'requests': []}, **changes)
+            if prepare is not None:
+                prepare()
+            start = time.perf_counter()
+            try:
+                status = get_data._download_one(session, base_url + name, path, get_data._RateLimiter(None),
+                                                retries, backoff_factor, timeout=10.)
+            except requests.exceptions.RequestException as error:
+                status = getattr(error.response, 'status_code', str(error))
+            seconds = time.perf_counter() - start
+
+            is_content_ok = not isinstance(status, str) or (not os.path.exists(path + '.part')
+                                                            and read_file(path) == content)
+            results.append({'scenario': scenario, 'expected': expected, 'status': status,
+                            'requests': len(options['requests']), 'seconds': seconds,
+                            'ok': status == expected and options['requests'] == expected_requests and is_content_ok})
+
+    df_results = pd.DataFrame(results).set_index('scenario')
+    # backoff between retries: `backoff_factor * (1 + 2)` seconds before the third request
+    df_results.loc['retry_5xx', 'ok'] &= df_results.loc['retry_5xx', 'seconds'] >= 3 * backoff_factor
+    failed = df_results.index[~df_results.ok.astype(bool)].tolist()
+    assert not failed, f'Download scenarios failed: {failed}\n{df_results}'
+
+    return df_results
+
+def _download(links, raw_path):
+    # start from empty folder, otherwise files are skipped as already downloaded
+    shutil.rmtree(raw_path, ignore_errors=True)
+    return get_data.download_raw_data(links, download=True, raw_path=raw_path, rate_limit=None)
+
+def _plot(radii):
+    """Renders hourly clock chart to png in memory (no display, no pyplot state)."""
+    from matplotlib.figure import Figure
+    from src import visualisations
+
+    fig = Figure(figsize=(6, 6))
+    visualisations.plot_clock_metric_hourly(radii, 'steelblue', 'Benchmark', fig.add_subplot(projection='polar'))
+    fig.savefig(io.BytesIO(), format='png', dpi=100)
+
+def benchmark_pipeline(work_path='./data/interim/benchmark', n_devices=500, n_weeks=4, layout='wide',
+                       repeat=1, seed=0, **anomalies):
+    """Runs every stage of the pipeline on synthetic data (see `synthetic.write_raw_files`) and
+        returns table of stages with best wall time, CPU time, peak RSS and rows out.
+        Stages: download (from local http server), reshape, concat, load, datetime features,
+        diff features, station joins, aggregations (cubes, hourly redistribution) and plotting.
+        Save results with `save_benchmark_results` to compare them between commits.
+
+    Parameters
+    ----------
+    work_path : str
+        folder for synthetic and intermediate files, it is removed and created again
+    n_devices : int
+        number of synthetic devices
+    n_weeks : int
+        number of weekly files
+    layout : str
+        layout of raw files, 'wide', 'long' or 'auto', see `synthetic.write_raw_files`
+    repeat : int
+        number of runs per stage, best (minimal) time is reported
+    seed : int
+        seed of data generator
+    anomalies : dict
+        anomaly rates of `synthetic.make_audits`, i.e. reset_rate=0.05
+    """
+    shutil.rmtree(work_path, ignore_errors=True)
+    source_path, raw_path = os.path.join(work_path, 'source'), os.path.join(work_path, 'raw')
+    # long files are saved next to raw folder, see `get_data._interim_path`
+    os.makedirs(os.path.join(work_path, 'interim'))
+    files = synthetic.write_raw_files(source_path, layout=layout, n_devices=n_devices, n_weeks=n_weeks,
+                                      seed=seed, **anomalies)
+    results = []
+
+    with _serve_folder(source_path) as base_url:
+        links = [base_url + os.path.basename(file) for file in files]
+        files = _run_stage(results, 'download', _download, links, raw_path, repeat=repeat)
+
+    long_files = _run_stage(results, 'reshape', get_data.reorganize_raw_files, files, repeat=repeat)
+    combined_path = os.path.join(work_path, 'combined.csv')
+    _run_stage(results, 'concat', get_data._concat_files, long_files, combined_path, repeat=repeat)
+    df = _run_stage(results, 'load', get_data.load_combined_table, combined_path, repeat=repeat)
+
+    df = _run_stage(results, 'datetime_features', feature_generation.calc_features_from_datetime, df, repeat=repeat)
+    df = _run_stage(results, 'diff_features', feature_generation.calc_features_from_cumulative_records, df,
+                    repeat=repeat)
+    registry = stations.StationRegistry(os.path.join(source_path, 'stations.csv'),
+                                        os.path.join(source_path, 'geocoded.csv'))
+    df = _run_stage(results, 'joins', lambda df: registry.attach(df.copy()), df, repeat=repeat)
+
+    _run_stage(results, 'aggregations.cubes', aggregates.build_cubes, df, repeat=repeat)
+    grid, devices, hours = _run_stage(results, 'aggregations.hourly', resampling.redistribute_hourly, df,
+                                      repeat=repeat)
+    _run_stage(results, 'plotting', _plot, resampling.hourly_radii(grid, devices, hours), repeat=repeat)
+
+    df_results = pd.DataFrame(results).set_index('stage')
+    df_results.attrs['params'] = {'n_devices': n_devices, 'n_weeks': n_weeks, 'layout': layout,
+                                  'repeat': repeat, 'seed': seed, **anomalies}
+
+    return df_results
+
+def _git_commit():
+    """Returns short hash of current git commit (with '+dirty' for uncommitted changes) or None."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('+dirty' if dirty else '')
+
+def save_benchmark_results(df_results, path=BENCHMARKS_PATH, label=None):
+    """Appends benchmark results (see `benchmark_pipeline`) to json lines file,
+        with git commit, time, parameters of run and optional label.
+
+    Parameters
+    ----------
+    df_results : pd.DataFrame
+        results of `benchmark_pipeline`
+    path : str
+        path to json lines file
+    label : str or None
+        name of run, i.e. 'before refactoring'
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    record = {'commit': _git_commit(), 'label': label,
+              'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'params': df_results.attrs.get('params', {}),
+              'results': df_results.reset_index().to_dict(orient='records')}
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+def compare_benchmark_results(path=BENCHMARKS_PATH, metric='seconds'):
+    """Loads saved benchmark runs and returns table stage x run (commit, label) of `metric`,
+        with ratio of the last run to the previous one (> 1 - regression for time and memory).
+
+    Parameters
+    ----------
+    path : str
+        path to json lines file, see `save_benchmark_results`
+    metric : str
+        'seconds', 'cpu_seconds', 'peak_rss_mb' or 'rows_out'
+    """
+    with open(path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+
+    columns = {}
+    for indx, run in enumerate(runs):
+        name = f"{indx}: {run['commit']}" + (f" ({run['label']})" if run['label'] else '')
+        columns[name] = {result['stage']: result[metric] for result in run['results']}
+
+    df = pd.DataFrame(columns)
+    if df.shape[1] > 1:
+        df['last_vs_previous'] = df.iloc[:, -1] / df.iloc[:, -2]
+
+    return df
@@ -0,0 +1,184 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import types
+
+import numpy as np
+import pandas as pd
+
+CACHE_PATH = './data/interim/cache'
+# cached results are off until `enable_cache` is called
+_config = {'enabled': False, 'path': CACHE_PATH, 'max_bytes': 2 * 1024 ** 3}
+
+def enable_cache(path=CACHE_PATH, max_bytes=2 * 1024 ** 3):
+    """Turns on disk cache of results of functions decorated with `cached`.
+
+    Parameters
+    ----------
+    path : str
+        folder of cache
+    max_bytes : int
+        max total size of cache, least recently used results are removed above it
+    """
+    _config.update(enabled=True, path=path, max_bytes=max_bytes)
+
+def disable_cache():
+    _config['enabled'] = False
+
+@functools.lru_cache(maxsize=1024)
+def _file_hash(path, size, mtime_ns, block_size=1 << 20):
+    """Returns sha256 of file content, computed once per file version (path, size, modification time)."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+def _path_hash(path):
+    """Returns hash of file content, or of names and contents of all files of folder."""
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return _file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    sha256 = hashlib.sha256()
+    for folder, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            file = os.path.join(folder, name)
+            sha256.update(os.path.relpath(file, path).encode())
+            sha256.update(_path_hash(file).encode())
+
+    return sha256.hexdigest()
+
+def _update_hash(sha256, value):
+    """Adds value to hash: tables and arrays by content, existing paths by content of files,
+        containers recursively, other values by repr.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        columns = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        sha256.update(repr((type(value).__name__, columns, [str(dtype) for dtype in np.atleast_1d(value.dtypes)])
+                           ).encode())
+        sha256.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        sha256.update(repr((value.dtype.str, value.shape)).encode())
+        sha256.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, str) and os.path.exists(value):
+        sha256.update(f'path:{_path_hash(value)}'.encode())
+    elif isinstance(value, (list, tuple)):
+        sha256.update(f'{type(value).__name__}:{len(value)}'.encode())
+        for item in value:
+            _update_hash(sha256, item)
+    elif isinstance(value, dict):
+        for key in sorted(value, key=repr):
+            _update_hash(sha256, key)
+            _update_hash(sha256, value[key])
+    else:
+        sha256.update(repr(value).encode())
+
+def _entry_path(func_name, key):
+    return os.path.join(_config['path'], f'{func_name}-{key}.pkl')
+
+def _evict(max_bytes):
+    """Removes least recently used results (by modification time, touched on every hit) above `max_bytes`."""
+    df_info = cache_info()
+    excess = df_info['size'].sum() - max_bytes
+    df_info = df_info.sort_values('last_used')
+    for path, size in zip(df_info.path, df_info['size']):
+        if excess <= 0:
+            break
+        os.remove(path)
+        excess -= size
+
+def _dependency_sources(module):
+    """Returns source code of module and of all modules of its package it depends on (imported modules,
+        functions and classes, recursively), so changes of i.e. `schema` invalidate results of `feature_generation`.
+    """
+    package = module.__name__.split('.')[0]
+    sources, stack = {}, [module]
+    while stack:
+        module = stack.pop()
+        if module.__name__ in sources:
+            continue
+        sources[module.__name__] = inspect.getsource(module)
+        for value in vars(module).values():
+            dependency = value if isinstance(value, types.ModuleType) else inspect.getmodule(value)
+            if dependency is not None and dependency.__name__.split('.')[0] == package:
+                stack.append(dependency)
+
+    return ''.join(sources[name] for name in sorted(sources))
+
+def cached(version=None):
+    """Decorator, memoizes function results on disk when cache is on (see `enable_cache`).
+        Key is hash of function name, version (if not given - source code of module of function
+        and of modules of the same package it depends on, see `_dependency_sources`, so changes
+        of helper functions, schema or station registry invalidate results too) and arguments:
+        tables and arrays by content, paths of existing files and folders by content of files.
+        Results are saved with pickle (exact dtypes, fast binary format).
+        Note: on cache hit function does not run, so arguments are not changed in place.
+
+    Parameters
+    ----------
+    version : str or None
+        version of function, change it to invalidate old results; if None - source code of modules is used
+    """
+    def decorator(func):
+        # dependencies are resolved on first call, modules of package may be still importing at decoration
+        func_version = [version]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _config['enabled']:
+                return func(*args, **kwargs)
+
+            if func_version[0] is None:
+                func_version[0] = _dependency_sources(inspect.getmodule(func))
+            sha256 = hashlib.sha256(f'{func.__qualname__}:{func_version[0]}'.encode())
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            _update_hash(sha256, dict(bound.arguments))
+            path = _entry_path(func.__name__, sha256.hexdigest()[:32])
+
+            if os.path.exists(path):
+                os.utime(path)
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+
+            result = func(*args, **kwargs)
+            os.makedirs(_config['path'], exist_ok=True)
+            with open(path + '.part', 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.part', path)
+            _evict(_config['max_bytes'])
+
+            return result
+        return wrapper
+    return decorator
+
+def cache_info():
+    """Returns table of cached results: function, path, size (bytes), last use time."""
+    folder = _config['path']
+    names = sorted(name for name in os.listdir(folder) if name.endswith('.pkl')) if os.path.isdir(folder) else []
+    paths = [os.path.join(folder, name) for name in names]
+
+    return pd.DataFrame({'func': [name.rsplit('-', 1)[0] for name in names], 'path': paths,
+                         'size': [os.path.getsize(path) for path in paths],
+                         'last_used': pd.to_datetime([os.path.getmtime(path) for path in paths], unit='s')})
+
+def invalidate(func=None):
+    """Removes cached results of function (or of all functions). Returns number of removed results.
+
+    Parameters
+    ----------
+    func : callable, str or None
+        function or its name, None - clears whole cache
+    """
+    df_info = cache_info()
+    if func is not None:
+        df_info = df_info[df_info.func == getattr(func, '__name__', func)]
+    for path in df_info.path:
+        os.remove(path)
+
+    return len(df_info)
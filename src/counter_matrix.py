@@ -0,0 +1,226 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import tqdm
+
+from src import feature_generation
+from src import get_data
+
+MATRIX_PATH = './data/processed/matrix'
+MATRIX_ARRAYS = ['entries', 'exits', 'times']
+# padding of time slots after the last audit of device
+EMPTY_TIME = np.iinfo('int64').min
+
+def _read_audits(file, storage_backend):
+    """Reads long file of `reorganize_raw_files` with device columns, counters and AUDIT_DATE_TIME."""
+    df = get_data._read_long_file(file, storage_backend)
+    df = feature_generation.calc_features_from_datetime(df, from_date=False, from_time=False)
+
+    return df[feature_generation.DEVICE_COLS + ['AUDIT_DATE_TIME', 'ENTRIES', 'EXITS']]
+
+def build_counter_matrix(files, path=MATRIX_PATH, storage_backend='csv', registry=None):
+    """Builds device x audit slot arrays of ENTRIES, EXITS and audit times (int64 ns) from long files
+        of `reorganize_raw_files` and saves them as .npy files (opened as memory maps by `CounterMatrix`),
+        with devices table (row of arrays per device, station code) and metadata.
+        Audits of each device are sorted by time and packed to the left, slots after
+        the last audit of device are padding (see `CounterMatrix.valid`).
+
+        Two passes over files, one file in memory at a time: the first counts audits of devices
+        (size of arrays), the second fills arrays. Files must be given in order of weeks,
+        audits already seen in previous file (overlapping weeks) are skipped.
+
+    Parameters
+    ----------
+    files : list
+        long files (csv) or week folders (parquet) of `reorganize_raw_files`, in order of weeks
+    path : str
+        folder where to save arrays
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    registry : stations.StationRegistry or None
+        station registry, stations are station names if given, otherwise UNIT
+    """
+    counts = None
+    for file in tqdm.tqdm(files, desc='Counting audits'):
+        df = get_data._read_long_file(file, storage_backend)
+        file_counts = df.groupby(feature_generation.DEVICE_COLS, observed=True).size()
+        counts = file_counts if counts is None else counts.add(file_counts, fill_value=0)
+
+    devices = counts.sort_index().index
+    n_devices, n_slots = len(devices), int(counts.max())
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {name: np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype='int64',
+                                              shape=(n_devices, n_slots)) for name in MATRIX_ARRAYS}
+    arrays['times'][:] = EMPTY_TIME
+    n_audits = np.zeros(n_devices, dtype='int64')
+    last_time = np.full(n_devices, EMPTY_TIME)
+
+    for file in tqdm.tqdm(files, desc='Filling counter matrix'):
+        df = _read_audits(file, storage_backend)
+        rows = devices.get_indexer(pd.MultiIndex.from_frame(df[feature_generation.DEVICE_COLS].astype(str)))
+        times = df.AUDIT_DATE_TIME.values.view('int64')
+
+        order = np.lexsort([times, rows])
+        rows, times = rows[order], times[order]
+        keep = times > last_time[rows]
+        order, rows, times = order[keep], rows[keep], times[keep]
+
+        # position of audit within device in this file, appended after audits of previous files
+        is_first = np.ones(len(rows), dtype=bool)
+        is_first[1:] = rows[1:] != rows[:-1]
+        starts = np.flatnonzero(is_first)
+        position = np.arange(len(rows)) - np.repeat(starts, np.diff(np.append(starts, len(rows))))
+        slots = n_audits[rows] + position
+
+        arrays['times'][rows, slots] = times
+        arrays['entries'][rows, slots] = df.ENTRIES.values[order]
+        arrays['exits'][rows, slots] = df.EXITS.values[order]
+        np.add.at(n_audits, rows, 1)
+        last_time[rows] = times
+
+    for array in arrays.values():
+        array.flush()
+
+    df_devices = devices.to_frame(index=False)
+    if registry is not None:
+        df_devices = registry.attach(df_devices, columns=['Station'])
+    station_col = 'Station' if 'Station' in df_devices.columns else 'UNIT'
+    df_devices['STATION_CODE'] = pd.factorize(df_devices[station_col].astype(str), sort=True)[0]
+    df_devices['N_AUDITS'] = n_audits
+    df_devices.astype({col: str for col in df_devices.columns if df_devices[col].dtype == object or
+                       isinstance(df_devices[col].dtype, pd.CategoricalDtype)}
+                      ).to_csv(os.path.join(path, 'devices.csv'), index=False)
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'n_devices': n_devices, 'n_slots': n_slots, 'station_col': station_col,
+                   'files': [os.path.basename(os.path.normpath(file)) for file in files]}, f)
+
+    return path
+
+class CounterMatrix:
+    """Device x audit slot arrays of ENTRIES, EXITS and audit times (int64 ns), see `build_counter_matrix`.
+        Arrays are read-only memory maps: opening is instant, pages are read on access and
+        shared by all processes opening the same folder (operating system page cache).
+        Row of arrays is device, see `devices` table (device columns, station, STATION_CODE, N_AUDITS).
+
+    Parameters
+    ----------
+    path : str
+        folder of arrays
+    """
+
+    def __init__(self, path=MATRIX_PATH):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for name in MATRIX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        self.devices = pd.read_csv(os.path.join(path, 'devices.csv'), dtype=str,
+                                   ).astype({'STATION_CODE': 'int64', 'N_AUDITS': 'int64'})
+        self.station_col = self.meta['station_col']
+        self.stations = self.devices.drop_duplicates('STATION_CODE').sort_values('STATION_CODE')[self.station_col].values
+
+    @property
+    def shape(self):
+        return self.entries.shape
+
+    def valid(self, rows=slice(None)):
+        """Boolean mask of slots holding audits (not padding).
+
+        Parameters
+        ----------
+        rows : slice or np.ndarray
+            rows (devices) to select
+        """
+        return self.times[rows] != EMPTY_TIME
+
+    def rows(self, station=None, unit=None):
+        """Returns rows (devices) of station or unit.
+
+        Parameters
+        ----------
+        station : str or None
+            station, see `station_col`
+        unit : str or None
+            UNIT
+        """
+        mask = np.ones(len(self.devices), dtype=bool)
+        if station is not None:
+            mask &= (self.devices[self.station_col] == station).to_numpy()
+        if unit is not None:
+            mask &= (self.devices['UNIT'] == unit).to_numpy()
+
+        return np.flatnonzero(mask)
+
+    def time_window(self, start=None, end=None, rows=slice(None)):
+        """Boolean mask of audits in time window [start, end).
+
+        Parameters
+        ----------
+        start : str or None
+            start of window, i.e. '2013-02-01'
+        end : str or None
+            end of window (excluded)
+        rows : slice or np.ndarray
+            rows (devices) to select
+        """
+        times = self.times[rows]
+        mask = times != EMPTY_TIME
+        if start is not None:
+            mask &= times >= pd.Timestamp(start).value
+        if end is not None:
+            mask &= times < pd.Timestamp(end).value
+
+        return mask
+
+    def diffs(self, counter='entries', max_diff=10000, rows=slice(None)):
+        """Relative values of counter between consequential audits of each device (float32, NaN for
+            first audits, padding and outliers) and flags, see `feature_generation._diff_counter`.
+
+        Parameters
+        ----------
+        counter : str
+            'entries' or 'exits'
+        max_diff : int
+            max plausible number of entries (exits) between two audits
+        rows : slice or np.ndarray
+            rows (devices) to select
+        """
+        values = getattr(self, counter)[rows]
+        valid = self.valid(rows)
+        previous = np.empty_like(values)
+        previous[:, 1:], previous[:, 0] = values[:, :-1], values[:, 0]
+        has_previous = valid.copy()
+        has_previous[:, 0] = False
+
+        result, flags = feature_generation._diff_counter(values.ravel(), previous.ravel(), has_previous.ravel(),
+                                                         max_diff)
+        result[~valid.ravel()] = np.nan
+
+        return result.reshape(values.shape), flags.reshape(values.shape)
+
+    def station_daily(self, values, rows=slice(None)):
+        """Sums device x slot values (i.e. `diffs`) to station x day table (audit belongs to day of audit).
+
+        Parameters
+        ----------
+        values : np.ndarray
+            device x slot values of selected rows, NaN are skipped
+        rows : slice or np.ndarray
+            rows (devices) of values
+        """
+        times = self.times[rows]
+        mask = (times != EMPTY_TIME) & ~np.isnan(values)
+        days = times[mask] // (24 * 3600 * 10 ** 9)
+        first_day = days.min() if len(days) else 0
+        n_days = int(days.max() - first_day + 1) if len(days) else 0
+
+        station_codes = self.devices.STATION_CODE.to_numpy()[rows]
+        codes = np.broadcast_to(station_codes[:, None], times.shape)[mask]
+        grid = np.bincount(codes * n_days + (days - first_day), weights=values[mask],
+                           minlength=len(self.stations) * n_days).reshape(len(self.stations), n_days)
+        dates = pd.DatetimeIndex((first_day + np.arange(n_days)) * 24 * 3600 * 10 ** 9)
+
+        return pd.DataFrame(grid, index=pd.Index(self.stations, name=self.station_col), columns=dates)
@@ -1,8 +1,19 @@
 import pandas as pd
 import numpy as np
 
+from src import cache
+from src import profiling
+from src import schema
+from src import stations
+
+@profiling.instrument('features.stations')
+@cache.cached()
 def add_stations(df, path_to_stations_dataset):
     """Appends station dataset.
+        Dataset is read once and cached, columns are attached by lookup on
+        integer codes of (C/A, UNIT), see `stations.StationRegistry`
+        Returns new table, input table is not changed (shallow copy, existing columns are not copied),
+        attached columns already have schema dtypes (categories).
 
     Parameters
     ----------
@@ -11,19 +22,23 @@ def add_stations(df, path_to_stations_dataset):
     path_to_stations_coords : str
         Relative or absolute path to file with extra features
     """
-    df_stations = pd.read_csv(path_to_stations_dataset)
-    df = pd.merge(df, df_stations, left_on=['C/A', 'UNIT'], right_on=['Booth', 'Remote'], how='left')
-    df = df.drop(columns = ['Remote', 'Booth'])
+    registry = stations.StationRegistry(path_to_stations_dataset=path_to_stations_dataset)
 
-    return df
+    return registry.attach(df.copy(deep=False))
 
+@profiling.instrument('features.coordinates')
+@cache.cached()
 def add_coordinates(df, path_to_stations_coords):
     """Appends geocoded station coordinates to main table.
+        Dataset is read once and cached, columns are attached by lookup on
+        integer codes of (C/A, UNIT), see `stations.StationRegistry`
 
         # External dataset credits to Chris Whong - nycturnstiles,
             https://github.com/chriswhong/nycturnstiles/blob/master/geocoded.csv
             ' cos I was to lazy to geocode from scratch.
 
+        Returns new table, input table is not changed (shallow copy, existing columns are not copied).
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -32,17 +47,70 @@ def add_coordinates(df, path_to_stations_coords):
         Relative or absolute path to file with extra features
     """
     # stations_coords columns={0:'UNIT', 1:'C/A', 2:'Station', 3:'Line Name', 4:'Division', 5:'Lat', 6:'Lon'}
-    df_stations_coords = pd.read_csv(path_to_stations_coords, header=None)
-    df = pd.merge(df, df_stations_coords, left_on=['C/A', 'UNIT'], right_on=[1, 0], how='left')
-    df = df.drop(columns=[0, 1, 2, 3, 4]).rename(columns={5:'Lat', 6:'Lon'})
+    registry = stations.StationRegistry(path_to_stations_coords=path_to_stations_coords)
 
-    return df
+    return registry.attach(df.copy(deep=False), columns=stations.COORDS_COLS)
+
+def _factorize(series):
+    """Returns integer codes of series values and array of unique values.
+        Categorical series are not re-factorized, their codes and categories are used.
+
+    Parameters
+    ----------
+    series : pd.Series
+        series to factorize
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+
+    return pd.factorize(series)
+
+def _take(values, codes):
+    """Maps codes back to values (broadcasts features of unique values to all rows),
+        code -1 (empty value) is mapped to empty value.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        features of unique values
+    codes : np.ndarray
+        codes of rows, see `_factorize`
+    """
+    values = np.asarray(values)
+    empty = np.array([np.datetime64('NaT') if values.dtype.kind in 'mM' else
+                      False if values.dtype.kind == 'b' else -1], dtype=values.dtype)
+
+    return np.concatenate([values, empty])[codes]
+
+def _categorical(codes, uniques):
+    """Builds categorical column from codes and unique values of `_factorize` without hashing rows again,
+        categories are sorted (the same column as `astype('category')`).
+
+    Parameters
+    ----------
+    codes : np.ndarray
+        codes of rows, see `_factorize`
+    uniques : np.ndarray or pd.Index
+        unique values, see `_factorize`
+    """
+    order = pd.Index(uniques).argsort()
+    ranks = np.empty(len(order) + 1, dtype='int64')
+    ranks[order], ranks[-1] = np.arange(len(order)), -1
 
-def calc_features_from_datetime(df, from_date=True, from_time=True):
+    return pd.Categorical.from_codes(ranks[codes], categories=pd.Index(uniques)[order])
+
+@profiling.instrument('features.datetime')
+@cache.cached()
+def calc_features_from_datetime(df, from_date=True, from_time=True, date_format='%m-%d-%y', time_format='%H:%M:%S'):
     """"Extracts basic date and time features from date & time type column(s).
-            Extracts: year, month number, day of week number from DATE field
+            Extracts: year, month number, ISO week number, day of week number,
+                weekend and (US federal) holiday flags from DATE field
             Extracts: hour, minute from TIME field
 
+        There are only few thousands distinct dates and times, so each distinct value is parsed
+            (with explicit format) and its features are calculated once, then they are broadcast
+            to all rows by integer codes. AUDIT_DATE_TIME is date plus time of day.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -51,45 +119,229 @@ def calc_features_from_datetime(df, from_date=True, from_time=True):
         Yes/No generate features from date column
     from_time : bool
         Yes/No generate features from time column
+    date_format : str or None
+        format of DATE values, 'MM-DD-YY' by default (see `get_data.parse_raw_file`), None - infer
+    time_format : str or None
+        format of TIME values, None - infer
     """
+    from pandas.tseries.holiday import USFederalHolidayCalendar
 
-    df['AUDIT_DATE_TIME'] = pd.to_datetime(df.DATE + " " + df.TIME)
-    #df['DATE'] = df.DATE.astype('datetime64[ns]')
+    date_codes, dates = _factorize(df.DATE)
+    time_codes, times = _factorize(df.TIME)
+    # schema dtype (category) of DATE and TIME is built from codes, rows are hashed once
+    for col, codes, uniques in [('DATE', date_codes, dates), ('TIME', time_codes, times)]:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = _categorical(codes, uniques)
+    dates = pd.DatetimeIndex(pd.to_datetime(pd.Index(dates).astype(str), format=date_format))
+    times = pd.to_datetime(pd.Index(times).astype(str), format=time_format)
+    times = pd.TimedeltaIndex(times - times.normalize())
+
+    df['AUDIT_DATE_TIME'] = _take(dates.values, date_codes) + _take(times.values, time_codes)
     if from_date:
-        df['AUDIT_YEAR'] = df.DATE.astype('datetime64[ns]').dt.year
-        df['AUDIT_MONTH'] = df.DATE.astype('datetime64[ns]').dt.month
-        df['AUDIT_WEEK'] = df.DATE.astype('datetime64[ns]').dt.week
-        df['AUDIT_DOW'] = df.DATE.astype('datetime64[ns]').dt.weekday
-        #df['IS_WEEKEND_FLAG'] = df['AUDIT_DOW'].isin([5, 6]) # count holidays here?
+        # empty table has no date range
+        holidays = USFederalHolidayCalendar().holidays(dates.min(), dates.max()) if len(dates) else dates
+        df['AUDIT_YEAR'] = _take(dates.year.values.astype('int16'), date_codes)
+        df['AUDIT_MONTH'] = _take(dates.month.values.astype('int8'), date_codes)
+        df['AUDIT_WEEK'] = _take(dates.isocalendar().week.values.astype('int8'), date_codes)
+        df['AUDIT_DOW'] = _take(dates.weekday.values.astype('int8'), date_codes)
+        df['IS_WEEKEND'] = _take(dates.weekday.values >= 5, date_codes)
+        df['IS_HOLIDAY'] = _take(dates.isin(holidays), date_codes)
     if from_time:
-        df['AUDIT_HOUR'] = df.TIME.astype('datetime64[ns]').dt.hour
-        df['AUDIT_MINUTE'] = df.TIME.astype('datetime64[ns]').dt.minute
+        components = times.components
+        df['AUDIT_HOUR'] = _take(components.hours.values.astype('int8'), time_codes)
+        df['AUDIT_MINUTE'] = _take(components.minutes.values.astype('int8'), time_codes)
 
-    return df
+    return schema.apply_schema(df)
+
+DEVICE_COLS = ['C/A', 'UNIT', 'SCP']
+# codes of `ENTRIES_FLAG` / `EXITS_FLAG`
+COUNTER_FIRST, COUNTER_OK, COUNTER_REVERSED, COUNTER_RESET, COUNTER_ROLLOVER, COUNTER_OUTLIER = -1, 0, 1, 2, 3, 4
+# narrowest counter register which wraps, drops of narrower counters to small values are resets
+ROLLOVER_MIN_DIGITS = 7
+
+def _sort_by_device_and_time(df):
+    """Sorts table by device (C/A, UNIT, SCP) and audit time (one lexsort on integer codes).
+        Returns sorted table (new frame owning its data, `take` does not mark it as a copy of `df`,
+        so columns are added without another copy) and boolean array marking first audit of each device.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Dataframe containing device columns and AUDIT_DATE_TIME
+    """
+    codes = [_factorize(df[col])[0] for col in DEVICE_COLS]
+    times = df.AUDIT_DATE_TIME.values.view('int64')
+    # last key is the primary one
+    order = np.lexsort([times] + codes[::-1])
+
+    codes = [code[order] for code in codes]
+    is_first = np.ones(len(order), dtype=bool)
+    if len(order):
+        is_first[1:] = np.logical_or.reduce([code[1:] != code[:-1] for code in codes])
+
+    return df.take(order), is_first
+
+def _previous_values(values, is_first, seed_values=None):
+    """Returns value of previous audit of the same device and mask of rows which have it.
+        First audits of devices take previous value from `seed_values` (i.e. last audit
+        of previous week) where it is known.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values sorted by device and time
+    is_first : np.ndarray
+        boolean array marking first audit of each device
+    seed_values : np.ndarray or None
+        previous values for first audits (same length as `values`, used where `is_first`),
+        empty (NaN / NaT) where unknown
+    """
+    previous = np.empty_like(values)
+    previous[1:] = values[:-1]
+    has_previous = ~is_first
+    if seed_values is not None:
+        previous[is_first] = seed_values[is_first]
+        has_previous = has_previous | (is_first & ~pd.isna(seed_values))
+    if len(values):
+        previous[~has_previous] = values[~has_previous]
+
+    return previous, has_previous
+
+def _diff_counter(values, previous, has_previous, max_diff=10000):
+    """Calculates relative values of cumulative counter between consequential audits of the same device.
+        Returns relative values (float, empty for first audits and outliers) and flags:
+            * COUNTER_OK - 0 <= diff < max_diff
+            * COUNTER_ROLLOVER - counter of at least `ROLLOVER_MIN_DIGITS` digits wrapped at 10 ** n_digits,
+                wrapped difference is used
+            * COUNTER_RESET - counter was reset to (near) zero: current value is below max_diff and
+                below the drop (counter lost more than it kept), current value is used
+            * COUNTER_REVERSED - counter runs backwards (-max_diff < diff < 0), absolute value is used
+            * COUNTER_OUTLIER - none of above, empty value
+            * COUNTER_FIRST - first audit of device, empty value
+        Checks are applied in this order, i.e. drop 5000 -> 3 is a reset (3), not reversed counter (4997),
+            drop 95000 -> 100 is a reset (100), not a wrap of 5-digits counter (5100).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        cumulative counter values sorted by device and time
+    previous : np.ndarray
+        counter values of previous audits, see `_previous_values`
+    has_previous : np.ndarray
+        boolean array marking audits with known previous audit
+    max_diff : int
+        max plausible number of entries (exits) between two audits
+    """
+    values = values.astype('int64')
+    previous = previous.astype('int64')
+    diff = values - previous
+
+    # wrap of counter, i.e. 9_999_990 -> 15 for 7-digits counter
+    n_digits = np.floor(np.log10(np.maximum(previous, 1))).astype('int64') + 1
+    rollover = values + 10 ** n_digits - previous
+
+    is_ok = (diff >= 0) & (diff < max_diff)
+    is_rollover = ~is_ok & (n_digits >= ROLLOVER_MIN_DIGITS) & (rollover >= 0) & (rollover < max_diff)
+    is_reset = ~is_ok & ~is_rollover & (values >= 0) & (values < max_diff) & (values < -diff)
+    is_reversed = ~is_ok & ~is_rollover & ~is_reset & (diff < 0) & (diff > -max_diff)
+
+    flags = np.select([~has_previous, is_ok, is_reversed, is_rollover, is_reset],
+                      [COUNTER_FIRST, COUNTER_OK, COUNTER_REVERSED, COUNTER_ROLLOVER, COUNTER_RESET],
+                      COUNTER_OUTLIER).astype('int8')
+    result = np.select([is_ok, is_reversed, is_rollover, is_reset],
+                       [diff, -diff, rollover, values], np.nan).astype('float32')
+    result[~has_previous] = np.nan
+
+    return result, flags
+
+def _diff_time(times, previous, has_previous):
+    """Calculates time difference between consequential audits, empty for first audits of devices.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        audit times (datetime64) sorted by device and time
+    previous : np.ndarray
+        times of previous audits, see `_previous_values`
+    has_previous : np.ndarray
+        boolean array marking audits with known previous audit
+    """
+    time_diff = times - previous
+    time_diff[~has_previous] = np.timedelta64('NaT')
+
+    return time_diff
+
+def last_audits(df):
+    """Returns last audit of each device (device columns, AUDIT_DATE_TIME, ENTRIES, EXITS),
+        used as `seed` of `calc_features_from_cumulative_records` for the next batch of data.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Dataframe containing device columns, AUDIT_DATE_TIME and counters
+    """
+    df = df[DEVICE_COLS + ['AUDIT_DATE_TIME', 'ENTRIES', 'EXITS']]
+
+    return df.sort_values('AUDIT_DATE_TIME').drop_duplicates(DEVICE_COLS, keep='last').reset_index(drop=True)
+
+def _seed_values(df, is_first, seed):
+    """Returns arrays of seed values (AUDIT_DATE_TIME, ENTRIES, EXITS) aligned with sorted table,
+        filled for first audits of devices found in seed only. Only first audits are joined.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table sorted by device and time
+    is_first : np.ndarray
+        boolean array marking first audit of each device
+    seed : pd.DataFrame
+        last audits of previous batch, see `last_audits`
+    """
+    first_rows = df.loc[is_first, DEVICE_COLS].astype(str)
+    seed = seed.astype({col: str for col in DEVICE_COLS})
+    first_rows = first_rows.merge(seed, on=DEVICE_COLS, how='left')
+    # audits of previous batch could not be later than audits of current one
+    is_earlier = first_rows.AUDIT_DATE_TIME.values < df.AUDIT_DATE_TIME.values[is_first]
+
+    seed_values = {}
+    for col, empty in [('AUDIT_DATE_TIME', np.datetime64('NaT')), ('ENTRIES', np.nan), ('EXITS', np.nan)]:
+        values = np.full(len(df), empty, dtype='datetime64[ns]' if col == 'AUDIT_DATE_TIME' else 'float64')
+        values[is_first] = np.where(is_earlier, first_rows[col].values, empty)
+        seed_values[col] = values
+
+    return seed_values
 
 def _cacl_time_difference_between_audits(df):
-    """Calculates time difference between consequential audits.
+    """Calculates time difference between consequential audits of the same device.
         For instance, between audits at 12:00:00 and at 12:01:59, or at 14:00:00 and 15:00:00
+        Table is sorted by device and time, first audit of each device gets empty value.
 
     Parameters
     ----------
     df : pd.DataFrame
         Dataframe containing source columns and which to add generated features
     """
-    TIME_DIFF = df.AUDIT_DATE_TIME - df.AUDIT_DATE_TIME.shift(1)
-    # TIME_DIFF > 1 day -= null
-    # z['Time_diff'] = df.groupby(['C/A','UNIT','SCP']).AUDIT_DATE_TIME.diff(1).fillna(np.timedelta64(0, 'D'))
-    # z['Time_diff'] = z.Time_diff.where((z.Time_diff < np.timedelta64(1, 'D')), np.timedelta64(0, 'D'))
-    df['TIME_DIFF'] = TIME_DIFF
+    df, is_first = _sort_by_device_and_time(df)
+    times = df.AUDIT_DATE_TIME.values
+    df['TIME_DIFF'] = _diff_time(times, *_previous_values(times, is_first))
 
     return df
 
-def calc_features_from_cumulative_records(df):
+@profiling.instrument('features.cumulative')
+@cache.cached()
+def calc_features_from_cumulative_records(df, max_diff=10000, seed=None):
     """Calculates relative `EXIT` and `ENTRY` values between two consequential audits.
             (!) Note these aren’t counts per interval, but equivalent to an “odometer”
             reading for each device
         Also, cleanes 'outliers' (negative or too big relative values)
         Also, calculates `busy-ness` metric defined as sum of entries and exits
+        Also, calculates time difference between audits (TIME_DIFF)
+
+        One pass for all features: table is sorted once by device and audit time
+            (requires AUDIT_DATE_TIME, see `calc_features_from_datetime`), device boundaries are found once,
+            all differences are taken on NumPy arrays. Returned table is sorted, index is kept.
+        Counters running backwards, reset to zero or wrapped are recovered, not dropped,
+            see `_diff_counter`. Kind of each value is kept in ENTRIES_FLAG / EXITS_FLAG.
 
         Code idea and code credits to Two Sigma Data Clinic - MTA,
             https://github.com/tsdataclinic/mta/blob/master/src/turnstile/turnstile.py#L41
@@ -98,20 +350,28 @@ def calc_features_from_cumulative_records(df):
     ----------
     df : pd.DataFrame
         Dataframe containing source columns and which to add generated features
+    max_diff : int
+        max plausible number of entries (exits) between two audits
+    seed : pd.DataFrame or None
+        last audits of devices from previous batch of data (see `last_audits`), so first audits
+        of batch get relative values too; if None - first audits of devices get empty values
     """
+    df, is_first = _sort_by_device_and_time(df)
+    seed_values = {} if seed is None else _seed_values(df, is_first, seed)
 
-    df['ENTRIES_DIFF'] = df.groupby(['C/A','UNIT','SCP']).ENTRIES.diff(1) # may use apply(func) too
-    df['EXITS_DIFF'] = df.groupby(['C/A','UNIT','SCP']).EXITS.diff(1) # may use apply(func) too
+    for col in ['ENTRIES', 'EXITS']:
+        values = df[col].values
+        previous, has_previous = _previous_values(values.astype('float64'), is_first, seed_values.get(col))
+        df[f'{col}_DIFF'], df[f'{col}_FLAG'] = _diff_counter(values, previous, has_previous, max_diff)
+        # outliers are not dropped, their relative values are empty
+        profiling.current_stage().add(**{f'{col.lower()}_outliers': int((df[f'{col}_FLAG'] == COUNTER_OUTLIER).sum())})
 
-    # set negative or too large values to empty value
-    df['ENTRIES_DIFF'] = df.ENTRIES_DIFF.where((df.ENTRIES_DIFF >= 0) & (df.ENTRIES_DIFF < 10000), np.nan)
-    df['EXITS_DIFF'] = df.EXITS_DIFF.where((df.EXITS_DIFF >= 0) & (df.EXITS_DIFF < 10000), np.nan)
-    #df['ENTRIES_CLEAN'] = df.groupby(['C/A','UNIT','SCP']).ENTRIES_DIFF.cumsum()
-    #df['EXITS_CLEAN'] = df.groupby(['C/A','UNIT','SCP']).EXITS_DIFF.cumsum()
+    times = df.AUDIT_DATE_TIME.values
+    df['TIME_DIFF'] = _diff_time(times, *_previous_values(times, is_first, seed_values.get('AUDIT_DATE_TIME')))
 
     df['BUSYNESS'] = df['ENTRIES_DIFF'] + df['EXITS_DIFF']
 
-    return df
+    return schema.apply_schema(df)
 
 ### not used now, functional is in func `calc_features_from_cumulative_records`
 def _calc_entries_diff(df : pd.DataFrame):
@@ -1,155 +1,712 @@
+import concurrent.futures
+import hashlib
+import json
 import logging
+import threading
 import time
 import requests
-from io import StringIO
 
 import glob
+import os
 import tqdm
 import numpy as np
 import pandas as pd
 
+from src import cache
+from src import profiling
+from src import schema
+from src import storage
+
+logger = logging.getLogger(__name__)
+
 COL_NAMES = '''C/A,UNIT,SCP,
 DATE1,TIME1,DESC1,ENTRIES1,EXITS1,DATE2,TIME2,DESC2,ENTRIES2,EXITS2,
 DATE3,TIME3,DESC3,ENTRIES3,EXITS3,DATE4,TIME4,DESC4,ENTRIES4,EXITS4,
 DATE5,TIME5,DESC5,ENTRIES5,EXITS5,DATE6,TIME6,DESC6,ENTRIES6,EXITS6,
 DATE7,TIME7,DESC7,ENTRIES7,EXITS7,DATE8,TIME8,DESC8,
 ENTRIES8,EXITS8'''.replace('\n', '').split(',')
+KEY_COL_NAMES = ['C/A', 'UNIT', 'SCP']
+AUDIT_COL_NAMES = ['DATE', 'TIME', 'DESC', 'ENTRIES', 'EXITS']
+LONG_COL_NAMES = KEY_COL_NAMES + AUDIT_COL_NAMES
+RAW_LONG_COL_NAMES = KEY_COL_NAMES + ['STATION', 'LINENAME', 'DIVISION'] + AUDIT_COL_NAMES
+MTA_BASE_URL = 'http://web.mta.info/developers/data/nyct/turnstile/'
 
-def _get_links_to_raw_data(links=None):
+def _get_links_to_raw_data(links=None, start_date='2013-01-05', end_date='2013-04-06', base_url=MTA_BASE_URL):
     """Prepares `list of links` to access the dataset stored online,
         Storage is here web.mta.info/developers/turnstile.html ,
         files are Saturday to Saturday.
+        Links are generated for every Saturday between `start_date` and `end_date` (both included),
+        defaults are Q1 2013 files, from turnstile_130105.txt to turnstile_130406.txt
 
     Parameters
+    ----------
     links : list
         Custom list of links which to reach with `get` requests to access data
-    ----------
+    start_date : str
+        first date of range, i.e. '2013-01-05', rounded up to Saturday
+    end_date : str
+        last date of range, i.e. '2013-04-06'
+    base_url : str
+        url of folder with weekly files, i.e. local mirror 'http://localhost:8000/'
     """
 
-    if links is None: # if no links provided, use hardcoded list
-        links = ['http://web.mta.info/developers/data/nyct/turnstile/turnstile_130105.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130112.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130119.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130126.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130202.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130209.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130216.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130223.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130302.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130309.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130316.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130323.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130330.txt',
-                 # 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_121229.txt',
-                 'http://web.mta.info/developers/data/nyct/turnstile/turnstile_130406.txt'
-                ]
+    if links is None: # if no links provided, generate links for each Saturday of date range
+        saturdays = pd.date_range(start_date, end_date, freq='W-SAT')
+        links = [f"{base_url.rstrip('/')}/turnstile_{date:%y%m%d}.txt" for date in saturdays]
 
     return links
 
-def download_raw_data(links, download=False):
+class _RateLimiter:
+    """Allows not more than `rate` calls per second shared between threads."""
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self.next_call = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0., self.next_call - now)
+            self.next_call = max(now, self.next_call) + self.interval
+        time.sleep(delay)
+
+def _make_session(max_workers):
+    """Creates `requests.Session` with connection pool large enough for `max_workers` threads.
+
+    Parameters
+    ----------
+    max_workers : int
+        number of concurrent downloads
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def _file_sha256(path, block_size=1 << 20):
+    """Returns sha256 hex digest of file, reads file by blocks.
+
+    Parameters
+    ----------
+    path : str
+        path to file
+    block_size : int
+        number of bytes to read at once
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def _read_download_meta(path):
+    """Returns metadata (etag, size, sha256) saved next to downloaded file, or empty dict.
+
+    Parameters
+    ----------
+    path : str
+        path to downloaded file
+    """
+    try:
+        with open(path + '.meta.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _is_downloaded(path, etag, size, meta):
+    """Checks if local file is the same as remote one, compares (by priority)
+        ETag, then size and checksum saved at download time, then size of file.
+
+    Parameters
+    ----------
+    path : str
+        path to local file
+    etag : str or None
+        ETag of remote file
+    size : int or None
+        Content-Length of remote file
+    meta : dict
+        metadata saved at download time, see `_read_download_meta`
+    """
+    if not os.path.exists(path):
+        return False
+    if etag is not None and meta.get('etag') is not None:
+        return etag == meta['etag']
+
+    local_size = os.path.getsize(path)
+    if meta.get('sha256') is not None:
+        return meta.get('size') == local_size and (size is None or size == local_size) \
+            and meta['sha256'] == _file_sha256(path)
+
+    return size is not None and size == local_size
+
+def _is_encoded(response):
+    """Checks if response body is compressed (`Content-Encoding`), then `Content-Length` is size of encoded bytes."""
+    return response.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+
+def _finalize_download(part_path, path, link, etag):
+    """Moves complete `*.part` file to `path` and saves metadata next to it, see `_read_download_meta`."""
+    os.replace(part_path, path)
+    with open(path + '.meta.json', 'w') as f:
+        json.dump({'url': link, 'etag': etag, 'size': os.path.getsize(path), 'sha256': _file_sha256(path)}, f)
+
+def _download_one(session, link, path, rate_limiter, retries, backoff_factor, timeout, block_size=1 << 16):
+    """Downloads one file, streams bytes straight to disk. Returns status: 'downloaded' or 'skipped'.
+        Skips file if it is already downloaded (see `_is_downloaded`),
+        resumes partially downloaded `*.part` file with `Range` request (complete `*.part` file
+        left by interrupted run is finalized, `*.part` rejected by server with 416 is downloaded again),
+        retries failed requests with exponential backoff.
+        Uncompressed body is requested (`Accept-Encoding: identity`), so sizes are comparable;
+        if server compresses it anyway, file is saved decoded and not resumed, received (encoded)
+        bytes are checked against `Content-Length` of response.
+
+    Parameters
+    ----------
+    session : requests.Session
+        session with connection pool
+    link : str
+        url of file
+    path : str
+        where to save file
+    rate_limiter : _RateLimiter
+        shared limit of requests per second
+    retries : int
+        number of retries after failed request
+    backoff_factor : float
+        sleep `backoff_factor * 2 ** attempt` seconds between retries
+    timeout : float
+        connect and read timeout in seconds
+    """
+    part_path = path + '.part'
+    meta = _read_download_meta(path)
+
+    for attempt in range(retries + 1):
+        try:
+            rate_limiter.wait()
+            head = session.head(link, headers={'Accept-Encoding': 'identity'}, timeout=timeout, allow_redirects=True)
+            head.raise_for_status()
+            etag = head.headers.get('ETag')
+            # size of encoded body is not comparable with size of saved file
+            size = int(head.headers['Content-Length']) if 'Content-Length' in head.headers \
+                and not _is_encoded(head) else None
+
+            if _is_downloaded(path, etag, size, meta):
+                return 'skipped'
+
+            resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if resume_from and size is not None and resume_from >= size:
+                if resume_from == size:
+                    # run was interrupted after the last byte was written
+                    _finalize_download(part_path, path, link, etag)
+                    return 'downloaded'
+                os.remove(part_path)
+                resume_from = 0
+
+            headers = {'Accept-Encoding': 'identity'}
+            if resume_from and not _is_encoded(head):
+                headers['Range'] = f'bytes={resume_from}-'
+                if etag is not None:
+                    headers['If-Range'] = etag
+
+            rate_limiter.wait()
+            response = session.get(link, headers=headers, stream=True, timeout=timeout)
+            if response.status_code == 416 and 'Range' in headers:
+                # `*.part` does not match remote file any more, starts from scratch
+                response.close()
+                os.remove(part_path)
+                headers.pop('Range'), headers.pop('If-Range', None)
+                rate_limiter.wait()
+                response = session.get(link, headers=headers, stream=True, timeout=timeout)
+
+            with response:
+                response.raise_for_status()
+                encoded = _is_encoded(response)
+                # server may ignore `Range` and send whole file, encoded body is never appended
+                mode = 'ab' if response.status_code == 206 and not encoded else 'wb'
+                with open(part_path, mode) as f:
+                    for block in response.iter_content(chunk_size=block_size):
+                        f.write(block)
+                # bytes received before decoding
+                received, expected = response.raw.tell(), response.headers.get('Content-Length')
+
+            if encoded:
+                is_complete = expected is None or received == int(expected)
+            else:
+                is_complete = size is None or os.path.getsize(part_path) == size
+            if not is_complete:
+                os.remove(part_path)
+                raise requests.exceptions.RequestException(f'Size mismatch, expected {expected if encoded else size} '
+                                                           f'bytes: {link}')
+
+            _finalize_download(part_path, path, link, etag)
+
+            return 'downloaded'
+
+        except requests.exceptions.RequestException as error:
+            # client errors (i.e. 404 - file is not published) are not retried, except 429
+            status_code = getattr(error.response, 'status_code', None)
+            if attempt == retries or (status_code is not None and status_code < 500 and status_code != 429):
+                raise
+            time.sleep(backoff_factor * 2 ** attempt)
+
+@profiling.instrument('download')
+def download_raw_data(links, download=False, raw_path='./data/raw', max_workers=4, rate_limit=4.,
+                      retries=3, backoff_factor=0.5, timeout=60.):
     """Downloads files from online storage - http://web.mta.info/developers/turnstile.html.
         Returns a list of paths to downloaded files.
 
+        Files are fetched concurrently over one pooled session and saved as is (raw MTA text,
+        no pandas round trip). Files already present (same ETag, size or checksum) are skipped,
+        interrupted downloads are resumed. Failed links are printed and not returned.
+        Use `base_url` of `_get_links_to_raw_data` to download from local mirror or test server,
+        behaviour against stand-in server is checked by `benchmarks.check_downloader`.
+        Files and bytes written are recorded in run report, see `profiling.stage`.
+
     Parameters
     ----------
-    links : int
+    links : list
         list of links which to reach with `get` requests to access data
     download : bool
         if true - downloads files, if false - uses existing files from hardcoded raw data folder
+    raw_path : str
+        folder where to save raw files
+    max_workers : int
+        number of concurrent downloads (and size of connection pool)
+    rate_limit : float or None
+        max number of requests per second across all workers, None - no limit
+    retries : int
+        number of retries after failed request
+    backoff_factor : float
+        sleep `backoff_factor * 2 ** attempt` seconds between retries
+    timeout : float
+        connect and read timeout in seconds
     """
-    if download:
-        path = []
-        for indx, link in enumerate(tqdm.tqdm(links, desc='Downloading raw files')):
+    if not download:
+        path = glob.glob(os.path.join(raw_path, 'turnstile*.txt'))
+        print(f'Raw files found, {len(path)} files found')
+        profiling.current_stage().add(files_out=len(path))
+        return path
+
+    os.makedirs(raw_path, exist_ok=True)
+    session = _make_session(max_workers)
+    rate_limiter = _RateLimiter(rate_limit)
+    paths = {link: os.path.join(raw_path, link.rstrip('/').split('/')[-1]) for link in links}
+    statuses = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_download_one, session, link, paths[link], rate_limiter,
+                                   retries, backoff_factor, timeout): link for link in links}
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures),
+                                desc='Downloading raw files'):
+            link = futures[future]
             try:
-                response = requests.get(link)
+                statuses[link] = future.result()
+                logger.debug('%s %s', statuses[link], link)
+            except requests.exceptions.RequestException as error:
+                statuses[link] = 'failed'
+                print('Error:', link, error)
+
+    session.close()
+    counts = {status: list(statuses.values()).count(status) for status in ['downloaded', 'skipped', 'failed']}
+    print(f"Raw files downloaded, {counts['downloaded']} files downloaded, "
+          f"{counts['skipped']} skipped (already present), {counts['failed']} failed")
+    downloaded = [paths[link] for link in links if statuses[link] == 'downloaded']
+    profiling.current_stage().add(files_in=len(links), files_out=len(links) - counts['failed'],
+                                  files_failed=counts['failed'], bytes_written=profiling.file_size(downloaded))
+
+    return [paths[link] for link in links if statuses[link] != 'failed']
+
+def _detect_raw_format(file):
+    """Detects layout of raw file by its first line:
+        * 'long' - post 10/18/14 files, one row per audit, header
+            `C/A,UNIT,SCP,STATION,LINENAME,DIVISION,DATE,TIME,DESC,ENTRIES,EXITS`
+        * 'wide' - pre 10/18/14 files, one row per eight audits, no header (`COL_NAMES`)
+        * 'wide_indexed' - wide files saved with pandas by older versions of `download_raw_data`
 
-                path_i = f'./data/raw/{link[-20:]}'
-                # response to pd.DataFrame
-                response_data = StringIO(response.text)
-                response_data_df = pd.read_csv(response_data, sep=',', names=COL_NAMES)
-                # save file
-                response_data_df.to_csv(path_i)
+    Parameters
+    ----------
+    file : str
+        path to raw file
+    """
+    with open(file) as f:
+        first_line = f.readline()
 
-                path.append(path_i)
+    if first_line.startswith(',C/A,'):
+        return 'wide_indexed'
+    if first_line.replace(' ', '').startswith('C/A,UNIT,SCP,STATION'):
+        return 'long'
 
-            except response.status_code != 200:
-                print('Error:', link, response.status_code)
+    return 'wide'
 
-            time.sleep(0.5)
+def _read_raw_file(file, chunksize=None):
+    """Reads raw wide pre-2014 file. Handles both original MTA text files (no header)
+        and files saved with pandas by older versions of `download_raw_data` (header and index).
 
-        print(f'Raw files downloaded, {indx} files downloaded')
+    Parameters
+    ----------
+    file : str
+        path to raw file
+    chunksize : int or None
+        number of rows to read at once (returns iterator), if None - reads whole file
+    """
+    if _detect_raw_format(file) == 'wide_indexed':
+        return pd.read_csv(file, index_col=0, chunksize=chunksize)
 
-    else:
-        path = glob.glob('./data/raw/turnstile*.txt')
-        print(f'Raw files found, {len(path)} files found')
+    return pd.read_csv(file, header=None, names=COL_NAMES, index_col=False, chunksize=chunksize)
 
-    return path
+def _read_raw_long_file(file, chunksize=None):
+    """Reads raw post-2014 (one row per audit) file, only columns of `LONG_COL_NAMES` are parsed.
+        Column names are stripped (`EXITS` has trailing spaces in MTA files).
 
-def reorganize_raw_files(files, custom_parse=True):
-    """Transforms (re-orginezes) format of fields of raw pre-2014 files.
-        Basicly transform from wide to long table.
-        Returns a list of paths to files with transformed format.
+    Parameters
+    ----------
+    file : str
+        path to raw file
+    chunksize : int or None
+        number of rows to read at once (returns iterator), if None - reads whole file
+    """
+    return pd.read_csv(file, header=0, names=RAW_LONG_COL_NAMES, usecols=LONG_COL_NAMES,
+                       dtype={'ENTRIES': 'float64', 'EXITS': 'float64'}, chunksize=chunksize)
 
-    *** NOTE: Data provider changed format of data set after 10/18/14
-        from one-wide-row-for-eight-audits to one-row-for-one-audit ***
+def _normalize_long_table(df):
+    """Brings long table of any layout to one schema: `LONG_COL_NAMES` columns,
+        DATE as 'MM-DD-YY' (pre-2014 format, post-2014 files have 'MM/DD/YYYY'),
+        int64 counters, rows with empty values dropped.
 
-    We have two ways to do it - with pandas built-in functions or with custom-written  'parser'.
-        Custom parses performs about 10% faster on my tests, but it is custom
+    Parameters
+    ----------
+    df : pd.DataFrame
+        long table
+    """
+    # somethimes columns from wide format are not populated for each and every row
+    n_rows = len(df)
+    df = df[LONG_COL_NAMES].dropna()
+    profiling.current_stage().add(rows_dropped=n_rows - len(df))
+
+    date = df['DATE'].astype(str)
+    is_long_date = date.str.len() == 10
+    if is_long_date.any():
+        date = date.where(~is_long_date, date.str[0:2] + '-' + date.str[3:5] + '-' + date.str[8:10])
+        df = df.assign(DATE=date)
+
+    return df.astype({'ENTRIES': 'int64', 'EXITS': 'int64'})
+
+def parse_raw_file(file, custom_parse=True, chunksize=None):
+    """Reads raw file of any layout (see `_detect_raw_format`) and yields normalized long tables
+        (see `_normalize_long_table`), one table or one table per `chunksize` raw rows.
+        Post-2014 files are already long and are not reshaped, pre-2014 files are reshaped
+        with vectorized parser. Index is continuous across chunks.
+        Raw rows read (wide rows of pre-2014 files) and rows dropped are added to current stage,
+        see `profiling.current_stage`.
 
     Parameters
     ----------
-    files : list
-        list of raw files which to reach and read to transform dataset format
+    file : str
+        path to raw file
     custom_parse : bool
         if true - uses custom function, if false - uses `wide_to_long` built-in function
+    chunksize : int or None
+        number of raw rows to read at once, if None - reads whole file
     """
-    columns_target = ['C/A', 'UNIT', 'SCP', 'DATE', 'TIME', 'DESC', 'ENTRIES', 'EXIT']
-    path = []
+    if _detect_raw_format(file) == 'long':
+        reshape, chunks = None, _read_raw_long_file(file, chunksize=chunksize)
+    else:
+        reshape = _reshape_wide_to_long if custom_parse else _reshape_wide_to_long_pandas
+        chunks = _read_raw_file(file, chunksize=chunksize)
+
+    if chunksize is None:
+        chunks = [chunks]
 
-    for indx, file in enumerate(tqdm.tqdm(files, desc='Making long files')):
+    offset = 0
+    for df in chunks:
+        profiling.current_stage().add(rows_in=len(df))
+        if reshape is not None:
+            df = reshape(df)
+        # keep index continuous across chunks, as in not chunked mode
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
 
-        # open wide table
-        df = pd.read_csv(file, index_col=0)
+        yield _normalize_long_table(df)
 
-        if custom:
-            # use custom row split
-            reshaped_list = []
-            for indx, row in df.iterrows():
-                row_splited = row.values.tolist()
+def _reshape_wide_to_long_iterrows(df):
+    """Reshapes wide pre-2014 table to long one row by row with `iterrows`.
+        Kept as a reference implementation for benchmarks, see `benchmarks.benchmark_reshape`
 
-                row_key_data = row_splited[:3]; del row_splited[:3]
-                rows_updating_data = np.reshape(row_splited, (-1, 5)).tolist()
+    Parameters
+    ----------
+    df : pd.DataFrame
+        wide table with `COL_NAMES` columns
+    """
+    reshaped_list = []
+    for indx, row in df.iterrows():
+        row_splited = row.values.tolist()
 
-                [reshaped_list.append(row_key_data + row_updating_data) for row_updating_data in rows_updating_data]
-                #break
-            df = pd.DataFrame(reshaped_list, columns=columns_target)
+        row_key_data = row_splited[:3]; del row_splited[:3]
+        rows_updating_data = np.reshape(np.array(row_splited, dtype=object), (-1, 5)).tolist()
 
-        else:
-            # use wide_to_long method from pandas
-            df['id'] = df.index.astype(str) + "-" + df['C/A'] + "-" + df['UNIT'] + "-" + df['SCP']
-            #display(df.head(2))
+        [reshaped_list.append(row_key_data + row_updating_data) for row_updating_data in rows_updating_data]
 
-            df = pd.wide_to_long(df,
-                            stubnames=['DATE', 'TIME', 'DESC', 'ENTRIES', 'EXITS'],
-                            i=['id'],
-                            j='row',
-                            suffix='.+').reset_index()
+    return pd.DataFrame(reshaped_list, columns=LONG_COL_NAMES)
 
-            df = df.sort_values(['C/A','UNIT','SCP', 'DATE', 'TIME']).reset_index(drop=True)
+def _reshape_wide_to_long_pandas(df):
+    """Reshapes wide pre-2014 table to long one with pandas built-in `wide_to_long`.
+        Output is sorted by device, date and time (not in order of raw file rows)
 
-            df.drop('id', axis=1, inplace=True)
+    Parameters
+    ----------
+    df : pd.DataFrame
+        wide table with `COL_NAMES` columns
+    """
+    df = df.copy()
+    df['id'] = df.index.astype(str) + "-" + df['C/A'] + "-" + df['UNIT'] + "-" + df['SCP']
+
+    df = pd.wide_to_long(df,
+                    stubnames=['DATE', 'TIME', 'DESC', 'ENTRIES', 'EXITS'],
+                    i=['id'],
+                    j='row',
+                    suffix='.+').reset_index()
+
+    df = df.sort_values(['C/A','UNIT','SCP', 'DATE', 'TIME']).reset_index(drop=True)
+
+    return df[LONG_COL_NAMES]
+
+def _reshape_wide_to_long(df):
+    """Reshapes wide pre-2014 table to long one in a single vectorized pass.
+        Each of 5 `DATEn..EXITSn` groups of 8 columns is taken as one NumPy block (n_rows x 8)
+        and flattened row-major, key columns C/A, UNIT, SCP are repeated 8 times.
+        Output has the same columns and row order as `_reshape_wide_to_long_iterrows`:
+        audits 1..8 of the 1st raw row, then audits 1..8 of the 2nd raw row, etc.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        wide table with `COL_NAMES` columns
+    """
+    n_audits = (len(COL_NAMES) - len(KEY_COL_NAMES)) // len(AUDIT_COL_NAMES)
 
-        # somethimes columns from wide format are not populated for each and every row
-        df = df.dropna()
+    data = {}
+    for col in KEY_COL_NAMES:
+        data[col] = np.repeat(df[col].to_numpy(), n_audits)
+    for col in AUDIT_COL_NAMES:
+        block = df[[f'{col}{i}' for i in range(1, n_audits + 1)]].to_numpy()
+        data[col] = block.ravel()
+
+    return pd.DataFrame(data, columns=LONG_COL_NAMES)
+
+def _write_long_chunk(df, save_path, first_chunk, storage_backend='csv'):
+    """Appends long table chunk to csv file (header is written with the first chunk only)
+        or to week partition of parquet dataset.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        long table chunk to write
+    save_path : str
+        path to csv file or to week folder of parquet dataset, i.e. './data/interim/turnstile/WEEK=130105'
+    first_chunk : bool
+        if true - overwrites file (week) and writes header, if false - appends rows
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    """
+    if storage_backend == 'csv':
+        df.to_csv(save_path, mode='w' if first_chunk else 'a', header=first_chunk)
+        return
+
+    root_path, week = os.path.split(os.path.normpath(save_path))
+    storage.write_long_table(df, root_path, week.split('=', 1)[1], backend=storage_backend,
+                             append=not first_chunk)
+
+def _read_long_file(path, storage_backend='csv'):
+    """Reads one week of long table written by `reorganize_raw_files`.
+
+    Parameters
+    ----------
+    path : str
+        path to csv file or to week folder of parquet dataset
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    """
+    if storage_backend == 'csv':
+        return pd.read_csv(path, index_col=0)
+
+    root_path, week = os.path.split(os.path.normpath(path))
+    df = storage.read_long_table(root_path, weeks=[week.split('=', 1)[1]], backend=storage_backend)
+
+    return df.drop(columns='WEEK')[LONG_COL_NAMES]
+
+def _interim_path(file, output_path=None):
+    """Returns interim folder for raw file: `output_path` if given, otherwise sibling 'interim' folder
+        of raw folder ('./data/raw/turnstile_130105.txt' -> './data/interim'), or 'interim' subfolder
+        if folder of raw file is not named 'raw'.
+
+    Parameters
+    ----------
+    file : str
+        path to raw file
+    output_path : str or None
+        interim folder
+    """
+    if output_path is not None:
+        return output_path
+
+    folder = os.path.dirname(file)
+    if os.path.basename(os.path.normpath(folder)) == 'raw':
+        return os.path.join(os.path.dirname(os.path.normpath(folder)), 'interim')
+
+    return os.path.join(folder, 'interim')
+
+def _interim_dataset_path(file, output_path=None):
+    """Returns folder of interim parquet dataset for raw file, i.e.
+        './data/raw/turnstile_130105.txt' -> './data/interim/turnstile'
+
+    Parameters
+    ----------
+    file : str
+        path to raw file
+    output_path : str or None
+        interim folder, see `_interim_path`
+    """
+    return os.path.join(_interim_path(file, output_path), 'turnstile')
+
+def _long_file_path(file, storage_backend='csv', output_path=None):
+    """Returns (deterministic) path of long table made from raw file.
+
+    Parameters
+    ----------
+    file : str
+        path to raw file
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    output_path : str or None
+        interim folder, see `_interim_path`
+    """
+    if storage_backend == 'csv':
+        name = os.path.splitext(os.path.basename(file))[0] + '.csv'
+        return os.path.join(_interim_path(file, output_path), name)
+
+    return storage.week_partition_path(_interim_dataset_path(file, output_path), storage.week_from_path(file),
+                                       storage_backend)
+
+def _reorganize_raw_file(file, custom_parse=True, chunksize=None, storage_backend='csv', output_path=None):
+    """Reshapes one raw file to long table and saves it, returns path of long table.
+        See `reorganize_raw_files` for parameters.
+    """
+    save_path = _long_file_path(file, storage_backend, output_path)
+    if storage_backend == 'csv':
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+    for chunk_indx, df in enumerate(parse_raw_file(file, custom_parse, chunksize)):
         # save long table
-        save_path = file.replace('raw', 'interim').replace('txt', 'csv')
-        path.append(save_path)
+        _write_long_chunk(df, save_path, first_chunk=chunk_indx == 0, storage_backend=storage_backend)
+        profiling.current_stage().add(rows_out=len(df))
 
-        df.to_csv(save_path)
+    return save_path
+
+def _reorganize_raw_file_in_worker(file, custom_parse, chunksize, storage_backend, output_path):
+    """Runs `_reorganize_raw_file` in pool worker, returns path of long table and counters of worker
+        (rows, peak RSS), see `profiling.stage`.
+    """
+    with profiling.stage('reorganize_file') as stats:
+        save_path = _reorganize_raw_file(file, custom_parse, chunksize, storage_backend, output_path)
+
+    return save_path, stats
+
+@profiling.instrument('reorganize')
+def reorganize_raw_files(files, custom_parse=True, chunksize=None, storage_backend='csv', n_jobs=1,
+                         output_path=None):
+    """Transforms (re-orginezes) format of fields of raw pre-2014 files.
+        Basicly transform from wide to long table.
+        Returns a list of paths to files with transformed format.
+
+    *** NOTE: Data provider changed format of data set after 10/18/14
+        from one-wide-row-for-eight-audits to one-row-for-one-audit ***
+        Layout is detected for each file (see `parse_raw_file`), post-2014 files are not reshaped,
+        both layouts are saved in the same long schema (`LONG_COL_NAMES`, DATE as 'MM-DD-YY').
+        STATION, LINENAME, DIVISION of post-2014 files are dropped, use `feature_generation.add_stations`
+
+    We have two ways to do it - with pandas built-in functions or with custom-written  'parser'.
+        Custom parser stacks whole column blocks at once (see `_reshape_wide_to_long`) and
+        keeps order of raw rows, `wide_to_long` sorts output by device, date and time.
+        See `benchmarks.benchmark_reshape` to compare both with the old `iterrows` parser
+
+    Streaming mode (`chunksize` is set) reads each raw file by `chunksize` wide rows,
+        reshapes each chunk and appends it to the long file right away, so memory is bound
+        by chunk size and not by file size. Peak RSS of the stage is printed at the end.
+        With `wide_to_long` parser output is sorted inside each chunk only.
+
+    Storage backend 'parquet' writes typed, compressed columnar files partitioned by week and unit
+        to './data/interim/turnstile' (see `storage.write_long_table`) and returns week folders.
+        Long tables are saved to `output_path` if it is given, otherwise next to raw folder (see `_interim_path`).
+
+    Weekly files are independent, with `n_jobs` > 1 they are processed in a pool of processes,
+        one file per task. Output path of each file does not depend on the order of processing,
+        returned paths keep the order of `files`. Failed files are printed and not returned.
+
+    Raw rows read, long rows written, rows dropped (empty values) and bytes read and written are
+        recorded in run report, see `profiling.stage`.
+
+    Parameters
+    ----------
+    files : list
+        list of raw files which to reach and read to transform dataset format
+    custom_parse : bool
+        if true - uses custom function, if false - uses `wide_to_long` built-in function
+    chunksize : int or None
+        number of wide rows to read at once, if None - reads whole file
+    storage_backend : str
+        'csv' - one csv file per week, 'parquet' - partitioned parquet dataset
+    n_jobs : int
+        number of worker processes, 1 - process files in current process, -1 - use all CPU cores
+    output_path : str or None
+        interim folder, i.e. './data/interim', if None - sibling 'interim' folder of raw folder
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    results, errors, peaks_rss = {}, {}, []
 
-    return path
+    if n_jobs == 1:
+        profiling.reset_peak_rss()
+        for indx, file in enumerate(tqdm.tqdm(files, desc='Making long files')):
+            try:
+                results[file] = _reorganize_raw_file(file, custom_parse, chunksize, storage_backend, output_path)
+            except Exception as error:
+                errors[file] = error
+        peaks_rss.append(profiling.get_peak_rss_mb())
 
-def _concat_files(files, save_path='./data/interim/turnstile_Q1_2013.csv'):
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(_reorganize_raw_file_in_worker, file, custom_parse,
+                                       chunksize, storage_backend, output_path): file for file in files}
+            for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures),
+                                    desc=f'Making long files ({n_jobs} workers)'):
+                file = futures[future]
+                try:
+                    results[file], stats = future.result()
+                    peaks_rss.append(stats['peak_rss_mb'])
+                    profiling.current_stage().add(**{key: stats.get(key, 0) for key in
+                                                     ['rows_in', 'rows_out', 'rows_dropped']})
+                except Exception as error:
+                    errors[file] = error
+
+    for file, error in errors.items():
+        print('Error:', file, repr(error))
+    profiling.current_stage().add(files_in=len(files), files_out=len(results), files_failed=len(errors),
+                                  bytes_read=profiling.file_size(files),
+                                  bytes_written=profiling.file_size(list(results.values())))
+
+    if chunksize is not None or n_jobs != 1:
+        print(f'Long files done, {len(results)} files, {len(errors)} failed, '
+              f'peak RSS {max(peaks_rss, default=0.):.1f} MB per process (chunksize={chunksize})')
+
+    return [results[file] for file in files if file in results]
+
+@profiling.instrument('concat')
+def _concat_files(files, save_path='./data/interim/turnstile_Q1_2013.csv', chunksize=None,
+                  storage_backend='csv'):
     """Concatenates weekly data-files ('batches') into one big, long table.
         ☆ We might use 'batches' too, but it will require some additional loops & logics every-time
         to access the data and calculate things. On other hand, we already have enough resources
@@ -157,7 +714,15 @@ def _concat_files(files, save_path='./data/interim/turnstile_Q1_2013.csv'):
         ☆ We would need batch-processing staff, as well as a different data-storage model,
         if we had significantly bigger dataset and some tricky modeling goals
 
-        ! Check memory usage. Sometimes garbage collector works wrong with concatenating/unionizing files
+        Weekly tables are collected to a list and concatenated once (not one by one).
+        Streaming mode (`chunksize` is set) never holds the big table in memory - each file is read
+        by `chunksize` rows and appended to `save_path` right away. Peak RSS of the stage is printed.
+
+        With 'parquet' storage backend `save_path` is a folder of partitioned dataset
+        (i.e. './data/processed/turnstile'), weeks are copied there one by one, so small chunk files
+        of interim layer are compacted and memory is bound by one week of data.
+
+        Rows and bytes are recorded in run report, see `profiling.stage`.
 
     Parameters
     ----------
@@ -165,15 +730,74 @@ def _concat_files(files, save_path='./data/interim/turnstile_Q1_2013.csv'):
         list of transformed files (batches) which to reach and read to concatenate into big file (table)
     save_path :
         path where to save concatenated table
-    df : pd.DataFrame
-        temp dataframe behaving as a bone for a concatenating files
+    chunksize : int or None
+        number of long rows to read at once, if None - reads whole files
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
     """
-    df = pd.DataFrame([])
+    stats = profiling.current_stage()
+    stats.add(files_in=len(files), bytes_read=profiling.file_size(files))
+
+    if storage_backend != 'csv':
+        for indx, file in enumerate(tqdm.tqdm(files, desc='Concatenating long files')):
+            df = _read_long_file(file, storage_backend)
+            storage.write_long_table(df, save_path, storage.week_from_path(file), backend=storage_backend)
+            stats.add(rows_in=len(df), rows_out=len(df))
+        stats.add(bytes_written=profiling.file_size(save_path))
+        return
+
+    if chunksize is None:
+        dfs = []
+        for indx, file in enumerate(tqdm.tqdm(files, desc='Concatenating long files')):
+            # collect weekly "batches", concat them once to big table
+            dfs.append(pd.read_csv(file, index_col=0))
+        df = pd.concat(dfs, ignore_index=True, axis=0)
+        del dfs
+
+        # df = df.sort_values(['C/A','UNIT','SCP', 'DATE', 'TIME']).reset_index(drop=True)
+        df.to_csv(save_path)
+        stats.add(rows_in=len(df), rows_out=len(df), bytes_written=profiling.file_size(save_path))
+        return
+
+    profiling.reset_peak_rss()
+    offset = 0
     for indx, file in enumerate(tqdm.tqdm(files, desc='Concatenating long files')):
-        # concat weekly "batches" to big table
-        df_small = pd.read_csv(file, index_col=0)
-        df = pd.concat([df, df_small], ignore_index=True, axis=0)
-        del df_small
+        for df in pd.read_csv(file, index_col=0, chunksize=chunksize):
+            df.index = pd.RangeIndex(offset, offset + len(df))
+            _write_long_chunk(df, save_path, first_chunk=offset == 0)
+            offset += len(df)
+    stats.add(rows_in=offset, rows_out=offset, bytes_written=profiling.file_size(save_path))
+
+    print(f'Concatenated table done, peak RSS {profiling.get_peak_rss_mb():.1f} MB (chunksize={chunksize})')
+
+@profiling.instrument('load')
+@cache.cached()
+def load_combined_table(path='./data/interim/turnstile_Q1_2013.csv', storage_backend='csv', columns=None,
+                        report=False):
+    """Loads concatenated long table (see `_concat_files`) with compact dtypes, see `schema.AUDIT_DTYPES`.
+
+    Parameters
+    ----------
+    path : str
+        path to csv file or folder of parquet dataset
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    columns : list or None
+        columns to read, if None - reads all columns
+    report : bool
+        if true - prints memory usage before and after dtypes conversion (csv is parsed without dtypes first)
+    """
+    profiling.current_stage().add(bytes_read=profiling.file_size(path))
+    if storage_backend != 'csv':
+        df = storage.read_long_table(path, columns=columns, backend=storage_backend)
+        return schema.apply_schema(df, report=report)
+
+    # index column has no name in header
+    usecols = None if columns is None else (lambda col: col in columns or col.startswith('Unnamed'))
+    if report:
+        df = pd.read_csv(path, index_col=0, usecols=usecols)
+        return schema.apply_schema(df, report=True)
+
+    dtypes = {col: schema.AUDIT_DTYPES[col] for col in LONG_COL_NAMES}
 
-    # df = df.sort_values(['C/A','UNIT','SCP', 'DATE', 'TIME']).reset_index(drop=True)
-    df.to_csv(save_path)
+    return pd.read_csv(path, index_col=0, usecols=usecols, dtype=dtypes)
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from src import get_data
+from src import storage
+
+MANIFEST_PATH = './data/interim/manifest.json'
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+    """Loads manifest of processed raw files, returns empty manifest if there is no file yet.
+        Manifest structure:
+            {'files': {raw_path: {'sha256', 'size', 'mtime', 'rows_raw', 'rows_long',
+                                  'output', 'partitions'}},
+             'combined': {'path', 'storage_backend', 'rows', 'weeks'}}
+
+    Parameters
+    ----------
+    manifest_path : str
+        path to manifest json file
+    """
+    if not os.path.exists(manifest_path):
+        return {'files': {}, 'combined': {}}
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path=MANIFEST_PATH):
+    """Saves manifest atomically (to temp file, then renames), so interrupted run does not break it.
+
+    Parameters
+    ----------
+    manifest : dict
+        manifest, see `load_manifest`
+    manifest_path : str
+        path to manifest json file
+    """
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def _hash_and_count_lines(path, block_size=1 << 20):
+    """Returns sha256 hex digest and number of lines of file in one read pass.
+
+    Parameters
+    ----------
+    path : str
+        path to file
+    block_size : int
+        number of bytes to read at once
+    """
+    digest, n_lines, last_block = hashlib.sha256(), 0, b''
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+            n_lines += block.count(b'\n')
+            last_block = block
+    # last line without line break
+    if last_block and not last_block.endswith(b'\n'):
+        n_lines += 1
+
+    return digest.hexdigest(), n_lines
+
+def _count_long_rows(path, storage_backend='csv'):
+    """Returns number of rows of long table (week), parquet rows are read from file footers.
+
+    Parameters
+    ----------
+    path : str
+        path to csv file or week folder of parquet dataset
+    storage_backend : str
+        'csv' or 'parquet'
+    """
+    if storage_backend == 'csv':
+        # minus header
+        return _hash_and_count_lines(path)[1] - 1
+
+    import pyarrow.parquet as pq
+
+    return sum(pq.ParquetFile(os.path.join(root, name)).metadata.num_rows
+               for root, _, names in os.walk(path) for name in names if name.endswith('.parquet'))
+
+def _list_partitions(path, storage_backend='csv'):
+    """Returns list of output partitions (files or unit folders) of long table (week).
+
+    Parameters
+    ----------
+    path : str
+        path to csv file or week folder of parquet dataset
+    storage_backend : str
+        'csv' or 'parquet'
+    """
+    if storage_backend == 'csv':
+        return [path]
+
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.startswith('UNIT='))
+
+def find_changed_files(files, manifest):
+    """Splits raw files to new, changed and unchanged ones using manifest.
+        File with the same size and modification time as in manifest is unchanged,
+        otherwise its sha256 is compared (so touched, but not modified file is unchanged too).
+        Returns dict {'new': [...], 'changed': [...], 'unchanged': [...]} and dict {raw_path: (sha256, n_lines)}
+        with hashes computed on the way.
+
+    Parameters
+    ----------
+    files : list
+        list of raw files
+    manifest : dict
+        manifest, see `load_manifest`
+    """
+    status, hashes = {'new': [], 'changed': [], 'unchanged': []}, {}
+
+    for file in files:
+        record = manifest['files'].get(file)
+        stat = os.stat(file)
+        if record is not None and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+            status['unchanged'].append(file)
+            continue
+
+        hashes[file] = _hash_and_count_lines(file)
+        if record is None:
+            status['new'].append(file)
+        elif record['sha256'] != hashes[file][0]:
+            status['changed'].append(file)
+        else:
+            status['unchanged'].append(file)
+            record['mtime'] = stat.st_mtime
+
+    return status, hashes
+
+def _append_to_combined_csv(files, save_path, offset, chunksize=500_000):
+    """Appends long csv files to combined csv table, index continues from `offset`.
+        Returns number of appended rows.
+
+    Parameters
+    ----------
+    files : list
+        list of long csv files
+    save_path : str
+        path to combined csv table
+    offset : int
+        number of rows already in combined table
+    chunksize : int
+        number of rows to read at once
+    """
+    n_rows = 0
+    for file in files:
+        for df in pd.read_csv(file, index_col=0, chunksize=chunksize):
+            df.index = pd.RangeIndex(offset + n_rows, offset + n_rows + len(df))
+            df.to_csv(save_path, mode='a', header=False)
+            n_rows += len(df)
+
+    return n_rows
+
+def run_incremental(files, combined_path='./data/interim/turnstile_Q1_2013.csv', manifest_path=MANIFEST_PATH,
+                    storage_backend='csv', custom_parse=True, chunksize=None, n_jobs=1):
+    """Runs `reorganize_raw_files` and `_concat_files` for new or changed raw files only.
+        Returns list of paths to long tables of all `files` (processed now or before).
+
+        Manifest records for each raw file its hash, row counts and output partitions.
+        Combined table is patched, not rebuilt:
+            * 'parquet' - weeks of new or changed files are (re)written in combined dataset
+            * 'csv' - rows of new files are appended to combined table; if some already processed
+                file has changed, combined table is rebuilt from long tables (no raw files re-parsing)
+
+    Parameters
+    ----------
+    files : list
+        list of raw files
+    combined_path : str
+        path to combined table (csv file or folder of parquet dataset)
+    manifest_path : str
+        path to manifest json file
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    custom_parse, chunksize, n_jobs :
+        see `get_data.reorganize_raw_files`
+    """
+    manifest = load_manifest(manifest_path)
+    combined = manifest['combined']
+    if combined and (combined['path'] != combined_path or combined['storage_backend'] != storage_backend):
+        # other target, nothing could be reused
+        manifest = {'files': {}, 'combined': {}}
+        combined = manifest['combined']
+
+    status, hashes = find_changed_files(files, manifest)
+    to_process = status['new'] + status['changed']
+    print(f"Incremental run: {len(status['new'])} new, {len(status['changed'])} changed, "
+          f"{len(status['unchanged'])} unchanged files")
+
+    long_paths = {file: get_data._long_file_path(file, storage_backend) for file in to_process}
+    processed = set(get_data.reorganize_raw_files(to_process, custom_parse=custom_parse, chunksize=chunksize,
+                                                  storage_backend=storage_backend, n_jobs=n_jobs)
+                    if to_process else [])
+    processed_files = {file: path for file, path in long_paths.items() if path in processed}
+
+    for file, path in processed_files.items():
+        sha256, n_lines = hashes[file]
+        stat = os.stat(file)
+        manifest['files'][file] = {'sha256': sha256, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                   'rows_raw': n_lines, 'rows_long': _count_long_rows(path, storage_backend),
+                                   'output': path, 'partitions': _list_partitions(path, storage_backend)}
+
+    changed_processed = [file for file in status['changed'] if file in processed_files]
+    new_processed = [file for file in status['new'] if file in processed_files]
+
+    if storage_backend != 'csv':
+        for file in changed_processed + new_processed:
+            df = get_data._read_long_file(processed_files[file], storage_backend)
+            storage.write_long_table(df, combined_path, storage.week_from_path(file), backend=storage_backend)
+
+    elif changed_processed or not combined or not os.path.exists(combined_path):
+        # rebuild from long tables of all processed files
+        long_paths = [manifest['files'][file]['output'] for file in files if file in manifest['files']]
+        get_data._concat_files(long_paths, save_path=combined_path, chunksize=chunksize or 500_000)
+        combined['rows'] = sum(manifest['files'][file]['rows_long'] for file in files if file in manifest['files'])
+
+    elif new_processed:
+        combined['rows'] += _append_to_combined_csv([processed_files[file] for file in new_processed],
+                                                    combined_path, combined['rows'])
+
+    combined.update({'path': combined_path, 'storage_backend': storage_backend,
+                     'weeks': sorted(set(combined.get('weeks', [])) |
+                                     {storage.week_from_path(file) for file in processed_files})})
+    save_manifest(manifest, manifest_path)
+
+    return [manifest['files'][file]['output'] for file in files if file in manifest['files']]
@@ -0,0 +1,110 @@
+import os
+
+import pandas as pd
+import tqdm
+
+from src import aggregates
+from src import feature_generation
+from src import schema
+from src import storage
+
+FEATURES_PATH = './data/processed/features'
+
+def iter_partitions(root_path, storage_backend='parquet', columns=None, filters=None, weeks=None):
+    """Yields (week, table) for each stored week of long audit table, in order of weeks.
+        Only one week is held in memory at a time.
+
+    Parameters
+    ----------
+    root_path : str
+        folder of dataset, i.e. './data/interim/turnstile'
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    columns : list or None
+        columns to read, if None - reads all columns
+    filters : list or None
+        row filters in pyarrow format, see `storage.read_long_table`
+    weeks : list or None
+        weeks to read, if None - reads all weeks
+    """
+    for week in weeks or storage.list_weeks(root_path, storage_backend):
+        df = storage.read_long_table(root_path, columns=columns, filters=filters, weeks=[week],
+                                     backend=storage_backend)
+        yield week, df.drop(columns='WEEK', errors='ignore')
+
+def _features_file(features_path, week):
+    return os.path.join(features_path, f'{week}.parquet')
+
+def run_features_by_partition(root_path, features_path=FEATURES_PATH, cube_path=aggregates.CUBE_PATH,
+                              storage_backend='parquet', weeks=None, registry=None, max_diff=10000):
+    """Runs feature pipeline week by week over on-disk long audit table:
+        `calc_features_from_datetime`, `calc_features_from_cumulative_records` (seeded with
+        last audits of previous week, so week boundaries do not lose relative values),
+        optional station attributes, and aggregate cubes (`aggregates.update_cubes`).
+        Each week of features is saved to `features_path/<week>.parquet`.
+        Memory is bound by size of one week, not by size of dataset.
+        Returns list of weeks processed.
+
+    Parameters
+    ----------
+    root_path : str
+        folder of long audit table, i.e. './data/interim/turnstile'
+    features_path : str
+        folder where to save feature tables
+    cube_path : str or None
+        folder of aggregate cubes, None - cubes are not updated
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    weeks : list or None
+        weeks to process, if None - processes all weeks
+    registry : stations.StationRegistry or None
+        station registry to attach station attributes (cubes are built by Station then)
+    max_diff : int
+        see `feature_generation.calc_features_from_cumulative_records`
+    """
+    os.makedirs(features_path, exist_ok=True)
+    weeks = weeks or storage.list_weeks(root_path, storage_backend)
+    seed = None
+
+    for week, df in tqdm.tqdm(iter_partitions(root_path, storage_backend, weeks=weeks),
+                              total=len(weeks), desc='Features by partition'):
+        df = feature_generation.calc_features_from_datetime(df)
+        df = feature_generation.calc_features_from_cumulative_records(df, max_diff=max_diff, seed=seed)
+        seed = feature_generation.last_audits(df)
+        if registry is not None:
+            df = schema.apply_schema(registry.attach(df))
+
+        df.to_parquet(_features_file(features_path, week), index=False, compression='zstd')
+        if cube_path is not None:
+            aggregates.update_cubes(df, week, cube_path)
+
+    return weeks
+
+def map_reduce_features(func, features_path=FEATURES_PATH, weeks=None, columns=None):
+    """Applies aggregation `func` to each week of features and combines partial results by summing
+        them (for additive aggregations: sums, counts). Memory is bound by size of one week.
+
+        i.e. total busyness by station and day of week:
+            map_reduce_features(lambda df: df.groupby(['UNIT', 'AUDIT_DOW'], observed=True).BUSYNESS.sum(),
+                                columns=['UNIT', 'AUDIT_DOW', 'BUSYNESS'])
+
+    Parameters
+    ----------
+    func : callable
+        function of feature table returning pd.Series or pd.DataFrame indexed by group keys
+    features_path : str
+        folder of feature tables, see `run_features_by_partition`
+    weeks : list or None
+        weeks to process, if None - processes all weeks
+    columns : list or None
+        columns to read, if None - reads all columns
+    """
+    if weeks is None:
+        weeks = sorted(name[:-len('.parquet')] for name in os.listdir(features_path) if name.endswith('.parquet'))
+
+    result = None
+    for week in tqdm.tqdm(weeks, desc='Aggregating by partition'):
+        partial = func(pd.read_parquet(_features_file(features_path, week), columns=columns))
+        result = partial if result is None else result.add(partial, fill_value=0)
+
+    return result
@@ -0,0 +1,188 @@
+import copy
+
+import pandas as pd
+
+from src import feature_generation
+from src import get_data
+from src import stations
+from src import storage
+
+DATE_FEATURES = ['AUDIT_YEAR', 'AUDIT_MONTH', 'AUDIT_WEEK', 'AUDIT_DOW', 'IS_WEEKEND', 'IS_HOLIDAY']
+TIME_FEATURES = ['AUDIT_HOUR', 'AUDIT_MINUTE']
+CUMULATIVE_FEATURES = ['ENTRIES_DIFF', 'EXITS_DIFF', 'ENTRIES_FLAG', 'EXITS_FLAG', 'TIME_DIFF', 'BUSYNESS']
+STATION_FEATURES = stations.STATIONS_COLS + stations.COORDS_COLS
+
+class Pipeline:
+    """Lazy pipeline over week partitioned long audit table (see `storage.write_long_table`).
+        Methods only record the request, `collect` plans and runs it:
+
+        * row filters (stations, units, dates) are pushed down to reading: weeks out of date range
+            and other units are not read (parquet reads only their partitions)
+        * only columns needed for requested output are read
+        * stages not needed for requested output are skipped (date or time features, relative
+            counters, station attributes), station attributes are attached after filtering
+
+            df = (Pipeline('./data/interim/turnstile', registry=registry)
+                  .filter(stations=['34 ST-PENN STA'], start='2013-01-01', end='2013-03-31')
+                  .select('AUDIT_DATE_TIME', 'BUSYNESS')
+                  .collect())
+
+    Parameters
+    ----------
+    root_path : str
+        folder of dataset, i.e. './data/interim/turnstile'
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    registry : stations.StationRegistry or None
+        station registry, required to filter by station names and to add station attributes
+    max_diff : int
+        see `feature_generation.calc_features_from_cumulative_records`
+    """
+
+    def __init__(self, root_path, storage_backend='parquet', registry=None, max_diff=10000):
+        self.root_path = root_path
+        self.storage_backend = storage_backend
+        self.registry = registry
+        self.max_diff = max_diff
+        self._columns = None
+        self._stations = None
+        self._units = None
+        self._start = None
+        self._end = None
+
+    def _copy(self, **changes):
+        pipeline = copy.copy(self)
+        pipeline.__dict__.update(changes)
+        return pipeline
+
+    def select(self, *columns):
+        """Returns new pipeline with output columns, i.e. select('UNIT', 'AUDIT_DATE_TIME', 'BUSYNESS')."""
+        return self._copy(_columns=list(columns))
+
+    def filter(self, stations=None, units=None, start=None, end=None):
+        """Returns new pipeline with row filters (combined with filters set before).
+
+        Parameters
+        ----------
+        stations : list or None
+            station names (requires registry)
+        units : list or None
+            UNIT values
+        start : str or None
+            first day of audits, i.e. '2013-01-01'
+        end : str or None
+            last day of audits (included), i.e. '2013-03-31'
+        """
+        if stations is not None and self.registry is None:
+            raise ValueError('Station registry is required to filter by station names')
+
+        return self._copy(_stations=list(stations) if stations is not None else self._stations,
+                          _units=list(units) if units is not None else self._units,
+                          _start=pd.Timestamp(start) if start is not None else self._start,
+                          _end=pd.Timestamp(end) if end is not None else self._end)
+
+    def _station_keys(self):
+        """Returns (C/A, UNIT) pairs of filtered stations or None."""
+        if self._stations is None:
+            return None
+        table = self.registry.table
+        return table.index[table['Station'].astype(str).isin(self._stations)]
+
+    def _weeks(self, margin):
+        """Returns weeks overlapping date filter, week file holds audits of 7 days before its date."""
+        weeks = storage.list_weeks(self.root_path, self.storage_backend)
+        dates = pd.to_datetime(weeks, format='%y%m%d')
+        keep = pd.Series(True, index=dates)
+        if self._start is not None:
+            keep &= dates > self._start - margin
+        if self._end is not None:
+            keep &= dates - pd.Timedelta(days=7) <= self._end + pd.Timedelta(days=1)
+
+        return [week for week, is_kept in zip(weeks, keep.values) if is_kept]
+
+    def plan(self, margin='1D'):
+        """Returns plan of pipeline: weeks and columns to read, row filters and stages to run.
+
+        Parameters
+        ----------
+        margin : str
+            audits read before start of date filter, so first audits in range get relative counters
+        """
+        output = self._columns
+        wanted = lambda features: output is None or any(col in output for col in features)
+
+        cumulative = wanted(CUMULATIVE_FEATURES)
+        from_date, from_time = wanted(DATE_FEATURES), wanted(TIME_FEATURES)
+        station_columns = [col for col in STATION_FEATURES if output is not None and col in output]
+        if output is None and self.registry is not None:
+            station_columns = self.registry.columns
+        datetime = (cumulative or from_date or from_time or self._start is not None or self._end is not None
+                    or (output is not None and 'AUDIT_DATE_TIME' in output))
+
+        read_columns = [col for col in get_data.LONG_COL_NAMES if output is None or col in output]
+        if cumulative or station_columns or self._stations is not None:
+            read_columns += feature_generation.DEVICE_COLS + ['ENTRIES', 'EXITS'] * cumulative
+        if datetime:
+            read_columns += ['DATE', 'TIME']
+        read_columns = [col for col in get_data.LONG_COL_NAMES if col in read_columns]
+
+        units = self._units
+        station_keys = self._station_keys()
+        if station_keys is not None:
+            station_units = list(station_keys.get_level_values('UNIT').unique())
+            units = station_units if units is None else [unit for unit in units if unit in station_units]
+        if units is not None and 'UNIT' not in read_columns:
+            read_columns = [col for col in get_data.LONG_COL_NAMES if col in read_columns + ['UNIT']]
+
+        return {'weeks': self._weeks(pd.Timedelta(margin) if cumulative else pd.Timedelta(0)),
+                'read_columns': read_columns,
+                'filters': None if units is None else [('UNIT', 'in', units)],
+                'station_keys': station_keys,
+                'datetime': datetime, 'from_date': from_date, 'from_time': from_time,
+                'cumulative': cumulative, 'station_columns': station_columns}
+
+    def explain(self):
+        """Returns plan as text, see `plan`."""
+        plan = self.plan()
+        lines = [f"read {len(plan['weeks'])} weeks of {self.root_path} ({self.storage_backend}), "
+                 f"columns {plan['read_columns']}, filters {plan['filters']}"]
+        if plan['datetime']:
+            lines.append(f"datetime features (date={plan['from_date']}, time={plan['from_time']})")
+        if plan['cumulative']:
+            lines.append('relative counters')
+        if self._start is not None or self._end is not None:
+            lines.append(f'filter dates {self._start} .. {self._end}')
+        if plan['station_columns']:
+            lines.append(f"attach {plan['station_columns']}")
+        lines.append(f"select {self._columns or 'all'}")
+
+        return '\n'.join(lines)
+
+    def collect(self):
+        """Runs pipeline and returns table."""
+        plan = self.plan()
+        if not plan['weeks']:
+            return pd.DataFrame(columns=self._columns or plan['read_columns'])
+
+        df = storage.read_long_table(self.root_path, columns=plan['read_columns'], filters=plan['filters'],
+                                     weeks=plan['weeks'], backend=self.storage_backend)
+        df = df.drop(columns='WEEK', errors='ignore')
+        if plan['station_keys'] is not None:
+            keys = pd.MultiIndex.from_arrays([df['C/A'].astype(str), df['UNIT'].astype(str)])
+            df = df[keys.isin(plan['station_keys'])].reset_index(drop=True)
+
+        if plan['datetime']:
+            df = feature_generation.calc_features_from_datetime(df, from_date=plan['from_date'],
+                                                                from_time=plan['from_time'])
+        if plan['cumulative']:
+            df = feature_generation.calc_features_from_cumulative_records(df, max_diff=self.max_diff)
+
+        if self._start is not None:
+            df = df[df.AUDIT_DATE_TIME >= self._start]
+        if self._end is not None:
+            df = df[df.AUDIT_DATE_TIME < self._end + pd.Timedelta(days=1)]
+
+        if plan['station_columns']:
+            df = self.registry.attach(df.copy(), columns=plan['station_columns'])
+
+        return df if self._columns is None else df[self._columns]
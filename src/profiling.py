@@ -0,0 +1,214 @@
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import platform
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+RUN_REPORT_PATH = './data/interim/run_report.json'
+PROFILES_PATH = './data/interim/profiles'
+
+# finished stages of current run, see `get_run_report`
+_records = []
+# stages running now (nested stages are inside of outer ones)
+_active = []
+# stage profiler, see `enable_profiler`
+_profiler = {'factory': None, 'output_dir': PROFILES_PATH}
+
+def reset_peak_rss():
+    """Resets peak resident set size (VmHWM) of current process, so the next
+        `get_peak_rss_mb` call reports the peak of one stage only. Linux only, no-op elsewhere.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss_mb():
+    """Returns peak resident set size of current process in MB.
+        Reads VmHWM from /proc (resettable), falls back to `resource.getrusage` (lifetime peak).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    import resource
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def file_size(paths):
+    """Returns total size (bytes) of files and folders (recursively), missing paths count as 0.
+
+    Parameters
+    ----------
+    paths : str or list
+        path or list of paths
+    """
+    total = 0
+    for path in [paths] if isinstance(paths, str) else paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(folder, name)) for name in names)
+
+    return total
+
+def _cprofile(name, path):
+    """Default stage profiler: runs stage under cProfile and saves stats to `path` (see `pstats`)."""
+    import cProfile
+
+    @contextlib.contextmanager
+    def profile():
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+    return profile()
+
+def enable_profiler(output_dir=PROFILES_PATH, factory=None):
+    """Runs each outermost stage under profiler and saves its output to `output_dir/<stage>.prof`.
+
+    Parameters
+    ----------
+    output_dir : str
+        folder of profiler outputs
+    factory : callable or None
+        function (stage name, output path) -> context manager, runs stage under other profiler
+        (i.e. sampling profiler); if None - uses cProfile
+    """
+    _profiler['factory'] = factory or _cprofile
+    _profiler['output_dir'] = output_dir
+
+def disable_profiler():
+    _profiler['factory'] = None
+
+class StageStats(dict):
+    """Counters of one pipeline stage: wall and CPU time (s), peak RSS (MB), rows in/out/dropped,
+        bytes read/written, plus any extra counters set by the stage. Counters are added with `add`.
+    """
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self[key] = self.get(key, 0) + value
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """Measures pipeline stage, logs its counters and adds them to run report.
+        Yields `StageStats`, stage code adds its counters (rows, bytes) to it.
+        CPU time is of current process only (pool workers are not counted).
+
+        with profiling.stage('concat', files=len(files)) as stats:
+            ...
+            stats.add(rows_out=len(df), bytes_written=profiling.file_size(save_path))
+
+    Parameters
+    ----------
+    name : str
+        stage name, nested stages are named 'outer/inner'
+    info : dict
+        extra values saved with stage counters
+    """
+    full_name = f"{_active[-1]['stage']}/{name}" if _active else name
+    stats = StageStats(stage=full_name, **info)
+    profile = contextlib.nullcontext()
+    if _profiler['factory'] is not None and not _active:
+        os.makedirs(_profiler['output_dir'], exist_ok=True)
+        stats['profile_path'] = os.path.join(_profiler['output_dir'], f'{full_name}.prof')
+        profile = _profiler['factory'](full_name, stats['profile_path'])
+
+    if _active:
+        # reset below wipes peak outer stage reached so far, it is kept with peaks of inner stages
+        _active[-1]['_inner_peak_rss_mb'] = max(_active[-1].get('_inner_peak_rss_mb', 0.), get_peak_rss_mb())
+    _active.append(stats)
+    reset_peak_rss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        with profile:
+            yield stats
+    except Exception as error:
+        stats['error'] = repr(error)
+        raise
+    finally:
+        stats['wall_s'] = round(time.perf_counter() - wall_start, 4)
+        stats['cpu_s'] = round(time.process_time() - cpu_start, 4)
+        # nested stages reset peak, so outer stage takes max of its own peak (since the last inner stage)
+        # and peaks kept before and during inner stages
+        stats['peak_rss_mb'] = round(max(get_peak_rss_mb(), stats.pop('_inner_peak_rss_mb', 0.)), 1)
+        _active.pop()
+        if _active:
+            _active[-1]['_inner_peak_rss_mb'] = max(_active[-1].get('_inner_peak_rss_mb', 0.), stats['peak_rss_mb'])
+
+        _records.append(dict(stats))
+        logger.info('stage ' + ' '.join(f'{key}={value}' for key, value in stats.items()),
+                    extra={'stage_stats': dict(stats)})
+
+def _n_rows(value):
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+def instrument(name):
+    """Decorator, runs function as pipeline stage (see `stage`). Rows in and out are counted
+        if first argument and result are tables; function can add other counters with `current_stage`.
+
+    Parameters
+    ----------
+    name : str
+        stage name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as stats:
+                if args and _n_rows(args[0]) is not None:
+                    stats.add(rows_in=_n_rows(args[0]))
+                result = func(*args, **kwargs)
+                if _n_rows(result) is not None:
+                    stats.add(rows_out=_n_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+def current_stage():
+    """Returns `StageStats` of innermost running stage, or empty stats (not recorded) outside of stages."""
+    return _active[-1] if _active else StageStats()
+
+def get_run_report():
+    """Returns finished stages of current run as table, one row per stage (inner stages first)."""
+    return pd.DataFrame(_records)
+
+def reset_run_report():
+    _records.clear()
+
+def save_run_report(path=RUN_REPORT_PATH):
+    """Saves run report (machine info and counters of finished stages) to json file, returns the path.
+
+    Parameters
+    ----------
+    path : str
+        path to json file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    report = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'pandas': pd.__version__, 'cpu_count': os.cpu_count(), 'stages': _records}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    return path
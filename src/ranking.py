@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from src import aggregates
+
+def station_week_matrix(df, metric='BUSYNESS'):
+    """Returns weekly totals as station x week table (weeks start on Monday).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table with relative counters, or `station_week` cube (see `aggregates.load_cube`)
+    metric : str
+        metric to sum, i.e. 'BUSYNESS', 'ENTRIES_DIFF'
+    """
+    if 'PERIOD' not in df.columns:
+        df = aggregates.build_cubes(df, ['station_week'])['station_week']
+
+    return aggregates.to_wide(df, metric)
+
+def rolling_means(values, window):
+    """Rolling mean along weeks for all stations at once (NaN until `window` weeks, empty weeks count as 0).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        station x week matrix
+    window : int
+        number of weeks
+    """
+    cumsum = np.cumsum(np.nan_to_num(values), axis=1)
+    result = np.full(values.shape, np.nan)
+    result[:, window - 1:] = cumsum[:, window - 1:]
+    result[:, window:] -= cumsum[:, :-window]
+
+    return result / window
+
+def pct_changes(values):
+    """Week to week relative change for all stations at once, NaN for first week and empty previous week."""
+    result = np.full(values.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result[:, 1:] = values[:, 1:] / values[:, :-1] - 1
+
+    return np.where(np.isfinite(result), result, np.nan)
+
+def trend_stats(df_matrix):
+    """Computes growth/decline statistics for every station on station x week matrix, without loops:
+
+        * TOTAL - sum over weeks, N_WEEKS - weeks with data
+        * CHANGE - relative change of last week with data against first week with data
+        * MEAN_PCT_CHANGE - mean week to week relative change
+        * SLOPE - least squares trend per week, REL_SLOPE - trend relative to mean weekly value
+
+    Parameters
+    ----------
+    df_matrix : pd.DataFrame
+        station x week table, see `station_week_matrix`
+    """
+    values = df_matrix.to_numpy(dtype='float64')
+    valid = ~np.isnan(values)
+    n_weeks = valid.sum(axis=1)
+    rows = np.arange(len(values))
+
+    first = values[rows, np.argmax(valid, axis=1)]
+    last = values[rows, values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)]
+
+    # least squares slope over weeks with data
+    weeks = np.where(valid, np.arange(values.shape[1]), 0.)
+    y = np.where(valid, values, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_week = weeks.sum(axis=1) / n_weeks
+        mean_value = y.sum(axis=1) / n_weeks
+        dx = np.where(valid, weeks - mean_week[:, None], 0.)
+        slope = (dx * (y - mean_value[:, None])).sum(axis=1) / (dx ** 2).sum(axis=1)
+        change = (last - first) / first
+        rel_slope = slope / mean_value
+
+        pct = pct_changes(values)
+        mean_pct = np.nansum(pct, axis=1) / (~np.isnan(pct)).sum(axis=1)
+
+    df_stats = pd.DataFrame({'TOTAL': y.sum(axis=1), 'N_WEEKS': n_weeks, 'CHANGE': change,
+                             'MEAN_PCT_CHANGE': mean_pct, 'SLOPE': slope, 'REL_SLOPE': rel_slope},
+                            index=df_matrix.index)
+
+    return df_stats.replace([np.inf, -np.inf], np.nan)
+
+def rank_stations(df_matrix, n=10, by='CHANGE', windows=(2, 3), min_weeks=2):
+    """Ranks stations by growth/decline (question DA4) and prepares series of ranked stations for plotting.
+        Returns ranked values (top `n` growth, then top `n` decline, as pd.Series) and dict of
+        station x week tables of ranked stations: 'totals', 'rolling' ({window: table}), 'pct_change'.
+        Ready for `visualisations.plot_panel_bars_station_change`.
+        Partial first and last weeks of data skew CHANGE, drop them from matrix before ranking.
+
+    Parameters
+    ----------
+    df_matrix : pd.DataFrame
+        station x week table, see `station_week_matrix`
+    n : int
+        number of stations of each direction
+    by : str
+        statistic to rank by, see `trend_stats`, i.e. 'CHANGE', 'REL_SLOPE'
+    windows : tuple
+        windows (weeks) of rolling means
+    min_weeks : int
+        stations with less weeks of data are not ranked
+    """
+    df_stats = trend_stats(df_matrix)
+    ranked = df_stats.loc[df_stats.N_WEEKS >= min_weeks, by].dropna().sort_values()
+    ranked = pd.concat([ranked.tail(n)[::-1], ranked.head(n)])
+    ranked = ranked[~ranked.index.duplicated()]
+
+    df_totals = df_matrix.loc[ranked.index]
+    values = df_totals.to_numpy(dtype='float64')
+    series = {'totals': df_totals,
+              'rolling': {window: pd.DataFrame(rolling_means(values, window), index=df_totals.index,
+                                               columns=df_totals.columns) for window in windows},
+              'pct_change': pd.DataFrame(pct_changes(values), index=df_totals.index, columns=df_totals.columns)}
+
+    return ranked, series
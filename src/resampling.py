@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from src.feature_generation import DEVICE_COLS
+
+HOUR = np.timedelta64(1, 'h').astype('timedelta64[ns]').astype('int64')
+
+def _device_index(df):
+    """Returns integer code of device for each row and table of devices (row of grid per device).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table with device columns
+    """
+    grouped = df.groupby(DEVICE_COLS, observed=True, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    devices = grouped.size().reset_index()[DEVICE_COLS]
+    if 'Station' in df.columns:
+        devices['Station'] = grouped.Station.first().to_numpy()
+
+    return codes, devices
+
+def _split_intervals(start, end, max_interval_hours):
+    """Splits audit intervals (start, end] to pieces by hour buckets, fully vectorized.
+        Returns index of interval, index of hour bucket (hours since epoch) and length of piece (ns).
+
+    Parameters
+    ----------
+    start : np.ndarray
+        start of intervals (int64 ns)
+    end : np.ndarray
+        end of intervals (int64 ns)
+    max_interval_hours : int
+        intervals longer than this are skipped (their relative counters are unreliable)
+    """
+    valid = (end > start) & (end - start <= max_interval_hours * HOUR)
+    rows = np.flatnonzero(valid)
+    start, end = start[valid], end[valid]
+
+    first_bucket = start // HOUR
+    n_buckets = (end - 1) // HOUR - first_bucket + 1
+
+    # row i is repeated n_buckets[i] times, offsets 0..n_buckets[i]-1 within each row
+    piece_rows = np.repeat(np.arange(len(rows)), n_buckets)
+    offsets = np.arange(len(piece_rows)) - np.repeat(np.cumsum(n_buckets) - n_buckets, n_buckets)
+    buckets = first_bucket[piece_rows] + offsets
+
+    piece_start = np.maximum(start[piece_rows], buckets * HOUR)
+    piece_end = np.minimum(end[piece_rows], (buckets + 1) * HOUR)
+
+    return rows[piece_rows], buckets, piece_end - piece_start
+
+def _hour_of_week(buckets):
+    """Returns hour of week (0 - Monday 00:00) of hour buckets (hours since epoch, 1970-01-01 is Thursday)."""
+    return (buckets + 3 * 24) % (7 * 24)
+
+def redistribute_hourly(df, metric='ENTRIES_DIFF', weights=None, max_interval_hours=24):
+    """Spreads relative counters of audit intervals (~4 hours, staggered per device)
+        over hours covered by interval and returns regular device x hour grid.
+        Share of each hour is proportional to overlap of hour and interval (uniform),
+        multiplied by weight of hour of week if `weights` are given (see `learn_hourly_weights`).
+        Returns grid (np.ndarray float32, devices x hours), devices table (row of grid per device)
+        and hours (pd.DatetimeIndex, column of grid per hour).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table after `feature_generation.calc_features_from_cumulative_records` (requires TIME_DIFF)
+    metric : str
+        relative counter to spread, i.e. 'ENTRIES_DIFF', 'EXITS_DIFF', 'BUSYNESS'
+    weights : np.ndarray or None
+        168 weights of hours of week (Monday 00:00 first), None - uniform spread
+    max_interval_hours : int
+        intervals longer than this are skipped
+    """
+    values = df[metric].to_numpy(dtype='float64')
+    end = df.AUDIT_DATE_TIME.values.view('int64')
+    start = end - df.TIME_DIFF.values.view('int64')
+    # first audits of devices (no interval) and outliers are skipped
+    has_value = ~np.isnan(values) & ~np.isnat(df.TIME_DIFF.values)
+    start = np.where(has_value, start, end)
+
+    codes, devices = _device_index(df)
+    rows, buckets, lengths = _split_intervals(start, end, max_interval_hours)
+
+    shares = lengths.astype('float64')
+    if weights is not None:
+        shares *= np.asarray(weights, dtype='float64')[_hour_of_week(buckets)]
+    totals = np.bincount(rows, weights=shares, minlength=len(values))
+    shares /= np.where(totals[rows] > 0, totals[rows], 1.)
+
+    first_hour = buckets.min() if len(buckets) else 0
+    n_hours = int(buckets.max() - first_hour + 1) if len(buckets) else 0
+    cells = codes[rows].astype('int64') * n_hours + (buckets - first_hour)
+    grid = np.bincount(cells, weights=values[rows] * shares, minlength=len(devices) * n_hours)
+    grid = grid.reshape(len(devices), n_hours).astype('float32')
+
+    hours = pd.DatetimeIndex((first_hour + np.arange(n_hours)) * HOUR)
+
+    return grid, devices, hours
+
+def learn_hourly_weights(df, metric='ENTRIES_DIFF', n_iter=5, max_interval_hours=24):
+    """Learns relative weights of 168 hours of week from data itself (EM-like iterations):
+        spread counters with current weights, sum them by hour of week,
+        use normalized sums as new weights. Starts from uniform spread.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table with relative counters and TIME_DIFF
+    metric : str
+        relative counter to learn weights from
+    n_iter : int
+        number of iterations
+    max_interval_hours : int
+        intervals longer than this are skipped
+    """
+    weights = np.ones(7 * 24)
+    for _ in range(n_iter):
+        grid, devices, hours = redistribute_hourly(df, metric, weights, max_interval_hours)
+        hour_of_week = hours.dayofweek.values * 24 + hours.hour.values
+        totals = np.bincount(hour_of_week, weights=grid.sum(axis=0, dtype='float64'), minlength=7 * 24)
+        counts = np.bincount(hour_of_week, minlength=7 * 24)
+        weights = totals / np.maximum(counts, 1)
+        weights = np.where(weights > 0, weights / weights.mean(), 1e-3)
+
+    return weights
+
+def hourly_radii(grid, devices, hours, station=None, station_col='UNIT'):
+    """Returns 24 average hourly values (hour of day) for station or whole system,
+        ready for `visualisations.plot_clock_metric_hourly`.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        device x hour grid, see `redistribute_hourly`
+    devices : pd.DataFrame
+        devices table of grid
+    hours : pd.DatetimeIndex
+        hours of grid
+    station : str or None
+        station to select, None - all devices
+    station_col : str
+        column of devices table with station, 'UNIT' or 'Station'
+    """
+    rows = slice(None) if station is None else (devices[station_col] == station).to_numpy()
+    totals = grid[rows].sum(axis=0, dtype='float64')
+    n_days = np.bincount(hours.hour.values, minlength=24)
+
+    return np.bincount(hours.hour.values, weights=totals, minlength=24) / np.maximum(n_days, 1)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+# dtypes of audit table columns, columns missing in table are skipped
+AUDIT_DTYPES = {
+    # identifiers, few thousands unique values per tens of millions rows
+    'C/A': 'category', 'UNIT': 'category', 'SCP': 'category', 'DESC': 'category',
+    'DATE': 'category', 'TIME': 'category',
+    # cumulative counters ("odometer" readings) overflow int32
+    'ENTRIES': 'int64', 'EXITS': 'int64',
+    'AUDIT_DATE_TIME': 'datetime64[ns]',
+    # calendar features
+    'AUDIT_YEAR': 'int16', 'AUDIT_MONTH': 'int8', 'AUDIT_WEEK': 'int8', 'AUDIT_DOW': 'int8',
+    'AUDIT_HOUR': 'int8', 'AUDIT_MINUTE': 'int8', 'IS_WEEKEND': 'bool', 'IS_HOLIDAY': 'bool',
+    # relative counters between audits, empty values for first audit of device and for outliers
+    'ENTRIES_DIFF': 'float32', 'EXITS_DIFF': 'float32', 'BUSYNESS': 'float32',
+    'ENTRIES_FLAG': 'int8', 'EXITS_FLAG': 'int8', 'TIME_DIFF': 'timedelta64[ns]',
+    # station metadata, see `feature_generation.add_stations` and `feature_generation.add_coordinates`
+    'Station': 'category', 'Line Name': 'category', 'Division': 'category',
+    'Lat': 'float64', 'Lon': 'float64',
+}
+
+def apply_schema(df, drop_raw_datetime=False, report=False):
+    """Casts audit table columns to compact dtypes, see `AUDIT_DTYPES`.
+        Integer columns with empty values are kept as they are (cast would fail).
+        Table is returned as is (not copied) if all columns already have schema dtypes.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table
+    drop_raw_datetime : bool
+        if true - drops DATE and TIME text columns (requires AUDIT_DATE_TIME column)
+    report : bool
+        if true - prints memory report, see `memory_report`
+    """
+    df_before = df if report else None
+
+    if drop_raw_datetime and 'AUDIT_DATE_TIME' in df.columns:
+        df = df.drop(columns=['DATE', 'TIME'], errors='ignore')
+
+    dtypes = {}
+    for col, dtype in AUDIT_DTYPES.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype != 'category' and np.dtype(dtype).kind in 'iub' and df[col].isna().any():
+            continue
+        dtypes[col] = dtype
+    if dtypes:
+        df = df.astype(dtypes)
+
+    if report:
+        print(memory_report(df_before, df).to_string())
+
+    return df
+
+def memory_report(df_before, df_after):
+    """Returns table of memory usage (MB) of columns before and after dtypes conversion.
+
+    Parameters
+    ----------
+    df_before : pd.DataFrame
+        table before conversion
+    df_after : pd.DataFrame
+        table after conversion
+    """
+    before = df_before.memory_usage(deep=True, index=False) / 1024 ** 2
+    after = df_after.memory_usage(deep=True, index=False) / 1024 ** 2
+
+    df_report = pd.DataFrame({'dtype_before': df_before.dtypes.astype(str),
+                              'dtype_after': df_after.dtypes.astype(str),
+                              'mb_before': before, 'mb_after': after})
+    df_report.loc['TOTAL', ['mb_before', 'mb_after']] = before.sum(), after.sum()
+    df_report['ratio'] = df_report.mb_before / df_report.mb_after
+
+    return df_report.round(2)
@@ -0,0 +1,219 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_M = 6_371_000
+
+def station_points(registry, station_col='Station'):
+    """Returns one point per station (mean Lat/Lon of its booths), stations without coordinates are dropped.
+        Coordinates stay at station level, audit table only needs station column to join values.
+
+    Parameters
+    ----------
+    registry : stations.StationRegistry
+        registry with coordinates (geocoded dataset)
+    station_col : str
+        'Station' or 'UNIT'
+    """
+    df = registry.table.reset_index()[[station_col, 'Lat', 'Lon']].dropna()
+
+    return df.groupby(df[station_col].astype(str), sort=True)[['Lat', 'Lon']].mean()
+
+def _project(lat, lon, lat0):
+    """Projects coordinates to local plane (meters), equirectangular - precise enough within a city."""
+    lat, lon = np.radians(np.asarray(lat, dtype='float64')), np.radians(np.asarray(lon, dtype='float64'))
+    return np.column_stack([EARTH_RADIUS_M * lon * np.cos(np.radians(lat0)), EARTH_RADIUS_M * lat])
+
+class StationIndex:
+    """Spatial index of station points for batch queries (all query points at once).
+        Uses KD-tree of scipy if it is installed, otherwise vectorized distance matrix
+        computed by blocks of query points (fast enough for hundreds of stations).
+
+    Parameters
+    ----------
+    df_points : pd.DataFrame
+        station points with Lat and Lon columns, indexed by station, see `station_points`
+    block_size : int
+        query points per block of distance matrix (without scipy)
+    """
+
+    def __init__(self, df_points, block_size=4096):
+        self.stations = df_points.index
+        self.lat0 = float(df_points.Lat.mean())
+        xy = _project(df_points.Lat.values, df_points.Lon.values, self.lat0)
+        # centered coordinates keep distances precise in `_distances`
+        self.origin = xy.mean(axis=0)
+        self.xy = xy - self.origin
+        self.block_size = block_size
+        try:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.xy)
+        except ImportError:
+            self.tree = None
+
+    def _query_xy(self, lat, lon):
+        return _project(np.atleast_1d(lat), np.atleast_1d(lon), self.lat0) - self.origin
+
+    def _distances(self, query):
+        """Yields (first row of block, distance matrix block x stations)."""
+        for start in range(0, len(query), self.block_size):
+            block = query[start:start + self.block_size]
+            # |a - b|^2 = |a|^2 + |b|^2 - 2ab, one matrix product instead of block x stations x 2 array
+            squared = (block ** 2).sum(axis=1)[:, None] + (self.xy ** 2).sum(axis=1)[None, :] - 2 * block @ self.xy.T
+            yield start, np.sqrt(np.maximum(squared, 0))
+
+    def nearest(self, lat, lon):
+        """Returns nearest station of each query point and distance to it (meters).
+
+        Parameters
+        ----------
+        lat : np.ndarray
+            latitudes of query points
+        lon : np.ndarray
+            longitudes of query points
+        """
+        query = self._query_xy(lat, lon)
+        if self.tree is not None:
+            distances, rows = self.tree.query(query)
+        else:
+            rows, distances = np.empty(len(query), dtype='int64'), np.empty(len(query))
+            for start, block in self._distances(query):
+                rows[start:start + len(block)] = block.argmin(axis=1)
+                distances[start:start + len(block)] = block[np.arange(len(block)), rows[start:start + len(block)]]
+
+        return pd.DataFrame({'STATION': self.stations[rows], 'DISTANCE_M': distances})
+
+    def within_radius(self, lat, lon, radius_m):
+        """Returns all (query point, station) pairs closer than `radius_m`: POINT (row of query point),
+            STATION_ROW (row of station in index), DISTANCE_M.
+
+        Parameters
+        ----------
+        lat : np.ndarray
+            latitudes of query points
+        lon : np.ndarray
+            longitudes of query points
+        radius_m : float
+            radius in meters
+        """
+        query = self._query_xy(lat, lon)
+        if self.tree is not None:
+            pairs = type(self.tree)(query).sparse_distance_matrix(self.tree, radius_m, output_type='ndarray')
+            points, rows, distances = pairs['i'], pairs['j'], pairs['v']
+        else:
+            points, rows, distances = [], [], []
+            for start, block in self._distances(query):
+                block_points, block_rows = np.nonzero(block <= radius_m)
+                points.append(block_points + start); rows.append(block_rows)
+                distances.append(block[block_points, block_rows])
+            points, rows, distances = np.concatenate(points), np.concatenate(rows), np.concatenate(distances)
+
+        order = np.lexsort([rows, points])
+        return pd.DataFrame({'POINT': points[order], 'STATION_ROW': rows[order], 'DISTANCE_M': distances[order]})
+
+    def sum_within_radius(self, values, lat, lon, radius_m):
+        """Sums station values (i.e. busyness) within `radius_m` of each query point.
+
+        Parameters
+        ----------
+        values : pd.Series
+            values indexed by station, missing stations count as 0
+        lat : np.ndarray
+            latitudes of query points
+        lon : np.ndarray
+            longitudes of query points
+        radius_m : float
+            radius in meters
+        """
+        pairs = self.within_radius(lat, lon, radius_m)
+        station_values = values.reindex(self.stations).fillna(0).to_numpy(dtype='float64')
+
+        return np.bincount(pairs.POINT, weights=station_values[pairs.STATION_ROW], minlength=len(np.atleast_1d(lat)))
+
+def read_polygons(path, name_property='name'):
+    """Reads polygons (i.e. boroughs, neighbourhoods) from local GeoJSON file or shapefile
+        (shapefile requires `pyshp` package). Returns list of (name, rings), ring is array of (lon, lat).
+
+    Parameters
+    ----------
+    path : str
+        path to .geojson / .json or .shp file
+    name_property : str
+        property (attribute) with polygon name
+    """
+    if os.path.splitext(path)[1].lower() == '.shp':
+        import shapefile
+        with shapefile.Reader(path) as reader:
+            polygons = []
+            for record in reader.shapeRecords():
+                parts = list(record.shape.parts) + [len(record.shape.points)]
+                points = np.asarray(record.shape.points, dtype='float64')
+                rings = [points[start:end] for start, end in zip(parts[:-1], parts[1:])]
+                polygons.append((record.record.as_dict()[name_property], rings))
+        return polygons
+
+    with open(path) as f:
+        features = json.load(f)['features']
+
+    polygons = []
+    for feature in features:
+        geometry = feature['geometry']
+        shapes = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        rings = [np.asarray(ring, dtype='float64')[:, :2] for shape in shapes for ring in shape]
+        polygons.append((feature['properties'][name_property], rings))
+
+    return polygons
+
+def points_in_polygons(lat, lon, polygons):
+    """Returns row of polygon containing each point (first match), -1 if none.
+        Ray casting vectorized over points, even-odd rule over all rings (holes are excluded),
+        bounding box of polygon filters points first.
+
+    Parameters
+    ----------
+    lat : np.ndarray
+        latitudes of points
+    lon : np.ndarray
+        longitudes of points
+    polygons : list
+        list of (name, rings), see `read_polygons`
+    """
+    lat, lon = np.asarray(lat, dtype='float64'), np.asarray(lon, dtype='float64')
+    result = np.full(len(lat), -1, dtype='int64')
+
+    for indx, (name, rings) in enumerate(polygons):
+        vertices = np.concatenate(rings)
+        candidates = np.flatnonzero((result < 0) & (lon >= vertices[:, 0].min()) & (lon <= vertices[:, 0].max())
+                                    & (lat >= vertices[:, 1].min()) & (lat <= vertices[:, 1].max()))
+        x, y = lon[candidates, None], lat[candidates, None]
+        inside = np.zeros(len(candidates), dtype=bool)
+        for ring in rings:
+            x1, y1 = ring[:, 0], ring[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            crosses = (y1 > y) != (y2 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= (np.count_nonzero(crosses & (x < x_cross), axis=1) % 2).astype(bool)
+        result[candidates[inside]] = indx
+
+    return result
+
+def rollup_by_polygons(values, df_points, polygons):
+    """Sums station values by polygons containing stations (i.e. busyness by borough).
+
+    Parameters
+    ----------
+    values : pd.Series
+        values indexed by station
+    df_points : pd.DataFrame
+        station points, see `station_points`
+    polygons : list
+        list of (name, rings), see `read_polygons`
+    """
+    df_points = df_points.reindex(values.index).dropna()
+    rows = points_in_polygons(df_points.Lat.values, df_points.Lon.values, polygons)
+    names = np.array([name for name, _ in polygons] + [None], dtype=object)
+
+    return values.loc[df_points.index].groupby(names[rows], dropna=True).sum()
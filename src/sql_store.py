@@ -0,0 +1,206 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+SQL_STORE_PATH = './data/processed/turnstile.sqlite'
+SQL_INDEXES = {'idx_audits_station_date': ['STATION', 'AUDIT_DATE'],
+               'idx_audits_device': ['CA', 'UNIT', 'SCP', 'AUDIT_DATE_TIME'],
+               'idx_audits_date': ['AUDIT_DATE']}
+
+def connect(path=SQL_STORE_PATH, engine='sqlite'):
+    """Opens (creates) local embedded database.
+
+    Parameters
+    ----------
+    path : str
+        path to database file
+    engine : str
+        'sqlite' (standard library) or 'duckdb' (optional package)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if engine == 'duckdb':
+        import duckdb
+        return duckdb.connect(path)
+
+    return sqlite3.connect(path)
+
+def _is_duckdb(con):
+    # module is 'duckdb' or '_duckdb' depending on version
+    return 'duckdb' in type(con).__module__
+
+def _to_sql_table(df):
+    """Converts audit table (after feature generation) to flat table of sql store:
+        text identifiers, STATION (station name if joined, otherwise UNIT), ISO date and time,
+        time difference in seconds.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table with AUDIT_DATE_TIME and relative counters
+    """
+    table = pd.DataFrame({'CA': df['C/A'].astype(str), 'UNIT': df['UNIT'].astype(str), 'SCP': df['SCP'].astype(str)})
+    table['STATION'] = (df['Station'] if 'Station' in df.columns else df['UNIT']).astype(str)
+    table['DESC'] = df['DESC'].astype(str)
+    table['AUDIT_DATE_TIME'] = df.AUDIT_DATE_TIME.dt.strftime('%Y-%m-%d %H:%M:%S')
+    table['AUDIT_DATE'] = df.AUDIT_DATE_TIME.dt.strftime('%Y-%m-%d')
+    table['AUDIT_HOUR'] = df.AUDIT_DATE_TIME.dt.hour.astype('int64')
+    for col in ['ENTRIES', 'EXITS', 'ENTRIES_DIFF', 'EXITS_DIFF', 'BUSYNESS']:
+        if col in df.columns:
+            table[col] = df[col].astype('float64' if col.endswith(('_DIFF', 'BUSYNESS')) else 'int64')
+    if 'TIME_DIFF' in df.columns:
+        table['TIME_DIFF_S'] = df.TIME_DIFF.dt.total_seconds()
+
+    return table.reset_index(drop=True)
+
+def _write(con, df, table, replace=False):
+    """Writes table to database (appends rows or replaces table)."""
+    if not _is_duckdb(con):
+        df.to_sql(table, con, if_exists='replace' if replace else 'append', index=False, chunksize=100_000)
+        return
+
+    con.register('_df_to_write', df)
+    if replace:
+        con.execute(f'DROP TABLE IF EXISTS {table}')
+    con.execute(f'CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM _df_to_write LIMIT 0')
+    con.execute(f'INSERT INTO {table} SELECT * FROM _df_to_write')
+    con.unregister('_df_to_write')
+
+def load_audits(con, df, replace=False):
+    """Loads audit table (after feature generation) to `audits` table of database and creates indexes
+        on station and date, device and time, date.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection, see `connect`
+    df : pd.DataFrame
+        audit table with AUDIT_DATE_TIME and relative counters
+    replace : bool
+        if true - replaces table, if false - appends rows
+    """
+    _write(con, _to_sql_table(df), 'audits', replace=replace)
+    for name, cols in SQL_INDEXES.items():
+        con.execute(f'CREATE INDEX IF NOT EXISTS {name} ON audits ({", ".join(cols)})')
+    con.commit()
+
+def load_stations(con, registry):
+    """Loads station metadata (see `stations.StationRegistry`) to `stations` table of database.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection, see `connect`
+    registry : stations.StationRegistry
+        station registry
+    """
+    df = registry.table.reset_index().rename(columns={'C/A': 'CA', 'Station': 'STATION', 'Line Name': 'LINE_NAME',
+                                                      'Division': 'DIVISION', 'Lat': 'LAT', 'Lon': 'LON'})
+    df = df.astype({col: str for col in df.columns if col not in ('LAT', 'LON')})
+    _write(con, df, 'stations', replace=True)
+    con.execute('CREATE INDEX IF NOT EXISTS idx_stations_key ON stations (CA, UNIT)')
+    con.commit()
+
+def query(con, sql, params=()):
+    """Runs sql query and returns result as pd.DataFrame.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection, see `connect`
+    sql : str
+        query with `?` placeholders
+    params : tuple
+        values of placeholders
+    """
+    if _is_duckdb(con):
+        return con.execute(sql, list(params)).df()
+
+    return pd.read_sql_query(sql, con, params=params)
+
+def system_totals(con, date):
+    """Total entries & exits across the subway system for date (question DA2).
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection
+    date : str
+        date, i.e. '2013-02-01'
+    """
+    return query(con, 'SELECT SUM(ENTRIES_DIFF) AS ENTRIES, SUM(EXITS_DIFF) AS EXITS '
+                      'FROM audits WHERE AUDIT_DATE = ?', (date,))
+
+def daily_totals(con, start, end, station=None):
+    """Daily total entries, exits & busyness across the system or for station (questions VIZ2, VIZ4).
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection
+    start : str
+        first date, i.e. '2013-01-01'
+    end : str
+        last date (included), i.e. '2013-03-31'
+    station : str or None
+        station, None - whole system
+    """
+    where, params = 'AUDIT_DATE BETWEEN ? AND ?', (start, end)
+    if station is not None:
+        where, params = where + ' AND STATION = ?', params + (station,)
+
+    return query(con, 'SELECT AUDIT_DATE, SUM(ENTRIES_DIFF) AS ENTRIES, SUM(EXITS_DIFF) AS EXITS, '
+                      f'SUM(BUSYNESS) AS BUSYNESS FROM audits WHERE {where} '
+                      'GROUP BY AUDIT_DATE ORDER BY AUDIT_DATE', params)
+
+def busiest_hours(con, station, start=None, end=None):
+    """Total busyness by hour of audit for station, busiest first (question DA5).
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection
+    station : str
+        station, i.e. 'CANAL ST'
+    start : str or None
+        first date
+    end : str or None
+        last date (included)
+    """
+    where, params = 'STATION = ?', (station,)
+    if start is not None:
+        where, params = where + ' AND AUDIT_DATE >= ?', params + (start,)
+    if end is not None:
+        where, params = where + ' AND AUDIT_DATE <= ?', params + (end,)
+
+    return query(con, f'SELECT AUDIT_HOUR, SUM(BUSYNESS) AS BUSYNESS FROM audits WHERE {where} '
+                      'GROUP BY AUDIT_HOUR ORDER BY BUSYNESS DESC', params)
+
+def station_weekly_change(con, n=10):
+    """Change of weekly busyness between first and last full week of data by station (question DA4).
+        Returns top `n` stations with growth and top `n` with decline.
+        Weeks (starting on Monday) with less than 7 dates of data are dropped: data starts and ends
+        within weeks, partial first and last weeks skew the change (see `ranking.rank_stations`).
+
+    Parameters
+    ----------
+    con : sqlite3.Connection or duckdb.DuckDBPyConnection
+        database connection
+    n : int
+        number of stations of each direction
+    """
+    # daily totals are small, weeks (starting on Monday) are built from them without sql date functions
+    df = query(con, 'SELECT STATION, AUDIT_DATE, SUM(BUSYNESS) AS BUSYNESS FROM audits GROUP BY STATION, AUDIT_DATE')
+    dates = pd.to_datetime(df.AUDIT_DATE)
+    df['WEEK'] = dates - pd.to_timedelta(dates.dt.dayofweek, unit='D')
+    df_wide = df.pivot_table(index='STATION', columns='WEEK', values='BUSYNESS', aggfunc='sum').sort_index(axis=1)
+    n_dates = df.drop_duplicates('AUDIT_DATE').groupby('WEEK').size()
+    df_wide = df_wide.loc[:, n_dates.reindex(df_wide.columns).values >= 7]
+    if df_wide.shape[1] < 2:
+        return pd.Series(dtype='float64', name='CHANGE')
+
+    change = (df_wide.iloc[:, -1] - df_wide.iloc[:, 0]) / df_wide.iloc[:, 0].replace(0, np.nan)
+    change = change.dropna().sort_values()
+
+    return pd.concat([change[change > 0].tail(n)[::-1], change[change < 0].head(n)]).rename('CHANGE')
@@ -0,0 +1,134 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+STATIONS_COLS = ['Station', 'Line Name', 'Division']
+COORDS_COLS = ['Lat', 'Lon']
+# columns of geocoded dataset (no header in file)
+COORDS_FILE_COLS = ['UNIT', 'C/A', 'Station', 'Line Name', 'Division', 'Lat', 'Lon']
+
+@functools.lru_cache(maxsize=8)
+def _read_lookup(path, mtime, kind):
+    """Reads lookup dataset once per file version (path, modification time).
+        Returns table indexed by (C/A, UNIT) with unique keys (first row of duplicated keys is kept).
+
+    Parameters
+    ----------
+    path : str
+        path to lookup file
+    mtime : float
+        modification time of file, part of cache key
+    kind : str
+        'stations' - station dataset (Booth, Remote, Station, Line Name, Division),
+        'coords' - geocoded dataset (no header, see `COORDS_FILE_COLS`)
+    """
+    if kind == 'stations':
+        df = pd.read_csv(path).rename(columns={'Booth': 'C/A', 'Remote': 'UNIT'})
+        df = df[['C/A', 'UNIT'] + STATIONS_COLS]
+    else:
+        df = pd.read_csv(path, header=None, names=COORDS_FILE_COLS)[['C/A', 'UNIT'] + COORDS_COLS]
+
+    return df.drop_duplicates(['C/A', 'UNIT']).set_index(['C/A', 'UNIT'])
+
+def _codes_and_uniques(series):
+    """Returns integer codes of series and its unique values (categories are reused)."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy().astype('int64'), series.cat.categories
+
+    codes, uniques = pd.factorize(series)
+    return codes.astype('int64'), uniques
+
+class StationRegistry:
+    """Station metadata (station, line, division, coordinates) keyed by (C/A, UNIT).
+        Lookup files are read once and cached. Each (C/A, UNIT) gets compact integer code -
+        row of registry table; attributes are attached to audit table by array lookup on codes,
+        without merging (copying) the audit table.
+
+    Parameters
+    ----------
+    path_to_stations_dataset : str or None
+        path to station dataset (Booth, Remote, Station, Line Name, Division)
+    path_to_stations_coords : str or None
+        path to geocoded dataset, see `COORDS_FILE_COLS`
+    """
+
+    def __init__(self, path_to_stations_dataset=None, path_to_stations_coords=None):
+        tables = []
+        if path_to_stations_dataset is not None:
+            tables.append(self._load(path_to_stations_dataset, 'stations'))
+        if path_to_stations_coords is not None:
+            coords = self._load(path_to_stations_coords, 'coords')
+            # station names are taken from station dataset if both are given
+            tables.append(coords[COORDS_COLS] if tables else coords)
+
+        table = pd.concat(tables, axis=1, join='outer') if tables else pd.DataFrame(
+            index=pd.MultiIndex.from_arrays([[], []], names=['C/A', 'UNIT']))
+        self.table = table.astype({col: 'category' for col in STATIONS_COLS if col in table.columns})
+
+    @staticmethod
+    def _load(path, kind):
+        return _read_lookup(os.path.abspath(path), os.path.getmtime(path), kind)
+
+    @property
+    def columns(self):
+        return list(self.table.columns)
+
+    def codes(self, df):
+        """Returns registry code (row of registry table) of each row of audit table, -1 if not found.
+            Strings are compared only for unique (C/A, UNIT) pairs, not for each row.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            audit table with C/A and UNIT columns
+        """
+        ca_codes, ca_uniques = _codes_and_uniques(df['C/A'])
+        unit_codes, unit_uniques = _codes_and_uniques(df['UNIT'])
+
+        # shift codes by one, so empty values (-1) get their own pair
+        n_units = len(unit_uniques) + 1
+        pairs, inverse = np.unique((ca_codes + 1) * n_units + unit_codes + 1, return_inverse=True)
+        pair_ca, pair_unit = np.divmod(pairs, n_units)
+        pair_ca, pair_unit = pair_ca - 1, pair_unit - 1
+
+        keys = pd.MultiIndex.from_arrays([np.asarray(ca_uniques, dtype=object)[pair_ca],
+                                          np.asarray(unit_uniques, dtype=object)[pair_unit]])
+        pair_registry_codes = self.table.index.get_indexer(keys)
+        pair_registry_codes[(pair_ca < 0) | (pair_unit < 0)] = -1
+
+        return pair_registry_codes[inverse.ravel()]
+
+    def attribute(self, codes, column):
+        """Returns attribute of registry for codes, categorical columns are built from codes (no strings copy).
+
+        Parameters
+        ----------
+        codes : np.ndarray
+            registry codes, see `codes`
+        column : str
+            registry column, i.e. 'Station', 'Lat'
+        """
+        values = self.table[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            attribute_codes = np.append(values.cat.codes.to_numpy(), -1)[codes]
+            return pd.Categorical.from_codes(attribute_codes, dtype=values.dtype)
+
+        return np.append(values.to_numpy(dtype='float64'), np.nan)[codes]
+
+    def attach(self, df, columns=None):
+        """Adds registry attributes as new columns of audit table (in place) and returns the table.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            audit table with C/A and UNIT columns
+        columns : list or None
+            registry columns to add, if None - adds all
+        """
+        codes = self.codes(df)
+        for column in columns or self.columns:
+            df[column] = self.attribute(codes, column)
+
+        return df
@@ -0,0 +1,207 @@
+import os
+import re
+import shutil
+
+import pandas as pd
+
+from src import schema
+
+PARTITION_COLS = ['WEEK', 'UNIT']
+STORAGE_BACKENDS = ('csv', 'parquet')
+
+def week_from_path(path):
+    """Returns week id (i.e. '130105', Saturday date as in MTA file names) from file path.
+
+    Parameters
+    ----------
+    path : str
+        path to raw or interim file, i.e. './data/raw/turnstile_130105.txt'
+    """
+    found = re.findall(r'(\d{6})', os.path.basename(path))
+    if not found:
+        raise ValueError(f'Can not find week id in file name: {path}')
+
+    return found[-1]
+
+def _check_backend(backend):
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f'Unknown storage backend: {backend}, expected one of {STORAGE_BACKENDS}')
+
+def to_typed_long_table(df):
+    """Casts long audit table columns to storage types, see `schema.AUDIT_DTYPES`.
+        Counters become int64 (rows with empty values are expected to be dropped before),
+        identifiers become categoricals (dictionary-encoded in parquet files).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        long audit table
+    """
+    return schema.apply_schema(df)
+
+def week_partition_path(root_path, week, backend='parquet'):
+    """Returns path where one week of long table is stored.
+
+    Parameters
+    ----------
+    root_path : str
+        folder of dataset, i.e. './data/interim/turnstile'
+    week : str
+        week id, i.e. '130105'
+    backend : str
+        'csv' - one csv file per week, 'parquet' - hive-partitioned dataset folder `WEEK=<week>`
+    """
+    _check_backend(backend)
+    if backend == 'csv':
+        return os.path.join(root_path, f'turnstile_{week}.csv')
+
+    return os.path.join(root_path, f'WEEK={week}')
+
+def remove_week(root_path, week, backend='parquet'):
+    """Removes stored week (if exists), so it could be rewritten without duplicated rows.
+
+    Parameters
+    ----------
+    root_path : str
+        folder of dataset
+    week : str
+        week id, i.e. '130105'
+    backend : str
+        storage backend, 'csv' or 'parquet'
+    """
+    path = week_partition_path(root_path, week, backend)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def write_long_table(df, root_path, week, backend='parquet', compression='zstd', append=False):
+    """Writes one week (or one chunk of week) of long audit table.
+        Returns path of written week.
+
+        * 'parquet' - typed, compressed columnar files partitioned by week and station unit,
+            `root_path/WEEK=130105/UNIT=R051/*.parquet`, no index column
+        * 'csv' - old text format, one file per week with index column
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        long audit table
+    root_path : str
+        folder of dataset, i.e. './data/interim/turnstile'
+    week : str
+        week id, i.e. '130105'
+    backend : str
+        storage backend, 'csv' or 'parquet'
+    compression : str
+        parquet compression codec, i.e. 'zstd', 'snappy', 'gzip'
+    append : bool
+        if true - adds rows to stored week, if false - replaces stored week
+    """
+    _check_backend(backend)
+    os.makedirs(root_path, exist_ok=True)
+    path = week_partition_path(root_path, week, backend)
+
+    if not append:
+        remove_week(root_path, week, backend)
+
+    if backend == 'csv':
+        df.to_csv(path, mode='a' if append else 'w', header=not append)
+        return path
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = to_typed_long_table(df)
+    df = df.assign(WEEK=week)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, root_path, partition_cols=PARTITION_COLS, compression=compression)
+
+    return path
+
+def _partitioning():
+    """Returns hive partitioning of parquet dataset with explicit types of partition keys,
+        otherwise week ids like '130105' are inferred as integers.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([('WEEK', pa.string()), ('UNIT', pa.string())]), flavor='hive')
+
+def read_long_table(root_path, columns=None, filters=None, weeks=None, backend='parquet'):
+    """Reads long audit table from storage.
+        Parquet reader pushes down columns and row filters, so only required
+        columns and partitions (weeks, units) are read from disk.
+
+    Parameters
+    ----------
+    root_path : str
+        folder of dataset, i.e. './data/interim/turnstile'
+    columns : list or None
+        columns to read, if None - reads all columns
+    filters : list or None
+        row filters in pyarrow format, i.e. [('UNIT', '=', 'R051'), ('ENTRIES', '>', 0)]
+    weeks : list or None
+        week ids to read, if None - reads all weeks
+    backend : str
+        storage backend, 'csv' or 'parquet'
+    """
+    _check_backend(backend)
+
+    if backend == 'csv':
+        if weeks is None:
+            weeks = list_weeks(root_path, backend)
+        df = pd.concat([pd.read_csv(week_partition_path(root_path, week, backend), index_col=0)
+                        for week in weeks], ignore_index=True)
+        if filters:
+            df = df[_filters_to_mask(df, filters)].reset_index(drop=True)
+        return df if columns is None else df[columns]
+
+    if weeks is not None:
+        filters = list(filters or []) + [('WEEK', 'in', list(weeks))]
+
+    df = pd.read_parquet(root_path, engine='pyarrow', columns=columns, filters=filters or None,
+                         partitioning=_partitioning())
+
+    return to_typed_long_table(df)
+
+def list_weeks(root_path, backend='parquet'):
+    """Returns sorted list of week ids stored in dataset.
+
+    Parameters
+    ----------
+    root_path : str
+        folder of dataset
+    backend : str
+        storage backend, 'csv' or 'parquet'
+    """
+    _check_backend(backend)
+    if not os.path.isdir(root_path):
+        return []
+
+    if backend == 'csv':
+        return sorted(week_from_path(name) for name in os.listdir(root_path)
+                      if re.fullmatch(r'turnstile_\d{6}\.csv', name))
+
+    return sorted(name.split('=', 1)[1] for name in os.listdir(root_path) if name.startswith('WEEK='))
+
+def _filters_to_mask(df, filters):
+    """Applies pyarrow-style filters [(column, op, value), ...] to pandas DataFrame.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        table to filter
+    filters : list
+        list of (column, op, value) tuples, combined with AND
+    """
+    ops = {'=': lambda s, v: s == v, '==': lambda s, v: s == v, '!=': lambda s, v: s != v,
+           '<': lambda s, v: s < v, '<=': lambda s, v: s <= v,
+           '>': lambda s, v: s > v, '>=': lambda s, v: s >= v,
+           'in': lambda s, v: s.isin(v), 'not in': lambda s, v: ~s.isin(v)}
+
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= ops[op](df[col], value)
+
+    return mask
@@ -0,0 +1,188 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import get_data
+
+# share of entries by hour of day, rush hours are busier
+HOURLY_PROFILE = np.array([1, 1, 1, 1, 2, 5, 9, 14, 16, 10, 7, 7, 8, 8, 8, 10, 13, 16, 14, 9, 6, 4, 3, 2], dtype='float64')
+# first file of new (long) layout
+LONG_LAYOUT_FROM = pd.Timestamp('2014-10-18')
+
+def _devices(n_devices, devices_per_station=8):
+    """Returns table of synthetic devices (C/A, UNIT, SCP), `devices_per_station` devices per booth and unit."""
+    station = np.arange(n_devices) // devices_per_station
+    return pd.DataFrame({'C/A': [f'A{code:03d}' for code in station],
+                         'UNIT': [f'R{code:03d}' for code in station],
+                         'SCP': [f'00-00-{code:02d}' for code in np.arange(n_devices) % devices_per_station]})
+
+def make_audits(n_devices=100, start_date='2013-01-05', n_weeks=4, audit_hours=4, reset_rate=0.01,
+                missing_rate=0.01, irregular_rate=0.01, reversed_rate=0.005, seed=0):
+    """Generates cumulative audit records of synthetic devices, one row per audit (long table
+        with `get_data.LONG_COL_NAMES` columns and AUDIT_DATE_TIME), ordered by device and time.
+        Devices are audited every `audit_hours` hours, staggered by device; entries and exits per hour
+        follow `HOURLY_PROFILE`. Anomalies are injected at given rates:
+
+        * counter resets - counter restarts from small value (share of audits)
+        * missing audits - audits are dropped (share of audits)
+        * irregular audits - audit time is shifted by random minutes, DESC is 'RECOVR AUD' (share of audits)
+        * reversed counters - counters of device run backwards (share of devices)
+
+    Parameters
+    ----------
+    n_devices : int
+        number of devices
+    start_date : str
+        first day of audits (Saturday, first day of weekly file)
+    n_weeks : int
+        number of weeks
+    audit_hours : int
+        hours between regular audits
+    reset_rate : float
+        share of audits with counter reset
+    missing_rate : float
+        share of missing audits
+    irregular_rate : float
+        share of irregular audits
+    reversed_rate : float
+        share of devices with reversed counters
+    seed : int
+        seed of random generator
+    """
+    rng = np.random.default_rng(seed)
+    n_slots = n_weeks * 7 * 24 // audit_hours
+    shape = (n_devices, n_slots)
+
+    # audit times: device offset (staggered audits) + regular slots
+    offsets = rng.integers(0, audit_hours, n_devices) * 3600
+    seconds = offsets[:, None] + np.arange(n_slots)[None, :] * audit_hours * 3600
+    is_irregular = rng.random(shape) < irregular_rate
+    seconds = seconds + np.where(is_irregular, rng.integers(1, 60 * audit_hours, shape) * 60, 0)
+
+    # counters: entries and exits per hour of day, scaled by busyness of device, summed up to audit times
+    # (interval gets traffic of hours it covers, audit within hour gets its share of the hour)
+    scale = rng.lognormal(0, 0.7, n_devices)[:, None]
+    n_hours = int(seconds.max() // 3600) + 1
+    hour, share = np.divmod(seconds, 3600)
+    rows = np.arange(n_devices)[:, None]
+    counters = {}
+    for col in ['ENTRIES', 'EXITS']:
+        hourly = rng.poisson(HOURLY_PROFILE[np.arange(n_hours) % 24] * scale).astype('int64')
+        # counts before each hour, then part of current hour
+        cumulative = np.cumsum(hourly, axis=1) - hourly
+        in_hour = np.floor(hourly[rows, hour] * share / 3600).astype('int64')
+        values = rng.integers(0, 5_000_000, n_devices)[:, None] + cumulative[rows, hour] + in_hour
+
+        resets = rng.random(shape) < reset_rate
+        if resets.any():
+            # counter drops to small value at reset and continues from there
+            # counters only grow, so max of earlier reset points is the last one (forward fill)
+            base = np.where(resets, values - rng.integers(0, 100, shape), 0)
+            values = values - np.maximum.accumulate(base, axis=1)
+
+        is_reversed = rng.random(n_devices) < reversed_rate
+        values[is_reversed] = 2 * values[is_reversed][:, :1] - values[is_reversed]
+        counters[col] = np.abs(values)
+
+    keep = rng.random(shape) >= missing_rate
+    device_rows, slots = np.nonzero(keep)
+    times = pd.Timestamp(start_date) + pd.to_timedelta(seconds[device_rows, slots], unit='s')
+
+    df = _devices(n_devices).iloc[device_rows].reset_index(drop=True)
+    df['DATE'] = times.strftime('%m-%d-%y')
+    df['TIME'] = times.strftime('%H:%M:%S')
+    df['DESC'] = np.where(is_irregular[device_rows, slots], 'RECOVR AUD', 'REGULAR')
+    df['ENTRIES'] = counters['ENTRIES'][device_rows, slots]
+    df['EXITS'] = counters['EXITS'][device_rows, slots]
+    df['AUDIT_DATE_TIME'] = times
+
+    return df
+
+def _to_wide(df):
+    """Packs long audits to pre-2014 wide rows (`get_data.COL_NAMES`), eight audits of device per row,
+        last row of device is not full (empty fields).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        long audits ordered by device and time
+    """
+    position = df.groupby(get_data.KEY_COL_NAMES, sort=False).cumcount().to_numpy()
+    df = df.assign(ROW=position // 8, SLOT=position % 8 + 1)
+    df_wide = df.pivot(index=get_data.KEY_COL_NAMES + ['ROW'], columns='SLOT', values=get_data.AUDIT_COL_NAMES)
+    df_wide.columns = [f'{col}{slot}' for col, slot in df_wide.columns]
+    df_wide = df_wide.reset_index().drop(columns='ROW')
+    # counters are integers, empty fields of last row are left blank
+    for col in df_wide.columns:
+        if col.startswith(('ENTRIES', 'EXITS')):
+            df_wide[col] = df_wide[col].astype('Int64')
+
+    return df_wide.reindex(columns=[col for col in get_data.COL_NAMES if col in df_wide.columns])
+
+def _to_long(df, stations):
+    """Formats long audits as post-2014 file (`get_data.RAW_LONG_COL_NAMES`, DATE as 'MM/DD/YYYY')."""
+    df = df.merge(stations, on=['C/A', 'UNIT'], how='left')
+    df['DATE'] = df.AUDIT_DATE_TIME.dt.strftime('%m/%d/%Y')
+
+    return df.rename(columns={'Station': 'STATION', 'Line Name': 'LINENAME', 'Division': 'DIVISION'}
+                     )[get_data.RAW_LONG_COL_NAMES]
+
+def make_stations(df):
+    """Returns synthetic station dataset (Booth, Remote, Station, Line Name, Division)
+        and geocoded dataset (`stations.COORDS_FILE_COLS`) of devices of audit table.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        audit table, see `make_audits`
+    """
+    df_stations = df[['C/A', 'UNIT']].drop_duplicates().reset_index(drop=True)
+    code = np.arange(len(df_stations))
+    df_stations['Station'] = [f'STATION {i}' for i in code]
+    df_stations['Line Name'] = np.array(['1', 'NQR', 'ACE', '456', 'L'])[code % 5]
+    df_stations['Division'] = np.array(['IRT', 'BMT', 'IND'])[code % 3]
+
+    df_coords = df_stations[['UNIT', 'C/A', 'Station', 'Line Name', 'Division']].copy()
+    rng = np.random.default_rng(len(df_stations))
+    df_coords['Lat'] = 40.70 + rng.random(len(df_stations)) * 0.15
+    df_coords['Lon'] = -74.02 + rng.random(len(df_stations)) * 0.15
+
+    return df_stations, df_coords
+
+def write_raw_files(raw_path, layout='auto', **kwargs):
+    """Generates synthetic audits (see `make_audits`) and saves them as weekly raw files
+        `turnstile_YYMMDD.txt`, in the same layout as files of data provider. File of Saturday holds
+        audits of the week before it. Also saves station datasets (`stations.csv`, `geocoded.csv`).
+        Returns list of raw files.
+
+    Parameters
+    ----------
+    raw_path : str
+        folder where to save files
+    layout : str
+        'wide' - pre-2014 files, 'long' - post-2014 files, 'auto' - by date of file (see `LONG_LAYOUT_FROM`)
+    kwargs : dict
+        parameters of `make_audits`
+    """
+    os.makedirs(raw_path, exist_ok=True)
+    df = make_audits(**kwargs)
+    df_stations, df_coords = make_stations(df)
+    df_stations.rename(columns={'C/A': 'Booth', 'UNIT': 'Remote'}).to_csv(os.path.join(raw_path, 'stations.csv'),
+                                                                        index=False)
+    df_coords.to_csv(os.path.join(raw_path, 'geocoded.csv'), index=False, header=False)
+
+    start = pd.Timestamp(kwargs.get('start_date', '2013-01-05'))
+    week = (df.AUDIT_DATE_TIME - start).dt.days // 7
+    files = []
+    for indx, df_week in df.groupby(week, sort=True):
+        file_date = start + pd.Timedelta(days=7 * (indx + 1))
+        path = os.path.join(raw_path, f'turnstile_{file_date:%y%m%d}.txt')
+        is_long = layout == 'long' or (layout == 'auto' and file_date >= LONG_LAYOUT_FROM)
+        if is_long:
+            _to_long(df_week, df_stations).to_csv(path, index=False)
+        else:
+            _to_wide(df_week).to_csv(path, index=False, header=False)
+        files.append(path)
+
+    return files
@@ -3,7 +3,7 @@ import matplotlib.pyplot as plt
 #import seaborn as sns
 #import july
 #import plotly.express as px
-# import numpy as np
+import numpy as np
 
 def _add_custom_text_units_per_stations(df_aux, axis):
     """Adds custom text with station names to top 5 stations number of units.
@@ -144,7 +144,59 @@ def plot_interactive_line_or_bar(df_aux, title, yaxis_label, xaxis_label, linepl
 
     fig.show()
 
-def plot_gradientplot_intervals(df_aux, fig, axis):
+def _quantile_sample(values, groups, max_points):
+    """Downsamples points to about `max_points` keeping distribution of each group:
+        points of group are sorted and taken at evenly spaced ranks (quantiles), min and max are kept.
+        Returns positions of kept points.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values of points
+    groups : np.ndarray
+        integer group of each point
+    max_points : int
+        approximate number of points to keep
+    """
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups)
+    starts = np.cumsum(counts) - counts
+    n_keep = np.minimum(counts, np.maximum(np.ceil(counts * max_points / len(values)), 2).astype('int64'))
+
+    # evenly spaced ranks within each group
+    group = np.repeat(np.arange(len(counts)), n_keep)
+    offset = np.arange(n_keep.sum()) - np.repeat(np.cumsum(n_keep) - n_keep, n_keep)
+    ranks = np.round(offset / np.maximum(n_keep[group] - 1, 1) * (counts[group] - 1)).astype('int64')
+
+    return order[starts[group] + ranks]
+
+def _density_offsets(values, groups, bins=50, seed=0):
+    """Returns random offsets (-1..1) scaled by density of points around each point within its group,
+        so dense areas are wide and sparse areas are thin (density strip, vectorized swarm alternative).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values of points
+    groups : np.ndarray
+        integer group of each point
+    bins : int
+        number of density bins per group
+    seed : int
+        seed of random offsets
+    """
+    n_groups = groups.max() + 1
+    lo = np.full(n_groups, np.inf); np.minimum.at(lo, groups, values)
+    hi = np.full(n_groups, -np.inf); np.maximum.at(hi, groups, values)
+    span = np.where(hi > lo, hi - lo, 1.)
+
+    cells = groups * bins + np.minimum(((values - lo[groups]) / span[groups] * bins).astype('int64'), bins - 1)
+    counts = np.bincount(cells, minlength=n_groups * bins).reshape(n_groups, bins)
+    density = counts.ravel()[cells] / counts.max(axis=1)[groups]
+
+    return np.random.default_rng(seed).uniform(-1, 1, len(values)) * density
+
+def plot_gradientplot_intervals(df_aux, fig, axis, max_points=5000):
     """Plots point estimation using gradient (intervals) plot.
 
         # Chart idea credits to Michael Friendly - Visualizing Uncertainty,
@@ -153,21 +205,27 @@ def plot_gradientplot_intervals(df_aux, fig, axis):
 
     Parameters
     ----------
-    df_jitter : pd.DataFrame
-        data table
+    df_aux : pd.Series or pd.DataFrame
+        daily values (one column), index levels AUDIT_MONTH (first) and IS_WEEKEND
     fig : matplotlib.pyplot.figure
         figure object to abjust legend & custom labels (coord are manually set now)
     axis : matplotlib.pyplot.axis
         axis object, where to plot
+    max_points : int or None
+        raw points above this number are downsampled by quantiles (see `_quantile_sample`),
+        None - plots all points; points are rasterized in any case
     """
+    values = df_aux.iloc[:, 0] if df_aux.ndim == 2 else df_aux
+    # all statistics in one pass
+    stats = values.groupby(level=['IS_WEEKEND', 'AUDIT_MONTH']).agg(['mean', 'std', 'max', 'min', 'size'])
+
     for indx, weekend_flag in enumerate([False, True]):
 
-        df_aux_tmp = df_aux.xs((weekend_flag), level=('IS_WEEKEND'))
-        inds = df_aux_tmp.index.get_level_values(0).unique().values - 1
-        mean_tmp = df_aux_tmp.groupby(['AUDIT_MONTH']).mean()
-        std_tmp = df_aux_tmp.groupby(['AUDIT_MONTH']).std()
-        max_tmp = df_aux_tmp.groupby(['AUDIT_MONTH']).max()
-        min_tmp = df_aux_tmp.groupby(['AUDIT_MONTH']).min()
+        df_aux_tmp = values.xs((weekend_flag), level=('IS_WEEKEND'))
+        stats_tmp = stats.xs(weekend_flag, level='IS_WEEKEND')
+        inds = stats_tmp.index.values - 1
+        mean_tmp, std_tmp = stats_tmp['mean'], stats_tmp['std']
+        max_tmp, min_tmp = stats_tmp['max'], stats_tmp['min']
 
         mean_marker = axis.scatter(inds + indx / 8, mean_tmp, marker='o', color='red', s=80,
                                 zorder=3, label = 'Mean value')
@@ -182,12 +240,18 @@ def plot_gradientplot_intervals(df_aux, fig, axis):
         min_marker = axis.scatter(x=inds + indx / 8, y=min_tmp, marker=6, color=marker_color, s=80,
                                 zorder=3, label = 'Min value')
 
-        points = axis.scatter(x=df_aux_tmp.index.get_level_values(0) - 1.1,
-                   y=df_aux_tmp.values, marker=1, alpha=0.6, # marker  1 if weekend_flag else 0
-                   linewidths=3, label='Weekend' if weekend_flag else 'Weekday')
+        months = df_aux_tmp.index.get_level_values(0).values.astype('int64')
+        points_x = months - 1.1
+        points_y = df_aux_tmp.values
+        if max_points is not None and len(points_y) > max_points:
+            # groups are months, not truncated x positions (January is at -0.1)
+            keep = _quantile_sample(points_y, months - months.min(), max_points)
+            points_x, points_y = points_x[keep], points_y[keep]
+        points = axis.scatter(x=points_x, y=points_y, marker=1, alpha=0.6, # marker  1 if weekend_flag else 0
+                   linewidths=3, label='Weekend' if weekend_flag else 'Weekday', rasterized=True)
 
         n_days_text = [axis.text(x, y, f'days={s}') for x, y, s in
-                    zip(inds + indx / 8 + 0.05, mean_tmp.values, df_aux_tmp.groupby('AUDIT_MONTH').size().values)]
+                    zip(inds + indx / 8 + 0.05, mean_tmp.values, stats_tmp['size'].values)]
 
     # Beautify
     axis.margins(y=0.1)
@@ -205,7 +269,7 @@ def plot_gradientplot_intervals(df_aux, fig, axis):
 
     return axis
 
-def plot_boxplot_jitter_mix(df_jitter, df_boxes, fig, axis):
+def plot_boxplot_jitter_mix(df_jitter, df_boxes, fig, axis, max_swarm_points=2000):
     """Plots a mix of boxplots and jittered scatterplot to show quantiles.
 
         Semantically it's a custom `Raincloud plot` without cloud
@@ -228,15 +292,30 @@ def plot_boxplot_jitter_mix(df_jitter, df_boxes, fig, axis):
         figure object to abjust custom labels (coord are manually set now)
     axis : matplotlib.pyplot.axis
         axis object, where to plot
+    max_swarm_points : int
+        above this number of points swarm (quadratic in number of points) is replaced by
+        density strip - jitter is proportional to density of points (see `_density_offsets`), rasterized
     """
     import seaborn as sns
 
-    jitter = sns.swarmplot(x='BUSYNESS', y='AUDIT_MONTH', hue='IS_WEEKEND',
-                  data=df_jitter,
-                  edgecolor="white",
-                  size=4, #jitter=0.1,
-                  zorder=0, orient='h',
-                  ax=axis)
+    if len(df_jitter) <= max_swarm_points:
+        jitter = sns.swarmplot(x='BUSYNESS', y='AUDIT_MONTH', hue='IS_WEEKEND',
+                      data=df_jitter,
+                      edgecolor="white",
+                      size=4, #jitter=0.1,
+                      zorder=0, orient='h',
+                      ax=axis)
+    else:
+        # same layout as swarm: one row per month (in sorted order), colors by weekend flag
+        months, rows = np.unique(df_jitter.AUDIT_MONTH.to_numpy(), return_inverse=True)
+        values = df_jitter.BUSYNESS.to_numpy(dtype='float64')
+        y = rows + 0.1 * _density_offsets(values, rows)
+        is_weekend = df_jitter.IS_WEEKEND.to_numpy(dtype=bool)
+        for color_indx, flag in enumerate([False, True]):
+            mask = is_weekend == flag
+            axis.scatter(values[mask], y[mask], s=4, color=f'C{color_indx}', zorder=0,
+                         label=str(flag), rasterized=True)
+        axis.invert_yaxis()
 
     weekend_weekday = axis.boxplot(x=df_boxes[:-3],
                  positions=[0.15, 0.20, 1.15, 1.20, 2.15, 2.20],
@@ -262,47 +341,52 @@ def plot_boxplot_jitter_mix(df_jitter, df_boxes, fig, axis):
 
     return axis
 
-def plot_panel_bars_station_change(df_aggregated, df_stations_change, fig, axes,
-                                   plot_MA=True, plot_pct_change=True):
-    """Plots a panel with mix of bar charts and line charts.
+def plot_panel_bars_station_change(df_totals, stations_change, fig, axes, rolling=None, pct_change=None):
+    """Plots a panel with mix of bar charts and line charts, one axis per station.
+        All series are precomputed for all stations at once (see `ranking.rank_stations`),
+        this function only draws them.
 
     * Question DA4. What stations have seen the most usage growth/decline in 2013?
 
     Parameters
     ----------
-    df_aggregated : pd.DataFrame or [container]
-        df with grouped (aggregated) numbers by station and date
-    df_stations_change : pd.DataFrame or [container]
-        df with usage changes and respective station names, better be sorted
+    df_totals : pd.DataFrame
+        weekly totals, station x week, i.e. `series['totals']` of `ranking.rank_stations`
+    stations_change : pd.Series
+        usage changes indexed by station names, better be sorted; one axis per station
     fig : matplotlib.pyplot.figure
         figure object
-    axis : matplotlib.pyplot.axis
-        axis object, where to plot
-    plot_MA : bool
-        if add moving average {windows = 1, 2, 3} lines to chart
-    plot_pct_change : bool
-        if add percent change lines to chart
+    axes : list of matplotlib.pyplot.axis
+        axis objects, where to plot
+    rolling : dict or None
+        moving averages {window: station x week table}, if given - adds moving average lines to chart
+    pct_change : pd.DataFrame or None
+        percent change, station x week, if given (and `rolling` is not) - adds percent change lines to chart
     """
-
-    for indx, (station_name, value) in enumerate(df_stations_change.iteritems()):
-
+    x = np.arange(df_totals.shape[1])
+    labels = [getattr(week, 'strftime', lambda fmt: str(week))('%Y-%m-%d') for week in df_totals.columns]
+    rows = df_totals.index.get_indexer(stations_change.index)
+    totals = df_totals.to_numpy(dtype='float64')
+    rolling = {window: df.to_numpy(dtype='float64') for window, df in (rolling or {}).items()}
+    pct_change = None if pct_change is None else pct_change.to_numpy(dtype='float64')
+
+    for indx, (station_name, value) in enumerate(stations_change.items()):
+        row = rows[indx]
         color = 'red' if value < 0 else 'green'
         alpha = 1. if abs(value) >= 1 else abs(value)
 
-        df_to_plot = df_aggregated.xs(station_name)
-        bars = df_to_plot.plot.bar(color='#009aa6', ax=axes[indx], label='Weekly totals')
+        axes[indx].bar(x, totals[row], color='#009aa6', label='Weekly totals')
 
-        if plot_MA:
-            for i in range(1, 3):
-                df_to_plot.rolling(i).mean().plot.line(ax=axes[indx], style='-', color=color, alpha=0.3,
-                                                        label='Moving Averages')
-        elif plot_pct_change:
+        if rolling:
+            for window, values in rolling.items():
+                axes[indx].plot(x, values[row], '-', color=color, alpha=0.3, label='Moving Averages')
+        elif pct_change is not None:
             # we may plot many options, and many rollings too
-            df_to_plot.pct_change(1).plot.line(ax=axes[indx], color=color, alpha=0.3,
-                                                label='Change rate', secondary_y=True)
+            axes[indx].twinx().plot(x, pct_change[row], color=color, alpha=0.3, label='Change rate')
 
-        axes[indx].set(#title=station_name + f', {round(value, 3)}', xticks=[],
-                        ymargin=0.1, xmargin=0.1)
+        axes[indx].set_xticks(x)
+        axes[indx].set_xticklabels(labels, rotation=90)
+        axes[indx].set(ymargin=0.1, xmargin=0.1)
         axes[indx].xaxis.set_tick_params(which='minor', bottom=False)
 
         axes[indx].grid(axis='y', linestyle='--', alpha=0.2, color='g', zorder=10)
@@ -313,7 +397,7 @@ def plot_panel_bars_station_change(df_aggregated, df_stations_change, fig, axes,
 
     return axes
 
-def plot_heatmap_calendar(df_aux, title, title_style_dict):
+def plot_heatmap_calendar(df_aux, title, title_style_dict, dpi=150):
     """Plots heatmap calendar chart.
 
     !!! `july` Chart package sets globals params which
@@ -333,10 +417,12 @@ def plot_heatmap_calendar(df_aux, title, title_style_dict):
         main title of a chart
     title_style_dict : dict
         dictionary with main (figure) title params
+    dpi : int
+        resolution of figure, render time grows with dpi squared; raise it (i.e. 350) for print quality
     """
     import july
 
-    fig, axes = plt.subplots(1, 3, figsize=(15, 5), dpi=350)
+    fig, axes = plt.subplots(1, 3, figsize=(15, 5), dpi=dpi)
 
     for indx in range(0, 3):
         july.month_plot(data=df_aux.values, dates=df_aux.index, month=indx + 1,
@@ -373,8 +459,8 @@ def plot_clock_metric_hourly(radii, color, title, axis):
 
     Parameters
     ----------
-    radii : type
-        placeholder
+    radii : np.ndarray
+        24 hourly values, i.e. from `resampling.hourly_radii`
     title :
         main title of a chart
     color :
@@ -383,8 +469,6 @@ def plot_clock_metric_hourly(radii, color, title, axis):
         axis object, where to plot
     ----------
     """
-    import numpy as np
-
     N = 24
     bottom = 2
 
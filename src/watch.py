@@ -0,0 +1,303 @@
+import glob
+import logging
+import os
+import time
+
+import pandas as pd
+import requests
+
+from src import aggregates
+from src import feature_generation
+from src import get_data
+from src import incremental
+from src import out_of_core
+from src import profiling
+from src import schema
+from src import storage
+
+logger = logging.getLogger(__name__)
+
+STATE_PATH = './data/interim/watch'
+INTERIM_PATH = './data/interim'
+PUBLISH_PATH = './data/processed/published'
+
+def load_state(state_path=STATE_PATH):
+    """Loads state of watch mode, returns empty state if there is no file yet.
+        State structure:
+            {'last_week': week id or None,
+             'weeks': {week: {'file', 'rows', 'detected_at', 'published_at', 'latency_s'}}}
+        Last audits of devices (seed of the next week) are kept next to it, see `_seed_file`.
+
+    Parameters
+    ----------
+    state_path : str
+        folder of watch state
+    """
+    path = os.path.join(state_path, 'state.json')
+    if not os.path.exists(path):
+        return {'last_week': None, 'weeks': {}}
+
+    return incremental.load_manifest(path)
+
+def _seed_file(state_path):
+    return os.path.join(state_path, 'seed.parquet')
+
+def _load_seed(state_path):
+    path = _seed_file(state_path)
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+def _week_date(week):
+    return pd.to_datetime(week, format='%y%m%d')
+
+def _settled_files(raw_path, settle_seconds):
+    """Returns raw files of folder not modified for `settle_seconds` (copying of file is finished)."""
+    now = time.time()
+    return sorted(file for file in glob.glob(os.path.join(raw_path, 'turnstile*.txt'))
+                  if now - os.path.getmtime(file) >= settle_seconds)
+
+def _published_links(base_url, last_week, start_date, timeout):
+    """Returns links of weekly files published on mirror after `last_week` (or from `start_date`) up to today.
+        Files are checked with HEAD requests, so not yet published files are not reported as failed downloads,
+        weeks are published in order, so checks stop at the first missing week.
+    """
+    if last_week is not None:
+        start = _week_date(last_week) + pd.Timedelta(days=1)
+    else:
+        start = pd.Timestamp(start_date) if start_date is not None else pd.Timestamp.today().normalize()
+    links = get_data._get_links_to_raw_data(start_date=start, end_date=pd.Timestamp.today(), base_url=base_url)
+
+    published = []
+    with requests.Session() as session:
+        for link in links:
+            try:
+                if not session.head(link, timeout=timeout, allow_redirects=True).ok:
+                    break
+                published.append(link)
+            except requests.exceptions.RequestException as error:
+                logger.warning('Mirror is not available: %s', error)
+                break
+
+    return published
+
+def find_new_files(source, state, raw_path='./data/raw', start_date=None, settle_seconds=5., timeout=10.):
+    """Returns raw files of weeks later than the last processed week, in order of weeks.
+        Earlier weeks found after later ones are skipped with warning, they need batch rebuild
+        (diff features of next weeks are seeded with audits of previous week).
+
+    Parameters
+    ----------
+    source : str
+        folder with raw files or url of http mirror (files are downloaded to `raw_path`)
+    state : dict
+        watch state, see `load_state`
+    raw_path : str
+        folder where to save files downloaded from mirror
+    start_date : str or None
+        first week to fetch from mirror when nothing is processed yet, i.e. '2013-01-05',
+        if None - only weeks published from today on
+    settle_seconds : float
+        files of folder modified more recently are not ready yet
+    timeout : float
+        timeout of requests to mirror in seconds
+    """
+    last_week = state['last_week']
+    if source.startswith(('http://', 'https://')):
+        links = _published_links(source, last_week, start_date, timeout)
+        files = get_data.download_raw_data(links, download=True, raw_path=raw_path) if links else []
+    else:
+        files = _settled_files(source, settle_seconds)
+
+    new_files = []
+    for file in sorted(files, key=storage.week_from_path):
+        week = storage.week_from_path(file)
+        if week in state['weeks']:
+            continue
+        if last_week is not None and week < last_week:
+            logger.warning('Week %s is earlier than processed week %s, skipped: %s', week, last_week, file)
+            continue
+        new_files.append(file)
+
+    return new_files
+
+def _drop_seen_audits(df, seed):
+    """Drops audits not later than the last audit of device in previous week (weekly files overlap),
+        so cubes do not count them twice.
+    """
+    if seed is None:
+        return df
+
+    seed = seed[feature_generation.DEVICE_COLS + ['AUDIT_DATE_TIME']].astype(
+        {col: str for col in feature_generation.DEVICE_COLS})
+    last_times = df[feature_generation.DEVICE_COLS].astype(str).merge(seed, on=feature_generation.DEVICE_COLS,
+                                                                      how='left').AUDIT_DATE_TIME.values
+    is_new = pd.isna(last_times) | (df.AUDIT_DATE_TIME.values > last_times)
+
+    return df[is_new].reset_index(drop=True)
+
+def process_week(file, seed=None, features_path=out_of_core.FEATURES_PATH, cube_path=aggregates.CUBE_PATH,
+                 storage_backend='csv', registry=None, max_diff=10000, interim_path=INTERIM_PATH):
+    """Runs pipeline for one new raw file: reshape to long table, datetime and diff features
+        (seeded with last audits of devices from previous week), optional station attributes,
+        features table of week and cubes of week (`aggregates.update_cubes`).
+        Returns features table of week and seed for the next week.
+
+    Parameters
+    ----------
+    file : str
+        raw file of week
+    seed : pd.DataFrame or None
+        last audits of devices from previous week, see `feature_generation.last_audits`
+    features_path : str
+        folder of feature tables, see `out_of_core.run_features_by_partition`
+    cube_path : str
+        folder of aggregate cubes
+    storage_backend : str
+        'csv' or 'parquet', see `storage.STORAGE_BACKENDS`
+    registry : stations.StationRegistry or None
+        station registry to attach station attributes (cubes are built by Station then)
+    max_diff : int
+        see `feature_generation.calc_features_from_cumulative_records`
+    interim_path : str
+        folder of long tables, watched folder holds source files only
+    """
+    week = storage.week_from_path(file)
+    long_path, = get_data.reorganize_raw_files([file], storage_backend=storage_backend, output_path=interim_path)
+    df = get_data._read_long_file(long_path, storage_backend)
+
+    df = feature_generation.calc_features_from_datetime(df)
+    df = _drop_seen_audits(df, seed)
+    df = feature_generation.calc_features_from_cumulative_records(df, max_diff=max_diff, seed=seed)
+    next_seed = feature_generation.last_audits(df if seed is None else pd.concat(
+        [seed, df[seed.columns]], ignore_index=True).astype({col: str for col in feature_generation.DEVICE_COLS}))
+    if registry is not None:
+        df = schema.apply_schema(registry.attach(df))
+
+    os.makedirs(features_path, exist_ok=True)
+    df.to_parquet(out_of_core._features_file(features_path, week), index=False, compression='zstd')
+    aggregates.update_cubes(df, week, cube_path)
+
+    return df, next_seed
+
+def publish_cubes(cube_path=aggregates.CUBE_PATH, publish_path=PUBLISH_PATH, cubes=None):
+    """Publishes refreshed cubes for dashboards: weeks are summed (see `aggregates.load_cube`)
+        and each cube is saved as one file `publish_path/<cube>.parquet`.
+        Files are replaced atomically, readers see either previous or new version.
+        Returns list of published files.
+
+    Parameters
+    ----------
+    cube_path : str
+        folder of aggregate cubes
+    publish_path : str
+        folder of published cubes
+    cubes : list or None
+        names of cubes to publish, see `aggregates.CUBES`, if None - publishes all
+    """
+    os.makedirs(publish_path, exist_ok=True)
+    published = []
+    for name in cubes or aggregates.CUBES:
+        path = os.path.join(publish_path, f'{name}.parquet')
+        aggregates.load_cube(name, cube_path).to_parquet(path + '.tmp', index=False, compression='zstd')
+        os.replace(path + '.tmp', path)
+        published.append(path)
+
+    return published
+
+def poll_once(source, state_path=STATE_PATH, raw_path='./data/raw', features_path=out_of_core.FEATURES_PATH,
+              cube_path=aggregates.CUBE_PATH, publish_path=PUBLISH_PATH, storage_backend='csv', registry=None,
+              max_diff=10000, start_date=None, settle_seconds=5., interim_path=INTERIM_PATH):
+    """Checks source once, processes new weeks in order (see `process_week`) and publishes
+        cubes if anything was processed. State and seed are saved after each week, so
+        interrupted run continues from the last processed week. Returns list of processed weeks.
+        Stages are recorded in run report, see `profiling.stage`.
+
+    Parameters
+    ----------
+    source : str
+        folder with raw files or url of http mirror, see `find_new_files`
+    state_path : str
+        folder of watch state, see `load_state`
+    raw_path : str
+        folder where to save files downloaded from mirror
+    features_path, cube_path, storage_backend, registry, max_diff, interim_path :
+        see `process_week`
+    publish_path : str
+        folder of published cubes, see `publish_cubes`
+    start_date, settle_seconds :
+        see `find_new_files`
+    """
+    state = load_state(state_path)
+    files = find_new_files(source, state, raw_path, start_date, settle_seconds)
+    if not files:
+        return []
+
+    os.makedirs(state_path, exist_ok=True)
+    seed = _load_seed(state_path)
+    weeks = []
+    for file in files:
+        week = storage.week_from_path(file)
+        detected_at = time.time()
+        with profiling.stage('watch.week', week=week) as stats:
+            df, seed = process_week(file, seed, features_path, cube_path, storage_backend, registry, max_diff,
+                                    interim_path)
+            stats.add(rows_out=len(df))
+
+        seed.to_parquet(_seed_file(state_path) + '.tmp', index=False)
+        os.replace(_seed_file(state_path) + '.tmp', _seed_file(state_path))
+        state['weeks'][week] = {'file': file, 'rows': len(df), 'detected_at': detected_at}
+        state['last_week'] = week
+        incremental.save_manifest(state, os.path.join(state_path, 'state.json'))
+        weeks.append(week)
+
+    with profiling.stage('watch.publish'):
+        publish_cubes(cube_path, publish_path)
+
+    published_at = time.time()
+    for week in weeks:
+        record = state['weeks'][week]
+        record.update(published_at=published_at, latency_s=round(published_at - record['detected_at'], 3))
+        logger.info('Week %s published in %.1f s', week, record['latency_s'])
+    incremental.save_manifest(state, os.path.join(state_path, 'state.json'))
+
+    return weeks
+
+def watch(source, interval=30., max_polls=None, on_publish=None, **kwargs):
+    """Tail mode: polls folder or http mirror for newly published weekly files and processes
+        only new weeks (see `poll_once`), then publishes refreshed cubes.
+        Latency of new week is `interval` at most plus processing time of one week.
+        Stops after `max_polls` polls or on KeyboardInterrupt.
+
+            watch('http://localhost:8000/', interval=30, registry=registry)
+
+    Parameters
+    ----------
+    source : str
+        folder with raw files or url of http mirror, see `find_new_files`
+    interval : float
+        seconds between polls
+    max_polls : int or None
+        number of polls, None - polls until interrupted
+    on_publish : callable or None
+        called with list of processed weeks after cubes are published (i.e. to refresh dashboards)
+    kwargs :
+        see `poll_once`
+    """
+    n_polls = 0
+    try:
+        while max_polls is None or n_polls < max_polls:
+            started = time.time()
+            try:
+                weeks = poll_once(source, **kwargs)
+            except (OSError, ValueError) as error:
+                # broken or partial file, next poll retries it
+                logger.error('Poll failed: %s', error)
+                weeks = []
+            if weeks:
+                print(f"Published weeks: {', '.join(weeks)}")
+                if on_publish is not None:
+                    on_publish(weeks)
+            n_polls += 1
+            if max_polls is None or n_polls < max_polls:
+                time.sleep(max(0., interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        print('Watch mode stopped')